@@ -0,0 +1,60 @@
+"""
+Compares write and read latency of one JSON file per event against PackedEventStore on a local directory.
+
+    python benchmarks/bench_event_store.py --n 10000
+"""
+import argparse
+import json
+import random
+import tempfile
+from pathlib import Path
+
+from common import Timer
+from microns_dashboard_api.stores import PackedEventStore
+
+
+def run(n=10000, n_reads=1000):
+    payloads = [{'entry_point': 'benchmark', 'user': f'bench_user_{i}', 'auto': False} for i in range(n)]
+    keys = [f'{i:012x}' for i in range(n)]
+    sample = random.Random(0).sample(range(n), min(n, n_reads))
+    results = {'n': n, 'n_reads': len(sample)}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        json_dir = Path(tmp) / 'json'
+        json_dir.mkdir()
+        with Timer() as t:
+            for key, payload in zip(keys, payloads):
+                with open(json_dir.joinpath(key).with_suffix('.json'), 'w') as f:
+                    f.write(json.dumps(payload))
+        results['json_write_s'] = t.elapsed
+        with Timer() as t:
+            for i in sample:
+                with open(json_dir.joinpath(keys[i]).with_suffix('.json'), 'r') as f:
+                    json.load(f)
+        results['json_read_s'] = t.elapsed
+
+        store = PackedEventStore(Path(tmp) / 'packed')
+        with Timer() as t:
+            pointers = [store.append(payload, key=key) for key, payload in zip(keys, payloads)]
+        results['packed_write_s'] = t.elapsed
+        with Timer() as t:
+            store.append_many(payloads, keys=keys)
+        results['packed_write_many_s'] = t.elapsed
+        with Timer() as t:
+            for i in sample:
+                store.read(pointers[i])
+        results['packed_read_s'] = t.elapsed
+        with Timer() as t:
+            store.read_many([pointers[i] for i in sample])
+        results['packed_read_many_s'] = t.elapsed
+        results['n_json_files'] = len(list(json_dir.iterdir()))
+        results['n_packed_files'] = len(list(store.location.iterdir()))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--n', type=int, default=10000)
+    parser.add_argument('--n-reads', type=int, default=1000)
+    args = parser.parse_args()
+    print(run(n=args.n, n_reads=args.n_reads))
@@ -0,0 +1,56 @@
+"""
+Times a full export of the event history, then an incremental export of new events only, with peak Python memory.
+    Requires pyarrow.
+
+    python benchmarks/bench_export.py --history 10000 --new 100 --chunk-size 1000
+"""
+import argparse
+import tempfile
+import time
+import tracemalloc
+
+from bench_user_activity import log_events
+from common import Timer, setup_dashboard
+
+
+def run(history=10000, new=100, chunk_size=1000, settle=1):
+    db = setup_dashboard()
+    from microns_dashboard_api import export
+
+    destination = tempfile.mkdtemp(prefix='bench_export_')
+    name = f'bench_export_{int(time.time())}'
+    parts = [db.Event.UserAccess, db.Event.UserCheckIn]
+    log_events(db, history)
+    time.sleep(settle + 1)
+    
+    tracemalloc.start()
+    try:
+        with Timer() as full:
+            first = export.export(destination, parts=parts, chunk_size=chunk_size, settle=settle, name=name)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    log_events(db, new, offset=history)
+    time.sleep(settle + 1)
+    with Timer() as incremental:
+        second = export.export(destination, parts=parts, chunk_size=chunk_size, settle=settle, name=name)
+    
+    return {
+        'history': history,
+        'chunk_size': chunk_size,
+        'full_s': full.elapsed,
+        'full_events': sum([r['n_events'] for r in first['parts'].values()]),
+        'peak_memory_mb': peak / 2**20,
+        'incremental_s': incremental.elapsed,
+        'incremental_events': sum([r['n_events'] for r in second['parts'].values()]),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--history', type=int, default=10000)
+    parser.add_argument('--new', type=int, default=100)
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--settle', type=int, default=1)
+    print(run(**vars(parser.parse_args())))
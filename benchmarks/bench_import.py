@@ -0,0 +1,46 @@
+"""
+Measures the time to import the dashboard apps in a fresh interpreter, with the modules a notebook kernel 
+    already has loaded (IPython, ipywidgets, numpy) imported beforehand. Fails if the import exceeds the budget 
+    or if it loads the database or Slack clients.
+
+    python benchmarks/bench_import.py --budget-ms 100
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+preloaded = ['IPython', 'ipywidgets', 'numpy']
+forbidden = ['datajoint', 'datajoint_plus', 'pymysql', 'slack', 'microns_utils']
+
+script = f"""
+import json, sys, time
+{'; '.join(['import ' + m for m in preloaded])}
+start = time.perf_counter()
+from microns_dashboard_api.apps import UserApp
+elapsed = time.perf_counter() - start
+loaded = [m for m in {forbidden} if m in sys.modules and type(sys.modules[m]).__name__ != '_LazyModule']
+print(json.dumps({{'import_s': elapsed, 'loaded': loaded}}))
+"""
+
+
+def run(n=5):
+    results = [json.loads(subprocess.check_output([sys.executable, '-c', script])) for _ in range(n)]
+    return {
+        'n': n,
+        'import_s': min([r['import_s'] for r in results]),
+        'loaded': sorted(set(sum([r['loaded'] for r in results], []))),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--n', type=int, default=5)
+    parser.add_argument('--budget-ms', type=float, default=100)
+    args = parser.parse_args()
+    result = run(n=args.n)
+    print(result)
+    if result['loaded']:
+        sys.exit(f'Importing the apps loaded {result["loaded"]}.')
+    if 1000 * result['import_s'] > args.budget_ms:
+        sys.exit(f'Importing the apps took {1000 * result["import_s"]:.1f} ms, over the {args.budget_ms} ms budget.')
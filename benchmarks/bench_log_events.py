@@ -0,0 +1,58 @@
+"""
+Compares N calls to Event.log_event against one call to Event.log_events, 
+    and times Event.log_event for each event type, including its on_event side effects, 
+    and for repeats of an idempotency key, as in a page reload storm.
+
+    python benchmarks/bench_log_events.py --n 1000 --n-per-event 100
+"""
+import argparse
+import time
+
+from common import Timer, sample_record, setup_dashboard
+
+
+def run(n=1000, n_per_event=100):
+    db = setup_dashboard()
+    run_id = int(time.time())
+    
+    with Timer() as single:
+        for i in range(n):
+            db.Event.log_event('user_access', {'user': f'bench_user_{i}'}, {'entry_point': 'benchmark'})
+        db.slack_notifier.flush()
+    
+    with Timer() as batch:
+        db.Event.log_events([
+            {'event': 'user_access', 'attrs': {'user': f'bench_user_{i}'}, 'data': {'entry_point': 'benchmark'}} for i in range(n)
+        ])
+        db.slack_notifier.flush()
+    
+    per_event = {}
+    for event in db.Event.events():
+        records = [sample_record(event, f'bench_user_{run_id}_{i}') for i in range(n_per_event)]
+        with Timer() as t:
+            for record in records:
+                db.Event.log_event(record['event'], record['attrs'], record['data'])
+            db.slack_notifier.flush()
+        per_event[event] = {'n': n_per_event, 'log_event_ms': 1000 * t.elapsed / n_per_event}
+
+    idempotency_key = db.Event.make_idempotency_key('user_access', f'bench_user_{run_id}', 'benchmark')
+    with Timer() as duplicate:
+        for _ in range(n_per_event):
+            db.Event.log_event('user_access', {'user': f'bench_user_{run_id}'}, {'entry_point': 'benchmark'}, idempotency_key=idempotency_key)
+        db.slack_notifier.flush()
+
+    return {
+        'n': n, 
+        'log_event_s': single.elapsed, 
+        'log_events_s': batch.elapsed, 
+        'speedup': single.elapsed / batch.elapsed, 
+        'per_event': per_event, 
+        'idempotent': {'n': n_per_event, 'n_logged': len(db.EventKey & {'idempotency_key': idempotency_key}), 'log_event_ms': 1000 * duplicate.elapsed / n_per_event},
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--n', type=int, default=1000)
+    parser.add_argument('--n-per-event', type=int, default=100)
+    print(run(**vars(parser.parse_args())))
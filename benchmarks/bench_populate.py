@@ -0,0 +1,46 @@
+"""
+Times EventHandler.run dispatch and bulk_populate of User.Add and User.AddInfo for N new users.
+    Events are logged without their on_event side effects so that populate starts from a full backlog.
+
+    python benchmarks/bench_populate.py --n 1000
+"""
+import argparse
+import time
+
+from common import Timer, sample_record, setup_dashboard, without_on_events
+
+
+def run(n=1000, batch_size=100):
+    db = setup_dashboard()
+    db.EventHandler.UserEvent.contents
+    users = [f'bench_populate_{int(time.time())}_{i}' for i in range(n)]
+    with without_on_events(db.Event.UserAdd):
+        add_events = db.Event.log_events([sample_record('user_add', user) for user in users])
+        add_info_events = db.Event.log_events([sample_record('user_add_info', user) for user in users])
+    add_keys = [{'event_id': e.id} for e in add_events]
+    add_info_keys = [{'event_id': e.id} for e in add_info_events]
+
+    rows = ((db.Event.UserAdd & add_info_keys) * db.EventHandler.UserEvent).fetch(as_dict=True)
+    with Timer() as dispatch:
+        for row in rows:
+            db.EventHandler.run(row)
+
+    with Timer() as add:
+        add_stats = db.bulk_populate(db.User.Add, add_keys, batch_size=batch_size)
+    with Timer() as add_info:
+        add_info_stats = db.bulk_populate(db.User.AddInfo, add_info_keys, batch_size=batch_size)
+
+    return {
+        'n': n,
+        'handler_run_ms': 1000 * dispatch.elapsed / max(len(rows), 1),
+        'user_add_populate_s': add.elapsed,
+        'user_add_info_populate_s': add_info.elapsed,
+        'made': add_stats['made'] + add_info_stats['made'],
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--n', type=int, default=1000)
+    parser.add_argument('--batch-size', type=int, default=100)
+    print(run(**vars(parser.parse_args())))
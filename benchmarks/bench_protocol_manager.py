@@ -0,0 +1,56 @@
+"""
+Times ProtocolManager construction, opening the management controls, refresh and update_source on protocol sources 
+    of different sizes, and counts the widgets built before and after the controls are opened.
+
+    python benchmarks/bench_protocol_manager.py --sizes 10 100 1000
+"""
+import argparse
+
+from common import Timer, setup_benchmark_tables
+
+
+def run(sizes=(10, 100, 1000), repeats=5):
+    from microns_dashboard_api.apps import ProtocolManager
+
+    Protocol, _ = setup_benchmark_tables()
+    results = []
+    for n in sizes:
+        Protocol.delete_quick()
+        Protocol.insert([
+            {'protocol_id': f'{i:08d}', 'protocol_name': f'protocol_{i}', 'tag': 'benchmark', 'active': i % 2, 'ordering': i // 2 if i % 2 else None} for i in range(n)
+        ])
+        with Timer() as construct:
+            for _ in range(repeats):
+                manager = ProtocolManager(source=Protocol, manage=True)
+        n_widgets = len(manager.wridgets())
+        with Timer() as manage:
+            manager._manage_button.set(value=True)
+        with Timer() as refresh:
+            for _ in range(repeats):
+                manager.refresh()
+        with Timer() as force_refresh:
+            for _ in range(repeats):
+                manager.refresh(force=True)
+        with Timer() as update:
+            for protocol in manager.inactive_protocols[:repeats]:
+                manager._inactive_select.wridget.widget.value = protocol
+                manager.update_source(set_active=True)
+        results.append({
+            'n_protocols': n,
+            'construct_ms': 1000 * construct.elapsed / repeats,
+            'n_widgets': n_widgets,
+            'manage_ms': 1000 * manage.elapsed,
+            'n_widgets_managed': len(manager.wridgets()),
+            'refresh_ms': 1000 * refresh.elapsed / repeats,
+            'force_refresh_ms': 1000 * force_refresh.elapsed / repeats,
+            'update_source_ms': 1000 * update.elapsed / max(min(repeats, n // 2), 1),
+        })
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--repeats', type=int, default=5)
+    for result in run(**vars(parser.parse_args())):
+        print(result)
@@ -0,0 +1,61 @@
+"""
+Times a read path while another process logs events, with reads on the primary and routed to read replicas.
+    The replicas can be a second local MySQL instance (e.g. 127.0.0.1:3307) holding a copy of the dashboard schema.
+
+    python benchmarks/bench_routing.py --replicas 127.0.0.1:3307 --duration 10
+"""
+import argparse
+import multiprocessing
+import time
+
+import numpy as np
+
+from bench_user_activity import log_events
+from common import Timer, setup_dashboard
+
+
+def write(duration, batch=100):
+    import datajoint_plus as djp
+
+    db = setup_dashboard()
+    djp.conn(reset=True)
+    end, offset = time.monotonic() + duration, 0
+    while time.monotonic() < end:
+        log_events(db, batch, offset=offset)
+        offset += batch
+
+
+def read(db, router, duration):
+    import datajoint_plus as djp
+
+    query = djp.U('user').aggr(db.Event.UserAccess, n_access='count(*)')
+    latencies, end = [], time.monotonic() + duration
+    while time.monotonic() < end:
+        with Timer() as t:
+            router.fetch(query, as_dict=True)
+        latencies.append(t.elapsed)
+    return {'n': len(latencies), 'p50_ms': 1000 * np.percentile(latencies, 50), 'p95_ms': 1000 * np.percentile(latencies, 95)}
+
+
+def run(replicas=None, duration=10.):
+    db = setup_dashboard()
+    from microns_dashboard_api.connections import ConnectionRouter, connection_router
+
+    replicas = connection_router.replicas if replicas is None else replicas
+    results = {'replicas': replicas}
+    for name, router in [('primary', ConnectionRouter()), ('routed', ConnectionRouter(replicas=replicas))]:
+        writer = multiprocessing.get_context('fork').Process(target=write, args=(duration,))
+        writer.start()
+        try:
+            results[name] = read(db, router, duration)
+            results[name]['stats'] = dict(router.stats)
+        finally:
+            writer.join()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--replicas', nargs='*', default=None, help='replica hosts; defaults to MICRONS_DASHBOARD_READ_REPLICAS')
+    parser.add_argument('--duration', type=float, default=10.)
+    print(run(**vars(parser.parse_args())))
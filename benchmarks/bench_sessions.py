@@ -0,0 +1,28 @@
+"""
+Runs N concurrent headless dashboard sessions and reports per-interaction latency and memory per session.
+
+    python benchmarks/bench_sessions.py --n-sessions 20 --workers 4
+"""
+import argparse
+
+from common import setup_benchmark_tables
+
+
+def run(n_sessions=20, workers=4, mode='process', iterations=3):
+    import datajoint_plus as djp
+    from microns_dashboard_api.headless import run_sessions
+
+    Protocol, _ = setup_benchmark_tables()
+    if not len(Protocol & 'active = 1'):
+        Protocol.insert([{'protocol_id': f'{i:08d}', 'protocol_name': f'protocol_{i}', 'tag': 'benchmark', 'active': 1, 'ordering': i} for i in range(10)])
+    session_kws = {'username': djp.config['database.user'], 'password': djp.config['database.password'], 'protocol_source': Protocol}
+    return run_sessions(n_sessions=n_sessions, workers=workers, mode=mode, session_kws=session_kws, iterations=iterations)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--n-sessions', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--mode', choices=['process', 'thread'], default='process')
+    parser.add_argument('--iterations', type=int, default=3)
+    print(run(**vars(parser.parse_args())))
@@ -0,0 +1,46 @@
+"""
+Times DataJointTableApp.to_df on the first and last page of a large table, with offset and keyset paging,
+    and a full scan with iter_df.
+
+    python benchmarks/bench_table_app.py --n 100000
+"""
+import argparse
+
+from common import Timer, setup_benchmark_tables
+
+
+def run(n=100000, n_rows=25, chunk_size=10000):
+    from microns_dashboard_api.apps import DataJointTableApp
+
+    _, Row = setup_benchmark_tables()
+    if len(Row) != n:
+        Row.delete_quick()
+        for start in range(0, n, chunk_size):
+            Row.insert([{'row_id': i, 'user': f'bench_user_{i % 1000}', 'value': i / n, 'note': 'x' * 64} for i in range(start, min(n, start + chunk_size))])
+    
+    app = DataJointTableApp(source=Row, n_rows=n_rows)
+    last_page = (n - 1) // n_rows
+    with Timer() as first:
+        app.to_df(page=0)
+    with Timer() as offset:
+        app.to_df(page=last_page)
+    with Timer() as keyset:
+        app.to_df(after={'row_id': last_page * n_rows - 1})
+    with Timer() as scan:
+        n_scanned = sum([len(df) for df in app.iter_df(chunk_size=chunk_size)])
+    return {
+        'n': n,
+        'first_page_ms': 1000 * first.elapsed,
+        'last_page_offset_ms': 1000 * offset.elapsed,
+        'last_page_keyset_ms': 1000 * keyset.elapsed,
+        'iter_df_s': scan.elapsed,
+        'n_scanned': n_scanned,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--n', type=int, default=100000)
+    parser.add_argument('--n-rows', type=int, default=25)
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    print(run(**vars(parser.parse_args())))
@@ -0,0 +1,50 @@
+"""
+Shows that UserActivity.update_from_events costs O(new events), independent of the size of the event history.
+
+    python benchmarks/bench_user_activity.py --history 1000 10000 --new 100
+"""
+import argparse
+import time
+
+from common import Timer, setup_dashboard
+
+
+def log_events(db, n, offset=0, n_users=100):
+    records = []
+    for i in range(offset, offset + n):
+        user = f'bench_user_{i % n_users}'
+        if i % 4 == 0:
+            records.append({'event': 'user_check_in', 'attrs': {'user': user, 'check_in': (i // 4) % 2 == 0}})
+        else:
+            records.append({'event': 'user_access', 'attrs': {'user': user}, 'data': {'entry_point': 'benchmark'}})
+    db.Event.log_events(records)
+    db.slack_notifier.flush()
+
+
+def run(history=(1000, 10000), new=100, settle=1):
+    db = setup_dashboard()
+    results = []
+    logged = 0
+    for n in history:
+        log_events(db, n - logged, offset=logged)
+        logged = n
+        time.sleep(settle + 1)
+        with Timer() as catch_up:
+            db.UserActivity.update_from_events(settle=settle)
+
+        log_events(db, new, offset=logged)
+        logged += new
+        time.sleep(settle + 1)
+        with Timer() as incremental:
+            stats = db.UserActivity.update_from_events(settle=settle)
+        results.append({'history': logged, 'new': stats['n_access'] + stats['n_check_in'], 'catch_up_s': catch_up.elapsed, 'incremental_s': incremental.elapsed})
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--history', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--new', type=int, default=100)
+    parser.add_argument('--settle', type=int, default=1)
+    for result in run(**vars(parser.parse_args())):
+        print(result)
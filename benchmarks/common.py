@@ -0,0 +1,125 @@
+"""
+Shared setup for dashboard benchmarks.
+
+Benchmarks run against the database configured for DataJoint (e.g. DJ_HOST, DJ_USER and DJ_PASS pointing at a 
+    local MySQL/MariaDB container). Never point them at the production database; they write to the dashboard schema.
+"""
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+
+class LocalSlackClient:
+    """
+    Stand-in for SlackForWidget that records messages instead of posting them.
+    """
+    default_channel = '#microns-dashboard'
+
+    def __init__(self):
+        self.messages = []
+
+    def post_to_slack(self, text, channel=None, as_file=False):
+        self.messages.append((self.default_channel if channel is None else channel, text))
+        return True
+
+    def get_slack_username(self, display_name):
+        return display_name
+
+
+def setup_dashboard(events_dir=None):
+    """
+    Imports the dashboard schema with a local events store and a local Slack client.
+
+    :param events_dir: directory for event payloads. Defaults to a new temporary directory.
+
+    :returns: dashboard schema module
+    """
+    import datajoint_plus as djp
+    from microns_dashboard_api.schemas import dashboard as db
+
+    events_dir = Path(tempfile.mkdtemp(prefix='dashboard_events_') if events_dir is None else events_dir)
+    db.Event.basedir = events_dir # first attribute access imports the schema and registers the stores
+    djp.config['stores']['events']['location'] = str(events_dir)
+    db.slack_client = LocalSlackClient()
+    db.slack_notifier.client = db.slack_client
+    db.slack_notifier.rate = None # the local client has no rate limits
+    return db
+
+
+def sample_record(event, user):
+    """
+    Returns a log_events record for event with the attrs and data the dashboard would log for user.
+    """
+    attrs, data = {'user': user}, None
+    if event == 'user_access':
+        data = {'entry_point': 'benchmark'}
+    elif event == 'user_check_in':
+        attrs['check_in'] = 1
+    elif event == 'user_add_info':
+        attrs['info_type'] = 'slack_username'
+        data = user
+    return {'event': event, 'attrs': attrs, 'data': data}
+
+
+@contextmanager
+def without_on_events(part):
+    """
+    Logs events to an Event part without their side effects (populate, Slack), e.g. to benchmark those separately.
+    """
+    on_events = part.__dict__['on_events']
+    part.on_events = lambda self, events, notifier=None: None
+    try:
+        yield
+    finally:
+        part.on_events = on_events
+
+
+def setup_benchmark_tables(schema_name='microns_dashboard_benchmark'):
+    """
+    Declares the tables used as sources for the app benchmarks in their own schema.
+
+    :returns: 
+        Protocol: protocol source for ProtocolManager
+        Row: wide table for DataJointTableApp
+    """
+    import datajoint_plus as djp
+
+    schema = djp.schema(schema_name, create_schema=True)
+
+    @schema
+    class Protocol(djp.Lookup):
+        definition = """
+        protocol_id : varchar(32)
+        ---
+        protocol_name : varchar(64)
+        tag : varchar(32)
+        active : tinyint
+        ordering=NULL : int
+        last_updated=CURRENT_TIMESTAMP : timestamp
+        """
+
+    @schema
+    class Row(djp.Lookup):
+        definition = """
+        row_id : int unsigned
+        ---
+        user : varchar(128)
+        value : float
+        note : varchar(255)
+        created=CURRENT_TIMESTAMP : timestamp
+        """
+
+    return Protocol, Row
+
+
+class Timer:
+    """
+    Context manager that records elapsed wall time in seconds.
+    """
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.elapsed = time.perf_counter() - self.start
@@ -0,0 +1,128 @@
+"""
+Runs the benchmark suite and stores the results as JSON, so that regressions can be compared across commits.
+
+Slack is replaced by a local client and the apps are built without a front end. Database benchmarks need a local
+    MySQL/MariaDB (see common.py); use --no-db to run only the benchmarks that do not.
+
+    python benchmarks/run.py                                  # writes benchmarks/results/<commit>.json
+    python benchmarks/run.py --only import event_store --no-db
+    python benchmarks/run.py --compare benchmarks/results/<other commit>.json
+"""
+import argparse
+import importlib
+import json
+import platform
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+benchmarks_dir = Path(__file__).resolve().parent
+
+# name: (module, uses the database)
+suite = {
+    'import': ('bench_import', False),
+    'event_store': ('bench_event_store', False),
+    'log_events': ('bench_log_events', True),
+    'populate': ('bench_populate', True),
+    'protocol_manager': ('bench_protocol_manager', True),
+    'table_app': ('bench_table_app', True),
+    'user_activity': ('bench_user_activity', True),
+    'sessions': ('bench_sessions', True),
+    'export': ('bench_export', True),
+    'routing': ('bench_routing', True),
+}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=benchmarks_dir, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run(names=None, db=True):
+    """
+    Runs benchmarks. A benchmark that raises is recorded with its error and the others still run.
+
+    :param names: (list) benchmarks to run. Defaults to the whole suite.
+    :param db: (bool) if False, benchmarks that use the database are skipped
+
+    :returns: (dict) commit, python version, start time and results by benchmark name
+    """
+    # benchmarks import common.py and the package from the checkout being measured
+    sys.path[:0] = [str(benchmarks_dir), str(benchmarks_dir.parent)]
+    output = {'commit': git_commit(), 'python': platform.python_version(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': {}}
+    for name in suite if names is None else names:
+        module, uses_db = suite[name]
+        if uses_db and not db:
+            continue
+        print(f'Running {name}...', flush=True)
+        try:
+            output['results'][name] = importlib.import_module(module).run()
+        except Exception as e:
+            output['results'][name] = {'error': repr(e)}
+    return output
+
+
+def flatten(result, prefix=''):
+    """
+    Returns {dotted path: value} for the timings in a result. Timings are the numbers under keys ending in _s or _ms.
+    """
+    if isinstance(result, list):
+        items = [(str(r.get('n_protocols', r.get('history', r.get('stage', i)))) if isinstance(r, dict) else str(i), r) for i, r in enumerate(result)]
+    elif isinstance(result, dict):
+        items = result.items()
+    else:
+        return {}
+    flat = {}
+    for key, value in items:
+        path = f'{prefix}.{key}' if prefix else str(key)
+        if isinstance(value, (dict, list)):
+            flat.update(flatten(value, prefix=path))
+        elif isinstance(value, (int, float)) and str(key).endswith(('_s', '_ms')):
+            flat[path] = value
+    return flat
+
+
+def compare(current, baseline, threshold=1.2):
+    """
+    Compares timings of two result files.
+
+    :returns: (list) (timing, baseline, current, ratio, is_regression) for timings present in both
+    """
+    current, baseline = flatten(current['results']), flatten(baseline['results'])
+    rows = []
+    for path in sorted(set(current) & set(baseline)):
+        ratio = current[path] / baseline[path] if baseline[path] else float('inf')
+        rows.append((path, baseline[path], current[path], ratio, ratio > threshold))
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs the dashboard benchmark suite.')
+    parser.add_argument('--only', nargs='+', choices=list(suite), help='benchmarks to run')
+    parser.add_argument('--no-db', action='store_true', help='skip benchmarks that use the database')
+    parser.add_argument('--output', default=str(benchmarks_dir / 'results'), help='directory for the results file')
+    parser.add_argument('--compare', help='results file to compare against')
+    parser.add_argument('--threshold', type=float, default=1.2, help='slowdown ratio reported as a regression')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+    output = run(names=args.only, db=not args.no_db)
+    path = Path(args.output) / f"{output['commit']}.json"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(output, f, indent=2, default=str)
+    print(f'Results written to {path}')
+
+    if baseline is not None:
+        regressions = 0
+        for timing, before, after, ratio, is_regression in compare(output, baseline, threshold=args.threshold):
+            regressions += is_regression
+            print(f"{'REGRESSION ' if is_regression else ''}{timing}: {before:.4g} -> {after:.4g} ({ratio:.2f}x)")
+        if regressions:
+            sys.exit(f'{regressions} timing(s) regressed by more than {args.threshold}x against {baseline["commit"]}.')
@@ -1,22 +1,32 @@
+import concurrent.futures
+import hashlib
+import inspect
 import json
 import logging
 import time
 
 import wridgets.app as wra
+from wridgets.utils import wrap
 from ipywidgets import link
 import numpy as np
-import datajoint_plus as djp
-import pandas as pd
-from microns_utils.misc_utils import wrap
-from ..utils import GetDashboardUser, get_user_info_js
-from ..schemas import dashboard as db
+from ..utils import GetDashboardUser, get_user_info_js, keyset_restriction, fetch_chunks, lazy_import
+from ..cache import MISSING, shared_cache
+from ..session import DashboardSession, get_session
 from collections import namedtuple
-logger = djp.getLogger(__name__)
+
+# imported on first use so that importing the apps does not connect to the database
+djp = lazy_import('datajoint_plus')
+pd = lazy_import('pandas')
+db = lazy_import('microns_dashboard_api.schemas.dashboard')
+connections = lazy_import('microns_dashboard_api.connections')
+protocols = lazy_import('microns_dashboard_api.protocols')
+logger = logging.getLogger(__name__)
 
 
 class DataType:   
     Protocol = namedtuple('Protocol', ['ID', 'name', 'tag', 'active', 'ordering'])
     Protocol.__repr__ = lambda self: 'Protocol(' + ', '.join([f'{f}={getattr(self, f)}' for f in self._fields ]) + ')'
+    ProtocolSnapshot = namedtuple('ProtocolSnapshot', ['protocols', 'active', 'inactive', 'n_rows', 'last_updated'])
 
 
 class AppLink(wra.App):
@@ -53,19 +63,30 @@ class AppLink(wra.App):
 class UserApp(wra.App):
     store_config = [
         'user_app',
-        'user_info',
+        '_user_info',
         'entry_point',
         'on_user_update',
         'on_user_update_kwargs',
+        'debounce',
+        'session',
     ]
     
     get_user_info_js = get_user_info_js
 
     def make(self, **kwargs):
+        """
+        :param debounce: (float) seconds during which repeated updates to the same user (e.g. widget re-syncs) 
+            do not call on_user_update again. Defaults to None (every update calls it).
+        :param session: (DashboardSession) if provided, the user is read from the session instead of a user_app widget 
+            or user_info, and on_user_update is called when the session user is resolved
+        """
         self.propagate = True
+        self.session = kwargs.get('session')
         self.entry_point = kwargs.get('entry_point')
         self.on_user_update = self.on_user_update if kwargs.get('on_user_update') is None else kwargs.get('on_user_update')
         self.on_user_update_kwargs = {} if kwargs.get('on_user_update_kwargs') is None else kwargs.get('on_user_update_kwargs')
+        self.debounce = kwargs.get('debounce')
+        self._last_user_update = None
         self.core = (
             (
                 wra.Label(text='User', name='UserLabel') + \
@@ -78,39 +99,97 @@ class UserApp(wra.App):
             
         )
         
-        if 'user_app' in kwargs:
+        if self.session is not None:
+            self.session.on_change(self._on_session_change)
+
+        elif 'user_app' in kwargs:
             self.user_app = kwargs.get('user_app')
             link((self.children.UserField.wridget.widget, 'value'), (self.user_app, 'name'))
             link((self.children.UserInfoField.wridget.widget, 'value'), (self.user_app, 'value'), transform=[json.loads, json.dumps])
             
         elif 'user_info' in kwargs:
-            self.user_info = kwargs.get('user_info')
+            self._user_info = kwargs.get('user_info')
             self.children.UserField.set(value=kwargs.get('user_info').get('user'))
             self.children.UserInfoField.set(value=json.dumps(kwargs.get('user_info')))
     
     @property
     def user(self):
+        if self.session is not None:
+            return self.session.user
         return self.children.UserField.get1('value')
     
     @property
     def user_info(self):
+        if self.session is not None:
+            return self.session.user_info
+        if self._user_info is not None:
+            return dict(self._user_info)
         return json.loads(self.children.UserInfoField.get1('value'))
+
+    def _on_session_change(self, session):
+        self.children.UserInfoField.set(value=json.dumps(session.user_info))
+        self.children.UserField.set(value=session.user)
     
     def on_user_update(self, **kwargs):
         pass
 
     def _on_user_update(self):
+        now = time.monotonic()
+        if self.debounce is not None and self._last_user_update is not None:
+            user, last = self._last_user_update
+            if user == self.user and now - last < self.debounce:
+                return
+        self._last_user_update = (self.user, now)
         self.on_user_update(**self.on_user_update_kwargs)
 
 
+def _session_kws(func, session, kwargs):
+    """
+    Returns kwargs with the keys of the session user (e.g. user=<user>) that func accepts, so that callbacks written 
+        without a user parameter keep working when a session is injected.
+    """
+    if session is None:
+        return kwargs
+    try:
+        params = inspect.signature(func).parameters
+    except (TypeError, ValueError):
+        return kwargs
+    var_kw = any([p.kind == p.VAR_KEYWORD for p in params.values()])
+    return {**{k: v for k, v in session.key.items() if var_kw or k in params}, **kwargs}
+
+
+def _rows_state(rows):
+    """
+    Returns (number of rows, max last_updated) of fetched protocol rows, as compared with the source state.
+    """
+    return len(rows), max([row.get('last_updated') for row in rows if row.get('last_updated') is not None], default=None)
+
+
+def _kernel_loop():
+    """
+    Returns the IO loop of the running IPython kernel, or None outside a kernel.
+    """
+    try:
+        from ipykernel.kernelbase import Kernel
+    except ImportError:
+        return None
+    if not Kernel.initialized():
+        return None
+    return getattr(Kernel.instance(), 'io_loop', None)
+
+
 class DataJointLoginApp(wra.App):
     store_config = [
-        'is_connected'
+        'is_connected',
+        'login_future',
+        'login_latency',
+        'login_error'
     ]
     
     def make(self, **kwargs):
         self.hide_on_login = kwargs.get('hide_on_login')
         self.disable_on_login = kwargs.get('disable_on_login')
+        self.asynchronous = True if kwargs.get('asynchronous') is None else kwargs.get('asynchronous')
         self.on_login = self.on_login if kwargs.get('on_login') is None else kwargs.get('on_login')
         self.on_login_kwargs = {} if kwargs.get('on_login_kwargs') is None else kwargs.get('on_login_kwargs')
         self._header = wra.Label(text='DataJoint', fontsize=2)
@@ -133,14 +212,18 @@ class DataJointLoginApp(wra.App):
         
     def check_connection(self):
         try:
-            djp.conn.connection
-            self.is_connected = True
-            self.msg('Connection established.')
-            time.sleep(2)
+            self.is_connected = djp.conn.connection.is_connected
         except:
             self.is_connected = False
+        self._show_connection()
+
+    def _show_connection(self):
+        if self.is_connected:
+            self.msg('Connection established.')
+        elif self.login_error is not None:
+            self.msg(f'Connection not established. {self.login_error}')
+        else:
             self.msg('Connection not established.')
-            time.sleep(2)
     
     def on_login(self, **kwargs):
         pass
@@ -152,26 +235,73 @@ class DataJointLoginApp(wra.App):
             djp.config['database.user'] = self._username_field.get1('value')
             djp.config['database.password'] = self._password_field.get1('value')
             logging.disable(logging.NOTSET)
-            djp.conn(reset=True)
-            self.check_connection()
-            self.clear_output()
+            start = time.perf_counter()
+            loop = _kernel_loop() if self.asynchronous else None
+            self.login_future = connections.connection_pool.connect_async()
+            if loop is not None:
+                self._login_button.set(disabled=True)
+                self.msg('Connecting...', with_clear_button=False)
+                def done(future):
+                    self.login_latency = time.perf_counter() - start
+                    # widgets and outputs are only updated from the kernel's thread
+                    loop.add_callback(self._on_connected, future)
+                self.login_future.add_done_callback(done)
+            else:
+                self.login_future.exception()
+                self.login_latency = time.perf_counter() - start
+                self._on_connected(self.login_future)
 
-            if self.hide_on_login:
-                self.set(hide=True)
+    def _on_connected(self, future):
+        """
+        Shows the result of a login attempt and runs on_login if it connected. 
+            A failed login leaves is_connected False even if a previous connection is still open.
+        """
+        self._login_button.set(disabled=False)
+        self.login_error = future.exception()
+        if self.login_error is not None:
+            logger.warning('Login failed: %r', self.login_error)
+        self.is_connected = self.login_error is None and future.result().is_connected
+        self._show_connection()
+        if not self.is_connected:
+            return
+        self.clear_output()
 
-            if self.disable_on_login:
-                self.set(disabled=True)
-            
-            self.on_login(**self.on_login_kwargs)
+        if self.hide_on_login:
+            self.set(hide=True)
+
+        if self.disable_on_login:
+            self.set(disabled=True)
+        
+        self.on_login(**self.on_login_kwargs)
+
+    def wait(self, timeout=None):
+        """
+        Blocks until an asynchronous login attempt has connected or failed. Returns True if connected.
+            on_login runs afterwards, on the kernel's thread.
+        """
+        if self.login_future is None:
+            return bool(self.is_connected)
+        done, _ = concurrent.futures.wait([self.login_future], timeout=timeout)
+        return bool(done) and self.login_future.exception() is None and self.login_future.result().is_connected
 
 
 class ProtocolManager(wra.App):
     store_config = [
-        ('protocol_is_set', False)
+        ('protocol_is_set', False),
+        ('fetch_count', 0),
+        'session',
     ]
 
-    def make(self, source, on_set_protocol=None, on_set_protocol_kws=None, manage=False, **kwargs):
+    def make(self, source, on_set_protocol=None, on_set_protocol_kws=None, manage=False, session=None, **kwargs):
+        """
+        :param session: (DashboardSession) if provided, on_set_protocol is also called with the keys of the 
+            session user (user=<user>) if it accepts them
+        """
+        self.session = session
         self.source = source
+        self._snapshot = None
+        # the management controls are built on the first on_manage (see _build_manage)
+        self._manage_built = False
         self.on_set_protocol = self.setdefault('on_set_protocol', on_set_protocol if on_set_protocol is not None else self.on_set_protocol)
         self.on_set_protocol_kws = self.setdefault('on_set_protocol_kws', on_set_protocol_kws if on_set_protocol_kws is not None else {})
         self.manage = self.setdefault('manage', manage)
@@ -237,18 +367,36 @@ class ProtocolManager(wra.App):
         
         # Set WrApps
         self._label = wra.Label(**label_kws)
-        self._active_select_label = wra.Label(**active_select_label_kws)
         self._active_select = wra.Select(options=self.active_protocol_options, **active_select_kws)
         self._set_protocol_button = wra.ToggleButton(**set_protocol_button_kws)
         self._refresh_button = wra.Button(**refresh_button_kws)
         self._manage_button = wra.ToggleButton(**manage_button_kws)
-        self._inactive_select_label = wra.Label(**inactive_select_label_kws)
-        self._inactive_select = wra.Select(options=self.inactive_protocol_options, **inactive_select_kws)
-        self._set_active_button = wra.Button(**set_active_button_kws)
-        self._set_inactive_button = wra.Button(**set_inactive_button_kws)
         
         # Set core
         self.core = (
+            self._label - \
+            self._active_select - \
+            (
+                self._set_protocol_button + \
+                self._refresh_button + \
+                self._manage_button                
+            )
+        )
+
+    def _build_manage(self):
+        """
+        Builds the management controls and loads the inactive protocols. Runs once; later calls reuse the controls.
+        """
+        if self._manage_built:
+            return
+        self._manage_built = True
+        self.load_protocols(force=True)
+        self._active_select_label = wra.Label(**self.getdefault('active_select_label_kws'))
+        self._inactive_select_label = wra.Label(**self.getdefault('inactive_select_label_kws'))
+        self._inactive_select = wra.Select(options=self.inactive_protocol_options, **self.getdefault('inactive_select_kws'))
+        self._set_active_button = wra.Button(**self.getdefault('set_active_button_kws'))
+        self._set_inactive_button = wra.Button(**self.getdefault('set_inactive_button_kws'))
+        core = (
             self._label - \
             (
                 (
@@ -264,14 +412,19 @@ class ProtocolManager(wra.App):
                 self._manage_button                
             )
         )
+        # keep self.app, which may already be displayed, and only replace its rows
+        self._core = core
+        self._app_layout = core._app_layout
+        self.children = core.children
+        self.build()
 
-    def on_set_protocol(self):
+    def on_set_protocol(self, **kwargs):
         pass
     
     def _on_set_protocol(self, **kwargs):
         if self._set_protocol_button.get1('value'):
             self._set_protocol_button.set(description='Unset')
-            self.on_set_protocol(**self.on_set_protocol_kws)
+            self.on_set_protocol(**_session_kws(self.on_set_protocol, self.session, self.on_set_protocol_kws))
             self.set(disabled=True, exclude=self._set_protocol_button.name)
             self.protocol_is_set = True
         else:
@@ -281,6 +434,7 @@ class ProtocolManager(wra.App):
     
     def on_manage(self):
         if self._manage_button.get1('value'):
+            self._build_manage()
             self._set_protocol_button.set(disabled=True)
             self._manage_button.set(description='Hide Manage Tools')
             self._active_select_label.minimize = False
@@ -299,25 +453,85 @@ class ProtocolManager(wra.App):
             self._set_inactive_button.minimize = True
             self._set_protocol_button.set(disabled=False)
     
+    def load_protocols(self, force=False):
+        """
+        Returns the cached protocol snapshot, fetching it from source in a single query if there is none or force=True.
+            Until the management controls are built, only active protocols are fetched.
+            Without force, rows are read from shared_cache if another kernel has fetched them and a cheap count and
+            max(last_updated) query shows that source has not changed since, e.g. by a write of a kernel that does not
+            share the cache.
+        """
+        if force or self._snapshot is None:
+            # the namespace is per table so that updates invalidate every restriction of it; the key is per query
+            key = hashlib.sha1(self.query().make_sql().encode()).hexdigest()[:16]
+            rows = MISSING if force else shared_cache.get(self.cache_namespace, key, default=MISSING)
+            if rows is not MISSING and _rows_state(rows) != self._source_state():
+                rows = MISSING
+            if rows is MISSING:
+                version = shared_cache.version(self.cache_namespace)
+                rows = self._fetch_rows()
+                shared_cache.set(self.cache_namespace, key, rows, version=version)
+            protocols, active, inactive = [], [], []
+            for row in rows:
+                protocol = DataType.Protocol(
+                    ID=row.get('protocol_id'), 
+                    name=row.get('protocol_name'), 
+                    tag=row.get('tag'), 
+                    active=row.get('active'), 
+                    ordering=row.get('ordering')
+                )
+                protocols.append(protocol)
+                if protocol.active == 1:
+                    active.append(protocol)
+                elif protocol.active == 0:
+                    inactive.append(protocol)
+            self._snapshot = DataType.ProtocolSnapshot(
+                protocols=protocols,
+                active=active,
+                inactive=inactive,
+                n_rows=len(rows),
+                last_updated=_rows_state(rows)[1]
+            )
+        return self._snapshot
+
+    def _source_state(self):
+        state = connections.connection_router.fetch1(djp.U().aggr(self.query(), n_rows='count(*)', last_updated='max(last_updated)'))
+        self.fetch_count += 1
+        return state['n_rows'], state['last_updated']
+
+    def _fetch_rows(self):
+        self.fetch_count += 1
+        return connections.connection_router.fetch(self.query(), as_dict=True, order_by='-ordering DESC')
+
+    @property
+    def cache_namespace(self):
+        return f'protocols:{self.source.full_table_name}'
+
+    def query(self):
+        """
+        Protocols loaded by the manager: all of source once the management controls are built, otherwise the active protocols.
+        """
+        return self.source if self._manage_built else self.source & 'active = 1'
+
+    def is_stale(self):
+        """
+        Cheap change check. Returns True if rows were added, removed or updated in source since the snapshot was loaded.
+        """
+        if self._snapshot is None:
+            return True
+        return self._source_state() != (self._snapshot.n_rows, self._snapshot.last_updated)
+
     @property
     def protocols(self):
-        return [
-            DataType.Protocol(
-                ID=row.get('protocol_id'), 
-                name=row.get('protocol_name'), 
-                tag=row.get('tag'), 
-                active=row.get('active'), 
-                ordering=row.get('ordering')
-                ) for row in self.source.fetch(as_dict=True, order_by='-ordering DESC')
-        ]
+        return self.load_protocols().protocols
     
     @property
     def active_protocols(self):
-        return [p for p in self.protocols if p.active==1]
+        return self.load_protocols().active
     
     @property
     def inactive_protocols(self):
-        return [p for p in self.protocols if p.active==0]
+        return self.load_protocols().inactive
     
     def _format_protocol_object(self, protocol_obj:DataType.Protocol):
         return (f'{protocol_obj.name} ({protocol_obj.ID[:4]})', protocol_obj)
@@ -337,69 +551,134 @@ class ProtocolManager(wra.App):
     def update_source(self, set_active=None, set_inactive=None):
         assert (set_active is None) ^ (set_inactive is None), 'either set_active or set_inactive must be True'
         
-        def update(protocol_id):
-            update_dict = (self.source & {'protocol_id': protocol_id}).fetch1()
-            if set_active is not None:
-                update_dict.update({'active': 1})
-                orderings = [p.ordering for p in self.active_protocols if p.ordering is not None]
-                if orderings:
-                    last_idx = np.max(orderings)
-                else:
-                    last_idx = -1
-                update_dict.update({'ordering': 1 + last_idx})
-            if set_inactive is not None:
-                update_dict.update({'active': 0})
-                update_dict.pop('ordering')
-            update_dict.pop('last_updated')
-            self.source.insert1(update_dict, replace=True)
-        
         if set_active is not None:
-            protocol_id = self._inactive_select.get1('value').ID
+            protocols.activate_protocol(self.source, self._inactive_select.get1('value').ID)
         if set_inactive is not None:
-            protocol_id = self._active_select.get1('value').ID
-        
-        update(protocol_id)        
-        self.refresh()
+            protocols.deactivate_protocol(self.source, self._active_select.get1('value').ID)
+        shared_cache.invalidate(self.cache_namespace)
+        self.refresh(force=True)
+
+    def reorder(self, protocol_ids):
+        """
+        Orders the active protocols as in protocol_ids (e.g. after a drag and drop) in one transaction.
+        """
+        protocols.reorder_protocols(self.source, protocol_ids)
+        shared_cache.invalidate(self.cache_namespace)
+        self.refresh(force=True)
         
-    def refresh(self):
-        self._active_select.updatedefault('options', self.active_protocol_options)
-        self._inactive_select.updatedefault('options', self.inactive_protocol_options)
-        self._active_select.reset()
-        self._inactive_select.reset()
+    def refresh(self, force=False):
+        if force or self.is_stale():
+            self.load_protocols(force=True)
+        self._update_select(self._active_select, self.active_protocol_options)
+        if self._manage_built:
+            self._update_select(self._inactive_select, self.inactive_protocol_options)
+
+    def _update_select(self, select, options):
+        """
+        Updates the options of select in place, keeping the selected protocol if it is still an option.
+            The widget is not synced if no option was added, removed, changed or moved.
+
+        :returns: (dict) IDs of protocols added, removed and changed
+        """
+        select.updatedefault('options', options)
+        widget = select.wridget.widget
+        previous = {p.ID: (label, p) for label, p in widget.options}
+        current = {p.ID: (label, p) for label, p in options}
+        diff = {
+            'added': [ID for ID in current if ID not in previous],
+            'removed': [ID for ID in previous if ID not in current],
+            'changed': [ID for ID in current if ID in previous and current[ID] != previous[ID]],
+        }
+        if not any(diff.values()) and list(previous) == list(current):
+            return diff
+
+        selected = widget.value.ID if widget.value is not None else None
+        on_interact_disabled = select.wridget.on_interact_disabled
+        select.wridget.on_interact_disabled = True
+        try:
+            with widget.hold_sync():
+                widget.options = options
+                widget.value = current[selected][1] if selected in current else None
+        finally:
+            select.wridget.on_interact_disabled = on_interact_disabled
+        return diff
 
 
 class DataJointTableApp(wra.App):
     store_config = [
         'source',
         'attrs',
-        'n_rows'
+        'n_rows',
+        'order_by'
     ]
-    def make(self, source, attrs=None, n_rows=25, **kwargs):
+    def make(self, source, attrs=None, n_rows=25, order_by=None, **kwargs):
         self.source = source
         self.attrs = source.heading.names if attrs is None else wrap(attrs)
         self.n_rows = n_rows
+        self.order_by = source.primary_key if order_by is None else wrap(order_by)
 
-    def to_df(self, restrict=None, subtract=None):
+    def query(self, restrict=None, subtract=None):
+        """
+        Returns (source & restrict) - subtract projected to attrs. The primary key is always included.
+        """
         restr = {} if restrict is None else restrict
         subtr = [] if subtract is None else subtract
+        query = (self.source & restr) - subtr
+        return query.proj(*[a for a in self.attrs if a not in query.primary_key])
 
-        df = pd.DataFrame(
-            (
-                (self.source & restr) - subtr
-            ).fetch(limit=self.n_rows)
-        )
-        df = df[[*self.attrs]]
+    def fetch_page(self, restrict=None, subtract=None, page=None, after=None):
+        """
+        Fetches one page of n_rows rows, projected and sorted on the server.
+
+        :param restrict: restriction to apply to source
+        :param subtract: restriction to subtract from source
+        :param page: (int) zero-based page number. Pages are sorted by order_by.
+        :param after: (dict) keyset cursor. If provided, returns the n_rows rows following this primary key, sorted by primary key.
+            Cheaper than page for deep pages. Cannot be combined with page.
+
+        :returns: 
+            df: (pd.DataFrame) page restricted to attrs
+            cursor: (dict) primary key of the last row of the page or None if there are no more rows
+        """
+        assert page is None or after is None, 'provide page or after, not both'
+        query = connections.connection_router.route(self.query(restrict=restrict, subtract=subtract))
+        if after is not None:
+            rows = (query & keyset_restriction(query.primary_key, after)).fetch(order_by=query.primary_key, limit=self.n_rows)
+        else:
+            rows = query.fetch(order_by=self.order_by, limit=self.n_rows, offset=None if page is None else page * self.n_rows)
+        cursor = {k: rows[-1][k] for k in query.primary_key} if len(rows) == self.n_rows else None
+        return pd.DataFrame(rows)[[*self.attrs]], cursor
+
+    def to_df(self, restrict=None, subtract=None, page=None, after=None):
+        df, _ = self.fetch_page(restrict=restrict, subtract=subtract, page=page, after=after)
         return df
 
+    def iter_df(self, restrict=None, subtract=None, chunk_size=None):
+        """
+        Yields the full query as DataFrames of at most chunk_size rows, sorted by primary key. 
+            Memory use is bounded by chunk_size regardless of table size.
+
+        :param chunk_size: (int) rows per DataFrame. Defaults to n_rows.
+        """
+        chunk_size = self.n_rows if chunk_size is None else chunk_size
+        for rows in fetch_chunks(connections.connection_router.route(self.query(restrict=restrict, subtract=subtract)), chunk_size=chunk_size):
+            yield pd.DataFrame(rows, columns=self.attrs)
+
 
 class UserInfoManager(wra.App):
     store_config = [
         'label',
         'get_data_kws',
-        'set_data_kws'
+        'set_data_kws',
+        'session',
     ]
     
-    def make(self, label, get_data=None, set_data=None, get_data_kws=None, set_data_kws=None, **kwargs):
+    def make(self, label, get_data=None, set_data=None, get_data_kws=None, set_data_kws=None, session=None, **kwargs):
+        """
+        :param session: (DashboardSession) if provided, get_data and set_data are also called with the keys of the 
+            session user (user=<user>) if they accept them
+        """
+        self.session = session
         self.label = label
         self.get_data = self.get_data if get_data is None else get_data
         self.set_data = self.set_data if set_data is None else set_data
@@ -432,9 +711,10 @@ class UserInfoManager(wra.App):
         pass
     
     def _get_data(self, **get_data_kws):
-        return self.get_data(**get_data_kws)
+        return self.get_data(**_session_kws(self.get_data, self.session, get_data_kws))
 
     def _set_data(self, **set_data_kws):
+        set_data_kws = _session_kws(self.set_data, self.session, set_data_kws)
         if self.children.ToggleButton.get1('value'):
             self.children.Field.set(disabled=False)
             self.children.ToggleButton.set(description='Set')
@@ -0,0 +1,257 @@
+"""
+Caches for dashboard lookups.
+
+TTLCache is local to a kernel. shared_cache is shared by the kernels of a host if MICRONS_DASHBOARD_SHARED_CACHE
+    is set to the path of a SQLite file, and is an in-process LocalCache otherwise.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime
+from pathlib import Path
+
+# default for `get` that tells a missing key from a cached None, e.g. cache.get(key, default=MISSING) is MISSING
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Thread-safe, in-process cache with a maximum size and a time-to-live per entry.
+        When full, the least recently used entry is evicted.
+
+    Usage:
+    ```python
+    cache = TTLCache(maxsize=1024, ttl=300)
+    value = cache.get_or_set('key', lambda: expensive_lookup('key'))
+    cache.invalidate('key')
+    cache.stats # {'hits': 0, 'misses': 1, 'evictions': 0, 'expirations': 0}
+    ```
+    """
+    def __init__(self, maxsize=1024, ttl=300.):
+        """
+        :param maxsize: (int) maximum number of entries
+        :param ttl: (float) seconds an entry stays valid after it is set
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, default=MISSING, count=False) is not MISSING
+
+    def get(self, key, default=None, count=True):
+        """
+        Returns the cached value for key or default if key is missing or expired.
+
+        :param count: (bool) if True, the lookup is counted in stats
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires = item
+                if expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    if count:
+                        self.stats['hits'] += 1
+                    return value
+                del self._data[key]
+                self.stats['expirations'] += 1
+            if count:
+                self.stats['misses'] += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def get_or_set(self, key, func):
+        """
+        Returns the cached value for key. On a miss, calls func(), caches and returns the result.
+        """
+        value = self.get(key, default=MISSING)
+        if value is MISSING:
+            value = func()
+            self.set(key, value)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+def _encode(obj):
+    if isinstance(obj, datetime):
+        return {'__datetime__': obj.isoformat()}
+    if isinstance(obj, date):
+        return {'__date__': obj.isoformat()}
+    if hasattr(obj, 'item'): # numpy scalars
+        return obj.item()
+    raise TypeError(f'Object of type {type(obj).__name__} cannot be cached.')
+
+
+def _decode(obj):
+    if '__datetime__' in obj:
+        return datetime.fromisoformat(obj['__datetime__'])
+    if '__date__' in obj:
+        return date.fromisoformat(obj['__date__'])
+    return obj
+
+
+class VersionedCache:
+    """
+    Base class of caches whose entries belong to a namespace with a version. 
+        `invalidate(namespace)` increments the version, which invalidates every entry of the namespace.
+    """
+    def version(self, namespace):
+        raise NotImplementedError
+
+    def get(self, namespace, key, default=None):
+        raise NotImplementedError
+
+    def set(self, namespace, key, value, version=None):
+        raise NotImplementedError
+
+    def invalidate(self, namespace):
+        raise NotImplementedError
+
+    def get_or_set(self, namespace, key, func):
+        """
+        Returns the cached value for key. On a miss, calls func(), caches and returns the result.
+            The result is cached under the version read before func() was called, 
+            so it is never served if the namespace is invalidated while func() runs.
+        """
+        value = self.get(namespace, key, default=MISSING)
+        if value is MISSING:
+            version = self.version(namespace)
+            value = func()
+            self.set(namespace, key, value, version=version)
+        return value
+
+
+class LocalCache(VersionedCache):
+    """
+    In-process VersionedCache. Stand-in for SQLiteCache in a single kernel or in tests.
+    """
+    def __init__(self, maxsize=1024, ttl=300.):
+        """
+        :param maxsize: (int) maximum number of entries
+        :param ttl: (float) seconds an entry stays valid after it is set
+        """
+        self.stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+        self._entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def version(self, namespace):
+        return self._versions.get(namespace, 0)
+
+    def get(self, namespace, key, default=None):
+        item = self._entries.get((namespace, key), count=False)
+        if item is None or item[0] != self.version(namespace):
+            self.stats['misses'] += 1
+            return default
+        self.stats['hits'] += 1
+        return item[1]
+
+    def set(self, namespace, key, value, version=None):
+        self._entries.set((namespace, key), (self.version(namespace) if version is None else version, value))
+
+    def invalidate(self, namespace):
+        with self._lock:
+            self._versions[namespace] = self.version(namespace) + 1
+            self.stats['invalidations'] += 1
+
+
+class SQLiteCache(VersionedCache):
+    """
+    VersionedCache stored in a SQLite file, shared by every kernel that opens the same path.
+        Values are stored as JSON (datetimes and dates are preserved), so they must be JSON serializable.
+
+    Usage:
+    ```python
+    cache = SQLiteCache('/tmp/microns_dashboard_cache.sqlite')
+    rows = cache.get_or_set('protocols', 'active', lambda: source.fetch(as_dict=True))
+    cache.invalidate('protocols') # after a write, in any kernel
+    ```
+    """
+    def __init__(self, path, ttl=300., timeout=10.):
+        """
+        :param path: path of the SQLite file. Created if it does not exist.
+        :param ttl: (float) seconds an entry stays valid after it is set
+        :param timeout: (float) seconds to wait for a write lock held by another kernel
+        """
+        self.path = Path(path)
+        self.ttl = ttl
+        self.timeout = timeout
+        self.stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        # sqlite3 connections cannot be shared by threads
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.path), timeout=self.timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS versions (namespace TEXT PRIMARY KEY, version INTEGER NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS entries (namespace TEXT, key TEXT, version INTEGER NOT NULL, expires REAL NOT NULL, value TEXT, PRIMARY KEY (namespace, key))')
+            self._local.connection = conn
+        return conn
+
+    def version(self, namespace):
+        row = self.connection.execute('SELECT version FROM versions WHERE namespace = ?', (namespace,)).fetchone()
+        return 0 if row is None else row[0]
+
+    def get(self, namespace, key, default=None):
+        row = self.connection.execute(
+            'SELECT e.value FROM entries e LEFT JOIN versions v ON v.namespace = e.namespace '
+            'WHERE e.namespace = ? AND e.key = ? AND e.version = COALESCE(v.version, 0) AND e.expires > ?',
+            (namespace, str(key), time.time())
+        ).fetchone()
+        if row is None:
+            self.stats['misses'] += 1
+            return default
+        self.stats['hits'] += 1
+        return json.loads(row[0], object_hook=_decode)
+
+    def set(self, namespace, key, value, version=None):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO entries (namespace, key, version, expires, value) VALUES (?, ?, ?, ?, ?)',
+            (namespace, str(key), self.version(namespace) if version is None else version, time.time() + self.ttl, json.dumps(value, default=_encode))
+        )
+
+    def invalidate(self, namespace):
+        conn = self.connection
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('INSERT INTO versions (namespace, version) VALUES (?, 1) ON CONFLICT(namespace) DO UPDATE SET version = version + 1', (namespace,))
+            conn.execute('DELETE FROM entries WHERE namespace = ?', (namespace,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        self.stats['invalidations'] += 1
+
+    def clear(self):
+        self.connection.execute('DELETE FROM entries')
+
+
+shared_cache = SQLiteCache(os.environ['MICRONS_DASHBOARD_SHARED_CACHE']) if os.environ.get('MICRONS_DASHBOARD_SHARED_CACHE') else LocalCache()
@@ -1,6 +1,8 @@
 """
 Configuration package/module for microns-coregistration.
 """
+import os
+
 import datajoint_plus as djp
 from microns_utils.config_utils import SchemaConfig
 from . import adapters
@@ -13,4 +15,14 @@ dashboard_config = SchemaConfig(
     schema_name='microns_external_dashboard',
     externals=externals.dashboard,
     adapters=adapters.dashboard
-)
\ No newline at end of file
+)
+
+# "json" stores one JSON file per event; "packed" appends event payloads to segment files (see stores.PackedEventStore)
+event_store = os.environ.get('MICRONS_DASHBOARD_EVENT_STORE', 'json')
+
+# seconds to collect user_access notifications into one digest message; 0 posts each message
+slack_digest_window = float(os.environ.get('MICRONS_DASHBOARD_SLACK_DIGEST_WINDOW', 0)) or None
+
+# "inline" runs on_event side effects in the kernel that logs the event; "outbox" records them in the Outbox table 
+# for the worker (see worker.py)
+event_processing = os.environ.get('MICRONS_DASHBOARD_EVENT_PROCESSING', 'inline')
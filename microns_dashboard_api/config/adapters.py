@@ -4,8 +4,13 @@ Adapters for DataJoint tables.
 
 from microns_utils.adapter_utils import JsonAdapter
 
+from ..stores import PackedEventStore, PackedJsonAdapter
+from .externals import dashboard_packed_events_path
+
 events = JsonAdapter('filepath@events')
+packed_events = PackedJsonAdapter('varchar(64)', store=PackedEventStore(dashboard_packed_events_path))
 
 dashboard = {
-    'events': events
-}
\ No newline at end of file
+    'events': events,
+    'packed_events': packed_events
+}
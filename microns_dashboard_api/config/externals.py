@@ -8,6 +8,7 @@ import datajoint_plus as djp
 
 base_path = Path() / '/mnt' / 'dj-stor01' / 'microns' / 'dashboard'
 dashboard_events_path = base_path / 'events'
+dashboard_packed_events_path = base_path / 'packed_events'
 
 
 dashboard = {
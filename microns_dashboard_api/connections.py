@@ -0,0 +1,330 @@
+"""
+Pooled DataJoint connections shared by the apps in a kernel, and routing of read-only queries to read replicas.
+"""
+import copy
+import hashlib
+import os
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import datajoint as dj
+import pymysql
+
+
+def credentials(host=None, user=None, password=None):
+    """
+    Returns (host, user, password), taking missing values from dj.config.
+    """
+    return (
+        dj.config['database.host'] if host is None else host,
+        dj.config['database.user'] if user is None else user,
+        dj.config['database.password'] if password is None else password,
+    )
+
+
+class ConnectionPool:
+    """
+    Kernel-wide pool of DataJoint connections keyed by credentials.
+
+    `connect` sets the global DataJoint connection (dj.conn()) and reuses it while it is alive and the credentials
+        are unchanged. `borrow` lends other apps or threads a connection for exclusive use,
+        keeping up to maxsize idle connections per set of credentials.
+
+    Usage:
+    ```python
+    connection_pool.connect() # credentials from dj.config
+    with connection_pool.borrow() as conn:
+        conn.query('SELECT 1')
+    ```
+    """
+    def __init__(self, maxsize=4):
+        """
+        :param maxsize: (int) maximum number of connections per set of credentials that can be borrowed at once
+        """
+        self.maxsize = maxsize
+        self.stats = {'created': 0, 'reused': 0}
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=self.__class__.__name__)
+        self._idle = {}
+        self._slots = {}
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(host, user, password):
+        return host, user, hashlib.sha256(str(password).encode()).hexdigest()
+
+    def _create(self, host, user, password):
+        conn = dj.Connection(host, user, password, None, dj.config['connection.init_function'], dj.config['database.use_tls'])
+        with self._lock:
+            self.stats['created'] += 1
+            self._keys[id(conn)] = self.key(host, user, password)
+        return conn
+
+    def connect(self, host=None, user=None, password=None):
+        """
+        Sets the global DataJoint connection for the credentials.
+            The current global connection is kept if it is alive and was opened with the same credentials.
+
+        :returns: dj.Connection
+        """
+        host, user, password = credentials(host, user, password)
+        current = getattr(dj.conn, 'connection', None)
+        if current is not None and self._keys.get(id(current)) == self.key(host, user, password) and current.is_connected:
+            with self._lock:
+                self.stats['reused'] += 1
+            return current
+        dj.conn.connection = self._create(host, user, password)
+        return dj.conn.connection
+
+    def connect_async(self, host=None, user=None, password=None):
+        """
+        Runs `connect` on the pool's background thread.
+
+        :returns: concurrent.futures.Future that resolves to the dj.Connection
+        """
+        return self.executor.submit(self.connect, *credentials(host, user, password))
+
+    @contextmanager
+    def borrow(self, host=None, user=None, password=None, timeout=None):
+        """
+        Lends a live connection for exclusive use. Blocks while maxsize connections are borrowed.
+
+        :param timeout: (float) maximum seconds to wait for a connection
+        """
+        host, user, password = credentials(host, user, password)
+        key = self.key(host, user, password)
+        with self._lock:
+            slots = self._slots.setdefault(key, threading.BoundedSemaphore(self.maxsize))
+            idle = self._idle.setdefault(key, [])
+        if not slots.acquire(timeout=-1 if timeout is None else timeout):
+            raise TimeoutError('No connection available.')
+        try:
+            conn = None
+            while conn is None:
+                with self._lock:
+                    conn = idle.pop() if idle else None
+                if conn is None:
+                    conn = self._create(host, user, password)
+                elif conn.is_connected:
+                    with self._lock:
+                        self.stats['reused'] += 1
+                else:
+                    conn = None
+            try:
+                yield conn
+            finally:
+                with self._lock:
+                    idle.append(conn)
+        finally:
+            slots.release()
+
+    def close(self):
+        """
+        Closes idle connections. The global connection is left open.
+        """
+        with self._lock:
+            idle = [conn for conns in self._idle.values() for conn in conns]
+            self._idle.clear()
+        for conn in idle:
+            conn.close()
+
+
+@contextmanager
+def named_lock(name, timeout=0, connection=None):
+    """
+    Holds the MySQL named lock `name` (GET_LOCK) while the block runs. Used to keep one instance of a job running 
+        across hosts. The server releases the lock if the connection is lost.
+
+    :param timeout: (float) seconds to wait for the lock
+    :param connection: dj.Connection. Defaults to dj.conn().
+
+    Yields True if the lock was acquired, False if another session holds it.
+    """
+    conn = dj.conn() if connection is None else connection
+    acquired = conn.query('SELECT GET_LOCK(%s, %s)', args=(name, timeout)).fetchone()[0] == 1
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            conn.query('SELECT RELEASE_LOCK(%s)', args=(name,))
+
+
+class ConnectionRouter:
+    """
+    Routes declared read-only queries to read replicas. Everything else, including undeclared reads, 
+        runs on the primary: the connection the query is bound to (e.g. the schema's connection).
+
+    Reads go to the primary instead of a replica:
+        - for `stickiness` seconds after this kernel wrote to the primary, so a read sees the kernel's own writes
+        - while the primary is in a transaction
+        - if a replica lags more than max_lag seconds behind the primary, cannot be reached or fails a query
+            (it is retried after retry_interval seconds)
+    Without replicas, queries are returned and fetched unchanged.
+
+    Replicas default to the comma-separated hosts ("host" or "host:port") in MICRONS_DASHBOARD_READ_REPLICAS, 
+        with the credentials of dj.config. Two local MySQL instances are enough to try it out; 
+        a server that is not a replica reports no lag.
+
+    Usage:
+    ```python
+    rows = connection_router.fetch(Table & restriction, as_dict=True) # on a replica
+    for rows in fetch_chunks(connection_router.route(Table)): # chunks on a replica
+        ...
+    ```
+    """
+    _read_statements = ('SELECT', 'SHOW', 'DESCRIBE', 'EXPLAIN', 'SET')
+
+    def __init__(self, replicas=None, stickiness=5., max_lag=10., lag_interval=5., retry_interval=30.):
+        """
+        :param replicas: (list) replica hosts ("host" or "host:port")
+        :param stickiness: (float) seconds after a write during which reads go to the primary
+        :param max_lag: (float) replicas lagging more than this many seconds are skipped. If None, lag is not checked.
+        :param lag_interval: (float) seconds between lag checks of a replica
+        :param retry_interval: (float) seconds before a replica that failed is tried again
+        """
+        self.replicas = [] if replicas is None else list(replicas)
+        self.stickiness = stickiness
+        self.max_lag = max_lag
+        self.lag_interval = lag_interval
+        self.retry_interval = retry_interval
+        self.stats = {'primary': 0, 'replica': 0, 'fallbacks': 0}
+        self.last_write = None
+        self._connections = {}
+        self._lag = {}
+        self._down = {}
+        self._tracked = {}
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def track_writes(self, conn):
+        """
+        Calls `mark_write` on every statement other than a read that runs on conn. 
+            Call with the schema connection before writing, so the first reads after a write already go to the primary.
+        """
+        # dj.Connection defines __eq__ without __hash__, so connections are tracked by id
+        with self._lock:
+            ref = self._tracked.get(id(conn))
+            if ref is not None and ref() is conn:
+                return conn
+            self._tracked[id(conn)] = weakref.ref(conn)
+        def tracked_query(sql, *args, **kwargs):
+            if not sql.lstrip()[:8].upper().startswith(self._read_statements):
+                self.mark_write()
+            # calls through the class so that class-level hooks (e.g. tracing) still see the query
+            return type(conn).query(conn, sql, *args, **kwargs)
+        conn.query = tracked_query
+        return conn
+
+    def mark_write(self):
+        """
+        Records a write to the primary. Reads go to the primary for the next `stickiness` seconds.
+        """
+        self.last_write = time.monotonic()
+
+    def _replica_connection(self, host, primary):
+        conn = self._connections.get(host)
+        if conn is None or not conn.is_connected:
+            _, user, password = credentials()
+            conn = connection_pool._create(host, user, password)
+            self._connections[host] = conn
+        # externals (e.g. filepath attributes) are resolved through the schemas of the primary
+        conn.schemas = primary.schemas
+        return conn
+
+    def lag(self, host):
+        """
+        Returns the replication lag of host in seconds (0 if host is not a replica, None if replication is stopped).
+        """
+        checked, lag = self._lag.get(host, (None, None))
+        if checked is None or time.monotonic() - checked > self.lag_interval:
+            conn = self._connections[host]
+            try:
+                status = conn.query('SHOW REPLICA STATUS', as_dict=True).fetchone()
+            except pymysql.err.MySQLError:
+                status = conn.query('SHOW SLAVE STATUS', as_dict=True).fetchone()
+            lag = 0 if status is None else status.get('Seconds_Behind_Source', status.get('Seconds_Behind_Master'))
+            self._lag[host] = (time.monotonic(), lag)
+        return lag
+
+    def _mark_down(self, host):
+        with self._lock:
+            self._down[host] = time.monotonic()
+            self._connections.pop(host, None)
+            self.stats['fallbacks'] += 1
+
+    def read_connection(self, primary=None):
+        """
+        Returns (host, connection) for a read: the next healthy replica, or (None, primary).
+
+        :param primary: dj.Connection the query is bound to. Defaults to dj.conn().
+        """
+        primary = self.track_writes(dj.conn() if primary is None else primary)
+        now = time.monotonic()
+        if not self.replicas or primary.in_transaction or (self.last_write is not None and now - self.last_write < self.stickiness):
+            self.stats['primary'] += 1
+            return None, primary
+        with self._lock:
+            start, self._next = self._next, self._next + 1
+        for i in range(len(self.replicas)):
+            host = self.replicas[(start + i) % len(self.replicas)]
+            down = self._down.get(host)
+            if down is not None and now - down < self.retry_interval:
+                continue
+            try:
+                conn = self._replica_connection(host, primary)
+                if self.max_lag is not None:
+                    lag = self.lag(host)
+                    # a lagging replica may not have this kernel's last write yet, even after stickiness
+                    if lag is None or lag > self.max_lag or (self.last_write is not None and now - self.last_write <= lag):
+                        continue
+            except (pymysql.err.MySQLError, dj.errors.LostConnectionError):
+                self._mark_down(host)
+                continue
+            self.stats['replica'] += 1
+            return host, conn
+        self.stats['primary'] += 1
+        return None, primary
+
+    @staticmethod
+    def _bind(query, conn):
+        query = copy.copy(query)
+        query._connection = conn
+        return query
+
+    def route(self, query):
+        """
+        Returns query bound to the connection chosen by `read_connection`. 
+            Expressions derived from it (restrictions, projections) use the same connection.
+        """
+        query = query() if isinstance(query, type) else query
+        host, conn = self.read_connection(query.connection)
+        return query if host is None else self._bind(query, conn)
+
+    def fetch(self, query, *attrs, **kwargs):
+        """
+        Fetches query (as query.fetch) from a replica, falling back to the primary if the replica fails.
+        """
+        return self._fetch(query, 'fetch', attrs, kwargs)
+
+    def fetch1(self, query, *attrs, **kwargs):
+        """
+        Fetches query (as query.fetch1) from a replica, falling back to the primary if the replica fails.
+        """
+        return self._fetch(query, 'fetch1', attrs, kwargs)
+
+    def _fetch(self, query, method, attrs, kwargs):
+        query = query() if isinstance(query, type) else query
+        host, conn = self.read_connection(query.connection)
+        if host is not None:
+            try:
+                return getattr(self._bind(query, conn), method)(*attrs, **kwargs)
+            except (pymysql.err.OperationalError, dj.errors.LostConnectionError):
+                self._mark_down(host)
+        return getattr(query, method)(*attrs, **kwargs)
+
+
+connection_pool = ConnectionPool()
+connection_router = ConnectionRouter(replicas=[h.strip() for h in os.environ.get('MICRONS_DASHBOARD_READ_REPLICAS', '').split(',') if h.strip()])
@@ -0,0 +1,202 @@
+"""
+Columnar export of the event history for offline analytics.
+
+Each event part table is streamed in primary key order chunks (see utils.fetch_chunks), payloads are decoded in bulk
+    per chunk and the rows are written as date-partitioned Parquet or Arrow IPC files:
+
+    <destination>/<part>/date=<YYYY-MM-DD>/<since>-<chunk>.parquet
+
+Exports are incremental. Only events the previous exports did not write are fetched (see Watermark.pending), so repeated
+    exports append new files and memory is bounded by the chunk size. Files of an export are staged in a hidden directory
+    and moved into place before the watermark is written, so an interrupted export leaves no partial files behind.
+    Files are named after the watermark the export starts from; rerunning an export whose watermark was not written 
+    replaces its files, so no event is written twice. The "data" column holds the decoded payload as a JSON string.
+
+Requires pyarrow. Safe to run from cron on several hosts at once; only the host that holds the export lock does any work.
+
+    python -m microns_dashboard_api.export /path/to/dataset --format parquet
+
+Reading the dataset back:
+```python
+import pyarrow.dataset as ds
+ds.dataset('/path/to/dataset/Event.UserAccess', format='parquet', partitioning='hive').to_table().to_pandas()
+```
+"""
+import argparse
+import json
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import datajoint as dj
+import datajoint_plus as djp
+from microns_utils.datetime_utils import current_timestamp
+
+from .connections import named_lock
+from .schemas import dashboard as db
+from .stores import PackedJsonAdapter
+from .utils import fetch_chunks
+
+logger = djp.getLogger(__name__)
+
+lock_name = 'microns_dashboard_api.export'
+
+formats = {'parquet': '.parquet', 'ipc': '.arrow'}
+
+
+def read_payloads(part, event_ids, max_workers=8):
+    """
+    Returns {event_id: payload} for event_ids of an event part table, reading payloads in bulk:
+        packed payloads are read with one pass over each segment, JSON files are resolved with one query
+        and read concurrently, and other payloads are fetched with one query.
+
+    :param part: event part table, e.g. db.Event.UserAccess
+    :param event_ids: (list) event_ids of part
+    :param max_workers: (int) maximum number of threads used to read JSON files
+    """
+    if not event_ids:
+        return {}
+    attr = part.heading.attributes['data']
+    in_ids = ', '.join(['%s'] * len(event_ids))
+    if isinstance(attr.adapter, PackedJsonAdapter):
+        rows = part.connection.query(
+            f'SELECT `event_id`, `data` FROM {part.full_table_name} WHERE `data` IS NOT NULL AND `event_id` IN ({in_ids})',
+            args=tuple(event_ids)
+        ).fetchall()
+        return dict(zip([r[0] for r in rows], attr.adapter.store.read_many([r[1] for r in rows])))
+
+    if attr.is_filepath:
+        external = db.schema.external[attr.store]
+        rows = part.connection.query(
+            f'SELECT p.`event_id`, x.`filepath` FROM {part.full_table_name} p JOIN {external.full_table_name} x ON p.`data` = x.`hash` '
+            f'WHERE p.`event_id` IN ({in_ids})',
+            args=tuple(event_ids)
+        ).fetchall()
+        location = Path(external.spec['location'])
+        def load(filepath):
+            with open(location / filepath, 'r') as f:
+                return json.load(f)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return dict(zip([r[0] for r in rows], executor.map(load, [r[1] for r in rows])))
+
+    return dict(zip(*(part & [{'event_id': i} for i in event_ids]).fetch('event_id', 'data')))
+
+
+def write_table(rows, path, format='parquet'):
+    """
+    Writes rows (list of dicts with the same keys) to path as a Parquet or Arrow IPC file.
+    """
+    import pyarrow as pa
+
+    table = pa.Table.from_pylist(rows)
+    # columns that are all NULL in this file (e.g. data, info_type) are typed as strings so that files share a schema
+    table = table.cast(pa.schema([pa.field(f.name, pa.string()) if pa.types.is_null(f.type) else f for f in table.schema]))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if format == 'parquet':
+        import pyarrow.parquet as pq
+
+        pq.write_table(table, str(path))
+    else:
+        with pa.OSFile(str(path), 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+
+def export_part(part, destination, format='parquet', chunk_size=10000, settle=5, lookback=60, name='export'):
+    """
+    Exports the events of part logged since its last export.
+
+    :param part: event part table, e.g. db.Event.UserAccess
+    :param destination: directory of the dataset. Files are written under <destination>/<part.class_name>.
+    :param format: (str) "parquet" or "ipc"
+    :param chunk_size: (int) maximum number of events fetched, decoded and held in memory at once
+    :param settle: (int) events from the last settle seconds are left for the next export
+    :param lookback: (int) events committed up to lookback seconds after their timestamp are still exported, once
+        (see Watermark.pending)
+    :param name: (str) prefix of the Watermark name. Use a different name per destination.
+
+    :returns: (dict) number of events and files written and the new watermark
+    """
+    assert format in formats, f'format must be one of {list(formats)}'
+    until = (current_timestamp('US/Central') - timedelta(seconds=settle)).replace(microsecond=0).strftime(db.Watermark.mark_format)
+    watermark = f'{name}.{part.class_name}'
+    since = db.Watermark.read(watermark)
+    if since is not None and since >= until:
+        return {'n_events': 0, 'n_files': 0, 'mark': since}
+
+    directory = Path(destination) / part.class_name
+    # files are named after the mark they start from, so an export that is rerun before its watermark was written
+    # replaces the files of the interrupted run instead of duplicating them
+    window_id = 'start' if since is None else since.replace('-', '').replace(':', '').replace(' ', 'T')
+    staging = directory / f'.staging-{window_id}'
+    for stale in directory.glob('.staging-*'):
+        shutil.rmtree(stale)
+
+    attrs = [a for a in part.heading.secondary_attributes if a != 'data']
+    floor = datetime.strptime(db.Watermark.shift(until, -lookback), db.Watermark.mark_format)
+    n_events, files, recent = 0, [], []
+    query = db.Watermark.pending(watermark, part, since, until, lookback=lookback)
+    for i, rows in enumerate(fetch_chunks(query, attrs=attrs, chunk_size=chunk_size)):
+        payloads = read_payloads(part, [r['event_id'] for r in rows])
+        partitions = {}
+        for row in rows:
+            payload = payloads.get(row['event_id'])
+            row['data'] = None if payload is None else json.dumps(payload, default=str)
+            partitions.setdefault(row['timestamp'].date(), []).append(row)
+            if row['timestamp'] >= floor:
+                recent.append({'event_id': row['event_id'], 'timestamp': row['timestamp']})
+        for date, partition in partitions.items():
+            path = Path(f'date={date.isoformat()}') / f'{window_id}-{i:05d}{formats[format]}'
+            write_table(partition, staging / path, format=format)
+            files.append(path)
+        n_events += len(rows)
+
+    for stale in directory.glob(f'date=*/{window_id}-*'):
+        stale.unlink()
+    for path in files:
+        (directory / path).parent.mkdir(parents=True, exist_ok=True)
+        os.replace(staging / path, directory / path)
+    if staging.exists():
+        shutil.rmtree(staging)
+    with db.Watermark.connection.transaction:
+        db.Watermark.advance(watermark, until, recent, lookback=lookback)
+    logger.info('%d %s events exported to %d files.', n_events, part.class_name, len(files))
+    return {'n_events': n_events, 'n_files': len(files), 'mark': until}
+
+
+def export(destination, parts=None, format='parquet', chunk_size=10000, settle=5, lookback=60, name='export', lock_timeout=0):
+    """
+    Exports the events of each part logged since its last export. See `export_part`.
+
+    :param parts: (list) event part tables. Defaults to Event.UserAccess, Event.UserCheckIn and Event.UserAdd.
+    :param lock_timeout: (float) seconds to wait for the export lock held by another host
+
+    :returns: (dict) "locked" (True if another host holds the lock) and the result of `export_part` by part
+    """
+    parts = [db.Event.UserAccess, db.Event.UserCheckIn, db.Event.UserAdd] if parts is None else parts
+    with named_lock(f'{lock_name}.{name}', timeout=lock_timeout) as acquired:
+        if not acquired:
+            logger.info('Export lock is held by another session. Skipping.')
+            return {'locked': True, 'parts': {}}
+        return {
+            'locked': False,
+            'parts': {part.class_name: export_part(part, destination, format=format, chunk_size=chunk_size, settle=settle, lookback=lookback, name=name) for part in parts}
+        }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export events logged since the last export to a date-partitioned dataset.')
+    parser.add_argument('destination', help='directory of the dataset')
+    parser.add_argument('--format', choices=list(formats), default='parquet')
+    parser.add_argument('--chunk-size', type=int, default=10000, help='maximum number of events held in memory at once')
+    parser.add_argument('--name', default='export', help='watermark name; use a different name per destination')
+    parser.add_argument('--lock-timeout', type=float, default=0., help='seconds to wait for an export running on another host')
+    args = parser.parse_args()
+    result = export(args.destination, format=args.format, chunk_size=args.chunk_size, name=args.name, lock_timeout=args.lock_timeout)
+    if result['locked']:
+        print('Another export is running.')
+    else:
+        for part_name, r in result['parts'].items():
+            print(f"{part_name}: {r['n_events']} events in {r['n_files']} files, up to {r['mark']}")
@@ -0,0 +1,193 @@
+"""
+Headless dashboard sessions for load testing.
+
+The apps are built and driven as in a notebook but without a front end: setting widget values and clicking buttons
+    runs the same callbacks, and messages to the front end are discarded.
+
+Usage:
+```python
+from microns_dashboard_api.headless import run_sessions
+
+report = run_sessions(n_sessions=50, workers=8, session_kws={'username': 'user', 'password': '***', 'protocol_source': Protocol})
+report['latency'] # n and p50/p95/p99 ms per construction and interaction
+report['memory_per_session_kb']
+```
+"""
+import io
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext, redirect_stdout
+
+from .apps import UserApp, DataJointLoginApp, ProtocolManager, UserInfoManager
+from .session import DashboardSession
+from .tracing import Span, Tracer
+
+
+class HeadlessSession:
+    """
+    The apps of one dashboard session: UserApp, DataJointLoginApp, ProtocolManager and UserInfoManager, 
+        sharing a DashboardSession. The latency of building each app and of each interaction is recorded in `spans`.
+    """
+    interactions = ['login', 'set_protocol', 'set_data']
+
+    def __init__(self, user_info=None, username=None, password=None, protocol_source=None, on_set_protocol=None, get_data=None, set_data=None, info_label='Info', on_user_update=None):
+        """
+        :param user_info: (dict) hub user info for UserApp. Defaults to {'user': 'headless_user'}.
+        :param username: (str) database username entered in DataJointLoginApp. If None, login is skipped.
+        :param password: (str) database password entered in DataJointLoginApp
+        :param protocol_source: DataJoint table of protocols. If None, no ProtocolManager is built.
+        :param on_set_protocol: function that ProtocolManager calls when a protocol is set, with user=<user> if it accepts it
+        :param get_data: function that UserInfoManager calls, with user=<user> if it accepts it, e.g. to fetch the Slack username
+        :param set_data: function that UserInfoManager calls with the entered value, and user=<user> if it accepts it
+        :param info_label: (str) label of the UserInfoManager
+        :param on_user_update: function that UserApp calls when the user is set, e.g. to log a user_access event
+        """
+        self.user_info = {'user': 'headless_user'} if user_info is None else user_info
+        self.username = username
+        self.password = password
+        self.spans = []
+        self.session = DashboardSession(user_info=self.user_info)
+
+        with self._span('construct.UserApp'):
+            self.user_app = UserApp(session=self.session, on_user_update=self.on_user_update if on_user_update is None else on_user_update)
+        with self._span('construct.DataJointLoginApp'):
+            self.login_app = DataJointLoginApp(asynchronous=False)
+        self.protocol_manager = None
+        if protocol_source is not None:
+            with self._span('construct.ProtocolManager'):
+                self.protocol_manager = ProtocolManager(source=protocol_source, on_set_protocol=on_set_protocol, session=self.session)
+        with self._span('construct.UserInfoManager'):
+            self.info_manager = UserInfoManager(label=info_label, get_data=get_data, set_data=set_data, session=self.session)
+
+    def on_user_update(self, **kwargs):
+        pass
+
+    @contextmanager
+    def _span(self, stage):
+        span = Span(stage)
+        start = time.perf_counter()
+        try:
+            yield span
+        except Exception as e:
+            span.error = repr(e)
+            raise
+        finally:
+            span.duration_s = time.perf_counter() - start
+            self.spans.append(span.to_dict())
+
+    def login(self):
+        """
+        Enters the credentials and clicks Login.
+        """
+        if self.username is None:
+            return
+        with self._span('login'):
+            self.login_app._username_field.set(value=self.username)
+            self.login_app._password_field.set(value='' if self.password is None else self.password)
+            self.login_app._login_button.wridget.widget.click()
+
+    def set_protocol(self):
+        """
+        Sets, then unsets, the selected active protocol.
+        """
+        if self.protocol_manager is None:
+            return
+        button = self.protocol_manager._set_protocol_button
+        with self._span('set_protocol'):
+            button.set(value=True)
+        with self._span('unset_protocol'):
+            button.set(value=False)
+
+    def set_data(self, value='headless'):
+        """
+        Clicks Update, enters value and clicks Set in the UserInfoManager.
+        """
+        button = self.info_manager.children.ToggleButton
+        with self._span('set_data'):
+            button.set(value=True)
+            self.info_manager.children.Field.set(value=value)
+            button.set(value=False)
+
+    def run(self, interactions=None, iterations=1):
+        """
+        Runs interactions in order, iterations times.
+        """
+        for _ in range(iterations):
+            for interaction in self.interactions if interactions is None else interactions:
+                getattr(self, interaction)()
+        return self.spans
+
+
+def _init_process():
+    # forked workers must not share the parent's database socket
+    dj = sys.modules.get('datajoint')
+    if dj is not None and getattr(dj.conn, 'connection', None) is not None:
+        dj.conn.connection.connect()
+
+
+def _run_session(session_kws, interactions, iterations):
+    """
+    Builds and runs one session in a worker process. Returns its spans and the Python memory allocated to build it.
+    """
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        session = HeadlessSession(**session_kws)
+        memory = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    return session.run(interactions=interactions, iterations=iterations), memory
+
+
+def run_sessions(n_sessions=10, workers=4, mode='process', session_kws=None, interactions=None, iterations=1, quiet=True):
+    """
+    Runs n_sessions headless sessions concurrently and reports latency and memory.
+
+    :param n_sessions: (int) number of sessions
+    :param workers: (int) number of sessions that run at once
+    :param mode: (str) "process" runs each session in its own forked process with its own database connection,
+        like one notebook kernel per user. "thread" runs sessions on threads of this process; they share the global
+        database connection, so only use it for interactions that do not query the database.
+    :param session_kws: (dict) keyword arguments for HeadlessSession
+    :param interactions: (list) HeadlessSession interactions to run. Defaults to all.
+    :param iterations: (int) number of times each session runs the interactions
+    :param quiet: (bool) if True, what the apps print (messages, errors) is discarded
+
+    :returns: (dict)
+        latency: (list) n and p50/p95/p99 ms per construction and interaction stage
+        memory_per_session_kb: (float) mean Python memory allocated to build a session
+        wall_s: (float) elapsed time
+    """
+    assert mode in ['process', 'thread'], 'mode must be "process" or "thread"'
+    session_kws = {} if session_kws is None else session_kws
+    start = time.perf_counter()
+    # without a front end, app output goes to stdout
+    with redirect_stdout(io.StringIO()) if quiet else nullcontext():
+        if mode == 'process':
+            import multiprocessing
+
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'), initializer=_init_process) as executor:
+                results = list(executor.map(_run_session, *zip(*[(session_kws, interactions, iterations)] * n_sessions)))
+            spans = [span for session_spans, _ in results for span in session_spans]
+            memory = sum([m for _, m in results]) / max(n_sessions, 1)
+        else:
+            tracemalloc.start()
+            try:
+                before = tracemalloc.get_traced_memory()[0]
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    sessions = list(executor.map(lambda _: HeadlessSession(**session_kws), range(n_sessions)))
+                memory = (tracemalloc.get_traced_memory()[0] - before) / max(n_sessions, 1)
+            finally:
+                tracemalloc.stop()
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                spans = sum(executor.map(lambda s: s.run(interactions=interactions, iterations=iterations), sessions), [])
+    return {
+        'n_sessions': n_sessions,
+        'workers': workers,
+        'mode': mode,
+        'wall_s': time.perf_counter() - start,
+        'latency': Tracer.summary(spans, by=('stage',))[['stage', 'n', 'p50_ms', 'p95_ms', 'p99_ms']].to_dict('records'),
+        'memory_per_session_kb': memory / 1024,
+    }
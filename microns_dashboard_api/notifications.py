@@ -0,0 +1,403 @@
+"""
+Background Slack notifications for dashboard events.
+"""
+import atexit
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+import datajoint_plus as djp
+
+logger = djp.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. Allows `rate` acquisitions per second on average and bursts of up to `burst`.
+    """
+    def __init__(self, rate, burst=1):
+        """
+        :param rate: (float) tokens added per second. Must be positive.
+        :param burst: (int) maximum number of tokens
+        """
+        assert rate > 0, 'rate must be positive'
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def delay(self):
+        """
+        Seconds until a token is available. 0 if one is available now.
+        """
+        with self._lock:
+            self._refill()
+            return 0. if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+    def acquire(self, block=True):
+        """
+        Takes one token.
+
+        :param block: (bool) if True, waits for a token; if False, returns immediately
+
+        :returns: (bool) True if a token was taken
+        """
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if not block:
+                return False
+            time.sleep(wait)
+
+
+class SlackDispatcher:
+    """
+    Posts Slack messages from a background worker so that callers (e.g. Event.*.on_event) do not block on Slack.
+
+    Messages are queued with `post_to_slack` and sent by a single daemon thread. Messages queued for the same
+        channel while the worker is busy are coalesced into one post. Posts that are rate limited by Slack are retried 
+        after the Retry-After delay and posts that fail with a server or connection error are retried with exponential 
+        backoff. Posts that fail with other errors (e.g. an unknown channel) are dropped. A post waiting for a retry
+        is held with later messages for its channel; the worker keeps sending to other channels meanwhile.
+        Posts can be rate limited per channel and in total with token buckets. Messages for a rate limited channel 
+        wait in the worker and are coalesced with later messages for that channel.
+
+    In digest mode, messages posted with a digest (topic, item) to a digest channel are held for digest_window seconds 
+        and summarized per topic, e.g. "5 users accessed the dashboard: a, b, c, d, e". Direct messages are never digested.
+
+    Usage:
+    ```python
+    slack_notifier = SlackDispatcher(SlackForWidget(default_channel='#microns-dashboard'), rate=1, burst=5, digest_window=60)
+    slack_notifier.post_to_slack('```user accessed the dashboard```', digest=('users accessed the dashboard', 'user'))
+    slack_notifier.flush(timeout=10)
+    slack_notifier.stats # {'queued': 1, 'sent': 1, 'coalesced': 0, 'digested': 0, 'dropped': 0, 'failed': 0, 'retried': 0}
+    ```
+    """
+    def __init__(self, client, maxsize=1000, max_batch=50, max_retries=3, backoff=1., max_backoff=30., drain_on_exit=True, drain_timeout=10., 
+                 rate=None, burst=1, total_rate=None, block=False, digest_window=None, digest_channels=None, 
+                 digest_format='```{n} {topic}: {items}```', digest_max_items=20):
+        """
+        :param client: object with a `post_to_slack(text, channel=None)` method and a `default_channel` attribute (e.g. SlackForWidget).
+            If the client is a slack WebClient, posts are sent with its `chat_postMessage` so that errors can be retried or dropped.
+            Otherwise, a post for which `post_to_slack` returns a false value is dropped.
+        :param maxsize: (int) maximum number of queued messages. Messages posted to a full queue are dropped.
+        :param max_batch: (int) maximum number of messages to coalesce into one post
+        :param max_retries: (int) number of retries after a post that failed with a transient error
+        :param backoff: (float) seconds to wait before the first retry. Doubles on every retry.
+        :param max_backoff: (float) maximum seconds to wait between retries
+        :param drain_on_exit: (bool) if True, flushes the queue when the interpreter exits. Registered when the first
+            message is queued and unregistered by `shutdown`.
+        :param drain_timeout: (float) maximum seconds to wait for the queue to drain on exit
+        :param rate: (float) maximum posts per second to each channel. Must be positive. If None, channels are not rate limited.
+        :param burst: (int) number of posts that can be sent at once before a rate limit applies
+        :param total_rate: (float) maximum posts per second to all channels. Must be positive. If None, there is no total limit.
+        :param block: (bool) if True, `post_to_slack` waits for room in a full queue instead of dropping the message. 
+            Intended for batch jobs, not for interactive callers.
+        :param digest_window: (float) seconds to hold messages for digest channels. If None, digest mode is off.
+        :param digest_channels: (list) channels that are digested. Defaults to client.default_channel.
+        :param digest_format: (str) format of a digest line with fields n (number of items), topic and items
+        :param digest_max_items: (int) maximum number of items listed in a digest line
+        """
+        assert rate is None or rate > 0, 'rate must be positive or None'
+        self.client = client
+        self.max_batch = max_batch
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.rate = rate
+        self.burst = burst
+        self.total_bucket = None if total_rate is None else TokenBucket(total_rate, burst=burst)
+        self.block = block
+        self.digest_window = digest_window
+        self.digest_channels = [self.default_channel] if digest_channels is None else list(digest_channels)
+        self.digest_format = digest_format
+        self.digest_max_items = digest_max_items
+        self.stats = {'queued': 0, 'sent': 0, 'coalesced': 0, 'digested': 0, 'dropped': 0, 'failed': 0, 'retried': 0}
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._worker = None
+        self._is_shutdown = False
+        self._flushing = 0
+        self._buckets = {}
+        self._pending = OrderedDict()
+        self._retries = {}
+        self.drain_on_exit = drain_on_exit
+        self.drain_timeout = drain_timeout
+        self._exit_registered = False
+
+    @property
+    def default_channel(self):
+        return getattr(self.client, 'default_channel', None)
+
+    @property
+    def pending(self):
+        """
+        Number of messages queued, held or in flight.
+        """
+        return self._queue.unfinished_tasks
+
+    def post_to_slack(self, text, channel=None, digest=None):
+        """
+        Queues a message for the worker.
+
+        :param text: (str) message, posted as is unless it is summarized in a digest
+        :param channel: (str) Slack channel or "@username". Defaults to client.default_channel.
+        :param digest: (tuple) optional (topic, item). In digest mode, items of the same topic are summarized in one line.
+
+        :returns: (bool) True if the message was queued, False if it was dropped
+        """
+        if self._is_shutdown:
+            logger.warning('SlackDispatcher is shut down. Message dropped: %s', text)
+            self._increment('dropped')
+            return False
+        channel = self.default_channel if channel is None else channel
+        try:
+            self._queue.put((channel, text, digest), block=self.block)
+        except queue.Full:
+            logger.warning('Slack notification queue is full. Message dropped: %s', text)
+            self._increment('dropped')
+            return False
+        self._increment('queued')
+        self._start()
+        return True
+
+    def send_direct_message(self, text, slack_username):
+        """
+        Queues a direct message to slack_username. Users without a Slack username (None) are skipped.
+
+        :returns: (bool) True if the message was queued
+        """
+        if slack_username is None:
+            return False
+        return self.post_to_slack(text, channel=f'@{slack_username}')
+
+    def flush(self, timeout=None):
+        """
+        Blocks until every queued message has been sent (or has failed). Digests are sent without waiting for digest_window.
+
+        :param timeout: (float) maximum seconds to wait. If None, waits indefinitely.
+
+        :returns: (bool) True if the queue drained, False on timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            self._flushing += 1
+        try:
+            self._wake()
+            with self._queue.all_tasks_done:
+                while self._queue.unfinished_tasks:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        logger.warning('Timed out flushing Slack notifications. %d message(s) pending.', self._queue.unfinished_tasks)
+                        return False
+                    self._queue.all_tasks_done.wait(remaining)
+            return True
+        finally:
+            with self._lock:
+                self._flushing -= 1
+
+    def shutdown(self, timeout=None):
+        """
+        Stops accepting messages, drains the queue and stops the worker.
+
+        :param timeout: (float) maximum seconds to wait for the queue to drain
+
+        :returns: (bool) True if the queue drained, False on timeout
+        """
+        self._is_shutdown = True
+        with self._lock:
+            if self._exit_registered:
+                atexit.unregister(self._drain)
+                self._exit_registered = False
+        return self.flush(timeout=timeout)
+
+    def _drain(self):
+        self.flush(timeout=self.drain_timeout)
+
+    def _increment(self, name, n=1):
+        with self._lock:
+            self.stats[name] += n
+
+    def _start(self):
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name=self.__class__.__name__, daemon=True)
+                self._worker.start()
+            if self.drain_on_exit and not self._exit_registered:
+                atexit.register(self._drain)
+                self._exit_registered = True
+
+    def _wake(self):
+        # the worker may be waiting for held messages to become due
+        if self._worker is not None and self._worker.is_alive():
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                pass
+
+    def _is_digested(self, channel):
+        return self.digest_window is not None and channel in self.digest_channels and not str(channel).startswith('@')
+
+    def _bucket(self, channel):
+        if self.rate is None:
+            return None
+        if channel not in self._buckets:
+            self._buckets[channel] = TokenBucket(self.rate, burst=self.burst)
+        return self._buckets[channel]
+
+    def _delay(self, channel, now):
+        """
+        Seconds until the post waiting for a retry or the messages held for channel can be sent.
+        """
+        delays = [0.]
+        if channel in self._retries:
+            delays.append(self._retries[channel]['at'] - now)
+        elif self._is_digested(channel) and not self._flushing:
+            delays.append(self._pending[channel]['since'] + self.digest_window - now)
+        for bucket in [self._bucket(channel), self.total_bucket]:
+            if bucket is not None:
+                delays.append(bucket.delay())
+        return max(delays)
+
+    def _run(self):
+        while True:
+            now = time.monotonic()
+            timeout = min([self._delay(channel, now) for channel in self._channels()], default=None)
+            try:
+                batch = [self._queue.get(timeout=timeout)]
+            except queue.Empty:
+                batch = []
+            while batch and len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            now = time.monotonic()
+            for message in batch:
+                if message is None:
+                    self._queue.task_done()
+                    continue
+                channel, text, digest = message
+                self._pending.setdefault(channel, {'since': now, 'messages': []})['messages'].append((text, digest))
+            for channel in self._channels():
+                if self._delay(channel, time.monotonic()) > 0:
+                    continue
+                retry = self._retries.pop(channel, None)
+                if retry is not None:
+                    # messages held for the channel are sent after the retry, on the next pass
+                    post = retry
+                else:
+                    held = self._pending[channel]['messages']
+                    messages, rest = held[:self.max_batch], held[self.max_batch:]
+                    if rest:
+                        self._pending[channel]['messages'] = rest
+                    else:
+                        del self._pending[channel]
+                    post = {'messages': messages, 'n_messages': len(messages), 'attempt': 0, 'delay': self.backoff}
+                try:
+                    if 'text' not in post:
+                        post['text'] = self._format(channel, post.pop('messages'))
+                    wait = self._send(channel, post['text'], n_messages=post['n_messages'], attempt=post['attempt'], delay=post['delay'])
+                except Exception:
+                    logger.exception('Slack notification worker failed.')
+                    wait = None
+                if wait is None:
+                    self._done(post)
+                else:
+                    self._retries[channel] = dict(post, at=time.monotonic() + wait, attempt=post['attempt'] + 1, delay=min(2 * post['delay'], self.max_backoff))
+
+    def _channels(self):
+        return list(self._retries) + [channel for channel in self._pending if channel not in self._retries]
+
+    def _done(self, post):
+        for _ in range(post['n_messages']):
+            self._queue.task_done()
+
+    def _format(self, channel, messages):
+        if not self._is_digested(channel):
+            return '\n'.join([text for text, _ in messages])
+        lines, topics = [], OrderedDict()
+        for text, digest in messages:
+            if digest is None:
+                lines.append(text)
+            else:
+                topics.setdefault(digest[0], []).append((text, digest[1]))
+        for topic, entries in topics.items():
+            if len(entries) == 1:
+                lines.append(entries[0][0])
+                continue
+            items = [str(item) for _, item in entries]
+            shown = ', '.join(items[:self.digest_max_items]) + ('…' if len(items) > self.digest_max_items else '')
+            lines.append(self.digest_format.format(n=len(items), topic=topic, items=shown))
+            self._increment('digested', len(entries))
+        return '\n'.join(lines)
+
+    def _post(self, channel, text):
+        post = getattr(self.client, 'chat_postMessage', None)
+        if post is None:
+            return bool(self.client.post_to_slack(text, channel=channel))
+        # a slack WebClient raises SlackApiError with the response, which tells transient from permanent errors
+        post(channel=channel, text=text)
+        return True
+
+    def _retry_delay(self, error, delay):
+        """
+        Seconds to wait before retrying a post that raised error, or None if the error is permanent.
+            Rate limited posts wait for the Retry-After header, server errors (5xx) and errors without a response
+            (e.g. a lost connection) wait delay seconds. Other errors (e.g. channel_not_found) are not retried.
+        """
+        response = getattr(error, 'response', None)
+        if response is None:
+            return delay
+        status = getattr(response, 'status_code', None)
+        code = response.get('error') if hasattr(response, 'get') else None
+        if status == 429 or code == 'ratelimited':
+            headers = getattr(response, 'headers', None) or {}
+            retry_after = headers.get('Retry-After', headers.get('retry-after'))
+            return delay if retry_after is None else float(retry_after)
+        if status is not None and status >= 500:
+            return delay
+        return None
+
+    def _send(self, channel, text, n_messages=1, attempt=0, delay=None):
+        """
+        Posts text to channel once.
+
+        :param attempt: (int) number of earlier attempts of this post
+        :param delay: (float) seconds to wait before retrying a post that failed with a transient error. Defaults to backoff.
+
+        :returns: (float) seconds to wait before retrying the post, or None if it was sent, dropped or failed for good
+        """
+        delay = self.backoff if delay is None else delay
+        for bucket in [self._bucket(channel), self.total_bucket]:
+            if bucket is not None:
+                bucket.acquire()
+        try:
+            if self._post(channel, text):
+                self._increment('sent')
+                self._increment('coalesced', n_messages - 1)
+                return None
+            logger.error('Slack client did not post to channel %s. Message dropped: %s', channel, text)
+        except Exception as e:
+            wait = self._retry_delay(e, delay)
+            if wait is None:
+                logger.error('Error posting to Slack channel %s: %r. Message dropped: %s', channel, e, text)
+            elif attempt >= self.max_retries:
+                logger.error('Failed to post to Slack channel %s after %d attempt(s): %s', channel, attempt + 1, text)
+            else:
+                logger.warning('Error posting to Slack channel %s: %r. Retrying in %.1f seconds.', channel, e, wait)
+                self._increment('retried')
+                return wait
+        self._increment('failed', n_messages)
+        return None
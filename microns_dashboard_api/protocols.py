@@ -0,0 +1,124 @@
+"""
+Ordering of protocols in a protocol source table.
+
+Each function runs in one transaction on the source's connection, while holding a named lock (GET_LOCK) on the source.
+    Concurrent calls from several kernels are serialized, so they cannot assign the same ordering or deadlock
+    on the row locks of the active protocols.
+
+The source must have the attributes protocol_id, active and ordering (nullable).
+    If it has last_updated, it is set on every row that changes so that ProtocolManager.is_stale detects the change.
+"""
+import hashlib
+from contextlib import contextmanager
+
+from .connections import named_lock
+
+lock_timeout = 10
+
+
+@contextmanager
+def _locked(source):
+    """
+    Runs the block in a transaction on the source's connection, holding the named lock of the source.
+    """
+    # lock names are limited to 64 characters
+    name = 'microns_dashboard_api.protocols.' + hashlib.sha1(source.full_table_name.encode()).hexdigest()[:16]
+    with named_lock(name, timeout=lock_timeout, connection=source.connection) as acquired:
+        if not acquired:
+            raise TimeoutError(f'Could not lock {source.full_table_name} within {lock_timeout} seconds.')
+        with source.connection.transaction:
+            yield
+
+
+def _set_clause(source, assignments):
+    if 'last_updated' in source.heading.names:
+        assignments = assignments + ['`last_updated` = CURRENT_TIMESTAMP']
+    return ', '.join(assignments)
+
+
+def _fetch_active(source):
+    """
+    Returns the protocol_ids of active protocols by ordering and locks their rows until the transaction ends.
+    """
+    return [row[0] for row in source.connection.query(
+        f'SELECT `protocol_id` FROM {source.full_table_name} WHERE `active` = 1 '
+        'ORDER BY `ordering` IS NULL, `ordering` FOR UPDATE'
+    ).fetchall()]
+
+
+def _fetch_protocol(source, protocol_id):
+    rows = source.connection.query(
+        f'SELECT `active`, `ordering` FROM {source.full_table_name} WHERE `protocol_id` = %s FOR UPDATE',
+        args=(protocol_id,)
+    ).fetchall()
+    if not rows:
+        raise KeyError(f'protocol_id {protocol_id} not found in {source.full_table_name}.')
+    return rows[0]
+
+
+def activate_protocol(source, protocol_id):
+    """
+    Sets a protocol active and gives it the next ordering after the active protocols.
+        A protocol that is already active keeps its ordering.
+
+    :param source: DataJoint table of protocols
+    :param protocol_id: (str) protocol to activate
+
+    :returns: (int) ordering of the protocol
+    """
+    with _locked(source):
+        active, ordering = _fetch_protocol(source, protocol_id)
+        if active == 1 and ordering is not None:
+            return ordering
+        (ordering,), = source.connection.query(
+            f'SELECT COALESCE(MAX(`ordering`), -1) + 1 FROM {source.full_table_name} WHERE `active` = 1 FOR UPDATE'
+        ).fetchall()
+        source.connection.query(
+            f'UPDATE {source.full_table_name} SET {_set_clause(source, ["`active` = 1", "`ordering` = %s"])} '
+            'WHERE `protocol_id` = %s',
+            args=(ordering, protocol_id)
+        )
+    return int(ordering)
+
+
+def deactivate_protocol(source, protocol_id):
+    """
+    Sets a protocol inactive and clears its ordering.
+
+    :param source: DataJoint table of protocols
+    :param protocol_id: (str) protocol to deactivate
+    """
+    with _locked(source):
+        _fetch_protocol(source, protocol_id)
+        source.connection.query(
+            f'UPDATE {source.full_table_name} SET {_set_clause(source, ["`active` = 0", "`ordering` = NULL"])} '
+            'WHERE `protocol_id` = %s',
+            args=(protocol_id,)
+        )
+
+
+def reorder_protocols(source, protocol_ids):
+    """
+    Orders active protocols as in protocol_ids with a single UPDATE.
+        Active protocols not in protocol_ids keep their relative order and follow the ones given.
+
+    :param source: DataJoint table of protocols
+    :param protocol_ids: (list) active protocol_ids in the desired order
+
+    :returns: (list) protocol_ids of all active protocols, in their new order
+    """
+    protocol_ids = list(dict.fromkeys(protocol_ids))
+    with _locked(source):
+        active = _fetch_active(source)
+        inactive = set(protocol_ids) - set(active)
+        if inactive:
+            raise ValueError(f'Protocols {sorted(inactive)} are not active.')
+        order = protocol_ids + [p for p in active if p not in set(protocol_ids)]
+        if order:
+            cases = ' '.join(['WHEN %s THEN %s'] * len(order))
+            source.connection.query(
+                f'UPDATE {source.full_table_name} SET {_set_clause(source, [f"`ordering` = CASE `protocol_id` {cases} END"])} '
+                f'WHERE `protocol_id` IN ({", ".join(["%s"] * len(order))})',
+                args=tuple(v for i, p in enumerate(order) for v in (p, i)) + tuple(order)
+            )
+    return order
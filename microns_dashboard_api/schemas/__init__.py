@@ -0,0 +1,12 @@
+"""
+DataJoint schemas for the dashboard. 
+
+Schema modules are imported lazily: they are executed, and connect to the database, on first attribute access.
+"""
+from ..utils import lazy_import
+
+
+def __getattr__(name):
+    if name == 'dashboard':
+        return lazy_import(f'{__name__}.{name}')
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -1,10 +1,17 @@
 """
 DataJoint tables for Dashboard Users.
 """
+import hashlib
 import json
+import multiprocessing
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from datetime import datetime, timedelta
 from pathlib import Path
 import traceback
+from collections import namedtuple
 
 import datajoint as dj
 import datajoint_plus as djp
@@ -15,19 +22,28 @@ from microns_utils.misc_utils import classproperty, wrap, unwrap
 from microns_utils.widget_utils import SlackForWidget
 
 from ..config import dashboard_config as config
+from ..config import event_store, slack_digest_window, event_processing
+from ..cache import MISSING, TTLCache, shared_cache
+from ..connections import connection_router
+from ..tracing import tracer
+from ..notifications import SlackDispatcher
+from ..stores import PackedJsonAdapter
 
 config.register_externals()
 config.register_adapters(context=locals())
 
 schema = djp.schema(config.schema_name, create_schema=True)
+connection_router.track_writes(schema.connection)
 
 slack_client = SlackForWidget(default_channel='#microns-dashboard')
+slack_notifier = SlackDispatcher(slack_client, rate=1., burst=5, digest_window=slack_digest_window)
 
 os.environ['DJ_LOGLEVEL'] ='WARNING'
 logger = djp.getLogger(__name__, level='WARNING', update_root_level=True)
 
 
 user_attr = """user : varchar(128) # dashboard username"""
+event_data_type = '<packed_events>' if event_store == 'packed' else dju.Event.data_type
 
 
 @schema
@@ -36,6 +52,9 @@ class Tag(dju.VersionLookup):
     attr_name = 'tag'
 
 
+tag_version = Tag.version
+
+
 @schema
 class Event(dju.EventLookup):
     basedir = Path(config.externals.get('events').get('location'))
@@ -43,23 +62,164 @@ class Event(dju.EventLookup):
     -> {Tag.class_name}
     """
 
+    @classmethod
+    def log_event(cls, event, attrs=None, data=None, idempotency_key=None):
+        """
+        :param idempotency_key: (str) if given, the event is logged once per key (see `make_idempotency_key`). 
+            Logging a key again is a no-op that returns the EventData of the first event.
+        """
+        with tracer.span('log_event', event_type=event) as span:
+            if idempotency_key is None:
+                if event_processing == 'outbox':
+                    event, = cls.log_events([{'event': event, 'attrs': attrs, 'data': data}])
+                else:
+                    event = super().log_event(event, attrs=attrs, data=data)
+                span.event_id = event.id
+                return event
+            # the key is reserved in the transaction that inserts the event, so a failed insert releases it. 
+            # A concurrent call with the same key waits for the transaction and then finds the event.
+            with cls.connection.transaction if not cls.connection.in_transaction else nullcontext():
+                if EventKey.reserve(idempotency_key):
+                    (event,), batches = cls._insert_events([{'event': event, 'attrs': attrs, 'data': data}])
+                    EventKey.assign(idempotency_key, event.id)
+                else:
+                    event = None
+            if event is None:
+                span.duplicate = True
+                return EventKey.get_event(idempotency_key)
+            span.event_id = event.id
+            cls._handle_events(batches)
+        return event
+
+    @staticmethod
+    def make_idempotency_key(event, *values, window=60, now=None):
+        """
+        Returns a key that is the same for event and values within each time bucket of window seconds.
+            e.g. make_idempotency_key('user_access', user, entry_point) logs one access per user and entry point per minute.
+
+        :param now: (float) seconds since the epoch. Defaults to time.time().
+        """
+        bucket = int((time.time() if now is None else now) // window)
+        return hashlib.sha1(json.dumps([event, *values, bucket], default=str).encode()).hexdigest()
+
+    @classmethod
+    def log_events(cls, records, max_workers=8, notifier=None):
+        """
+        Logs a batch of events. Rows are inserted with one transaction per part table, 
+            data payloads written to files are written concurrently and each part table handles its events in one call to `on_events`.
+            If event_processing is "outbox", the events are recorded in the Outbox in the same transaction 
+            and handled later by the worker instead.
+
+        :param records: (list) dictionaries with key "event" and optional keys "attrs" and "data", as in `log_event`
+        :param max_workers: (int) maximum number of threads used to write data payloads to files. Payloads of a single
+            event, or of parts that store them in the table, are prepared without threads.
+        :param notifier: (SlackDispatcher) passed to `on_events` for the Slack notifications of the batch. 
+            Defaults to slack_notifier. Not used if event_processing is "outbox"; the worker uses its own slack_notifier.
+
+        :returns: (list) EventData for each record, in the order of records
+        """
+        events, batches = cls._insert_events(records, max_workers=max_workers)
+        cls._handle_events(batches, notifier=notifier)
+        return events
+
+    @classmethod
+    def _insert_events(cls, records, max_workers=8):
+        """
+        Inserts the events of `log_events` without handling them.
+
+        :returns: 
+            (list) EventData for each record, in the order of records
+            (list) (part, part events) to pass to `_handle_events`; empty if event_processing is "outbox"
+        """
+        parts = {}
+        for part in cls.parts(as_cls=True):
+            for name in wrap(part.events):
+                parts[name] = part
+
+        for record in records:
+            assert record.get('event') in parts, f'No parts with event "{record.get("event")}" found.'
+
+        # timestamps are offset by 1 microsecond so that every event in the batch hashes to a unique event_id
+        now = current_timestamp('US/Central')
+        timestamps = [(now + timedelta(microseconds=i)).strftime("%Y-%m-%d_%H:%M:%S.%f") for i in range(len(records))]
+        
+        batches = {}
+        for i, record in enumerate(records):
+            batches.setdefault(parts[record['event']], []).append(i)
+        
+        events, handled = [None] * len(records), []
+        for part, inds in batches.items():
+            event_ids = part.hash([{'event': records[i]['event'], 'timestamp': timestamps[i]} for i in inds])
+            part_events = [dju.EventData(id=event_id, name=records[i]['event'], timestamp=timestamps[i]) for event_id, i in zip(event_ids, inds)]
+            prepare = lambda e, i: part().prepare_data(event=e, data=records[i].get('data'))
+            if len(inds) > 1 and part.external_type is not None:
+                # payloads written to files are written concurrently; other payloads are returned as is by prepare_data
+                with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    data = list(executor.map(prepare, part_events, inds))
+            else:
+                data = [prepare(e, i) for e, i in zip(part_events, inds)]
+            adapter = part.heading.attributes['data'].adapter
+            if isinstance(adapter, PackedJsonAdapter):
+                # the payloads of the part are appended under one lock; insert stores the returned pointers as is
+                data = adapter.put_many(data)
+            rows = []
+            for event, i, d in zip(part_events, inds, data):
+                row = {'event_id': event.id, 'event': event.name, 'timestamp': event.timestamp}
+                row.update(records[i].get('attrs') or {})
+                row['data'] = d
+                rows.append(row)
+            outbox = event_processing == 'outbox'
+            with cls.connection.transaction if outbox and not cls.connection.in_transaction else nullcontext():
+                part.insert(rows, constant_attrs={} if part.constant_attrs is None else part.constant_attrs, insert_to_master=True, ignore_extra_fields=True, skip_hashing=True)
+                if outbox:
+                    Outbox.insert([{'event_id': e.id, 'event': e.name} for e in part_events])
+            cls.Log('info', f'{len(rows)} events logged to {part.class_name}')
+            for event, i in zip(part_events, inds):
+                events[i] = event
+            if not outbox:
+                handled.append((part, part_events))
+        return events, handled
+
+    @staticmethod
+    def _handle_events(batches, notifier=None):
+        for part, part_events in batches:
+            with tracer.span('on_event', event_type=part_events[0].name) as span:
+                span.n_events = len(part_events)
+                if hasattr(part, 'on_events'):
+                    part().on_events(events=part_events, notifier=notifier)
+                else:
+                    for event in part_events:
+                        part().on_event(event=event)
+
     class UserAccess(dju.Event):
         events = 'user_access'
+        data_type = event_data_type
         constant_attrs = {Tag.attr_name: Tag.version}
         extra_primary_attrs = f"""
         -> {Tag.class_name}
         """
-        extra_secondary_attrs = user_attr
+        extra_secondary_attrs = f"""
+        {user_attr}
+        index(timestamp)
+        """
         def on_event(self, event):
-            user, data = (self & {'event_id': event.id}).fetch1('user', 'data')
-            if data is not None:
-                entry_point = data.get('entry_point') if data.get('entry_point') is not None else 'dashboard'
-            else:
-                entry_point = 'dashboard'
-            slack_client.post_to_slack(f'```{user} accessed the {entry_point} ```')                
+            with tracer.span('on_event', event_id=event.id, event_type=event.name):
+                self.on_events([event])
+        
+        def on_events(self, events, notifier=None):
+            notifier = slack_notifier if notifier is None else notifier
+            rows = {r['event_id']: r for r in (self & [{'event_id': e.id} for e in events]).fetch('event_id', 'user', 'data', as_dict=True)}
+            for event in events:
+                user, data = rows[event.id]['user'], rows[event.id]['data']
+                if data is not None:
+                    entry_point = data.get('entry_point') if data.get('entry_point') is not None else 'dashboard'
+                else:
+                    entry_point = 'dashboard'
+                notifier.post_to_slack(f'```{user} accessed the {entry_point} ```', digest=(f'users accessed the {entry_point}', user))
     
     class UserCheckIn(dju.Event):
         events = 'user_check_in'
+        data_type = event_data_type
         constant_attrs = {Tag.attr_name: Tag.version}
         extra_primary_attrs = f"""
         -> {Tag.class_name}
@@ -67,19 +227,29 @@ class Event(dju.EventLookup):
         extra_secondary_attrs = f"""
         {user_attr}
         check_in : tinyint # 1 if check in; 0 if check out
+        index(timestamp)
         """
         def on_event(self, event):
-            user, check_in, data = (self & {'event_id': event.id}).fetch1('user', 'check_in', 'data')
-            if data is not None:
-                auto = data.get('auto')
-            else:
-                auto = False
-            msg = f"```%s {'' if not auto else 'auto-'}checked {'in' if check_in else 'out'}```"
-            slack_client.post_to_slack(msg % user)
-            slack_client.post_to_slack(msg % 'You', channel=f'@{User.Slack.get_slack_username(user)}')
+            with tracer.span('on_event', event_id=event.id, event_type=event.name):
+                self.on_events([event])
+
+        def on_events(self, events, notifier=None):
+            notifier = slack_notifier if notifier is None else notifier
+            rows = {r['event_id']: r for r in (self & [{'event_id': e.id} for e in events]).fetch('event_id', 'user', 'check_in', 'data', as_dict=True)}
+            slack_usernames = User.Slack.get_slack_usernames([r['user'] for r in rows.values()])
+            for event in events:
+                user, check_in, data = rows[event.id]['user'], rows[event.id]['check_in'], rows[event.id]['data']
+                if data is not None:
+                    auto = data.get('auto')
+                else:
+                    auto = False
+                msg = f"```%s {'' if not auto else 'auto-'}checked {'in' if check_in else 'out'}```"
+                notifier.post_to_slack(msg % user)
+                notifier.send_direct_message(msg % 'You', slack_usernames[user])
 
     class UserAdd(dju.Event):
         events = ['user_add', 'user_add_info']
+        data_type = event_data_type
         constant_attrs = {Tag.attr_name: Tag.version}
         extra_primary_attrs = f"""
         -> {Tag.class_name}
@@ -89,32 +259,244 @@ class Event(dju.EventLookup):
         info_type=NULL : varchar(128)
         """
         def on_event(self, event):
-            if event.name == 'user_add':
-                User.Add.populate({'event_id': event.id})
-                user = (self & {'event_id': event.id}).fetch1('user')
-                slack_client.post_to_slack(f"```{user} was added to the dashboard```")
+            with tracer.span('on_event', event_id=event.id, event_type=event.name):
+                self.on_events([event])
+
+        def on_events(self, events, notifier=None):
+            notifier = slack_notifier if notifier is None else notifier
+            add_keys = [{'event_id': e.id} for e in events if e.name == 'user_add']
+            add_info_keys = [{'event_id': e.id} for e in events if e.name == 'user_add_info']
+            if add_keys:
+                with tracer.span('populate', event_type='user_add'):
+                    bulk_populate(User.Add, add_keys)
+            if add_info_keys:
+                with tracer.span('populate', event_type='user_add_info'):
+                    bulk_populate(User.AddInfo, add_info_keys)
+            shared_cache.invalidate('users')
             
-            elif event.name == 'user_add_info':
-                User.AddInfo.populate({'event_id': event.id})
-                user, info_type = (self & {'event_id': event.id}).fetch1('user', 'info_type')
-                msg = f"```%s updated %s {' '.join(info_type.split('_'))}```"
-                slack_client.post_to_slack(msg % (user, 'their'))
-                slack_client.post_to_slack(msg % ('You', 'your'), channel=f'@{User.Slack.get_slack_username(user)}')
+            rows = {r['event_id']: r for r in (self & [{'event_id': e.id} for e in events]).fetch('event_id', 'user', 'info_type', as_dict=True)}
+            for event in events:
+                user, info_type = rows[event.id]['user'], rows[event.id]['info_type']
+                if event.name == 'user_add':
+                    notifier.post_to_slack(f"```{user} was added to the dashboard```")
+                
+                elif event.name == 'user_add_info':
+                    msg = f"```%s updated %s {' '.join(info_type.split('_'))}```"
+                    notifier.post_to_slack(msg % (user, 'their'))
+                    notifier.send_direct_message(msg % ('You', 'your'), User.Slack.get_slack_username(user))
+
+
+@schema
+class EventKey(djp.Lookup):
+    definition = f"""
+    idempotency_key : char(40) # see Event.make_idempotency_key
+    ---
+    -> [nullable] {Event.class_name}
+    reserved=CURRENT_TIMESTAMP : timestamp
+    index(reserved)
+    """
+    retention = 24 * 3600. # seconds a key is kept; must exceed the window of the key plus the retry horizon of callers
+
+    @classmethod
+    def reserve(cls, idempotency_key):
+        """
+        Inserts idempotency_key. Returns True if it was inserted, False if it already exists. 
+            The primary key makes this atomic across kernels.
+        """
+        return cls.connection.query(
+            f'INSERT IGNORE INTO {cls.full_table_name} (`idempotency_key`) VALUES (%s)', args=(idempotency_key,)
+        ).rowcount == 1
+
+    @classmethod
+    def assign(cls, idempotency_key, event_id):
+        cls.connection.query(
+            f'UPDATE {cls.full_table_name} SET `event_id` = %s WHERE `idempotency_key` = %s', args=(event_id, idempotency_key)
+        )
+
+    @classmethod
+    def prune(cls, retention=None, limit=10000):
+        """
+        Deletes keys reserved more than retention seconds ago (default: cls.retention), limit rows per DELETE. 
+            Logging a pruned key again logs a new event.
+
+        :returns: (int) number of keys deleted
+        """
+        retention = cls.retention if retention is None else retention
+        n = 0
+        while True:
+            deleted = cls.connection.query(
+                f'DELETE FROM {cls.full_table_name} WHERE `reserved` < NOW() - INTERVAL %s SECOND LIMIT %s', args=(retention, limit)
+            ).rowcount
+            n += deleted
+            if deleted < limit:
+                return n
+
+    @classmethod
+    def get_event(cls, idempotency_key):
+        """
+        Returns the EventData logged with idempotency_key or None if there is none.
+        """
+        rows = (Event & (cls & {'idempotency_key': idempotency_key} & 'event_id IS NOT NULL')).fetch('event_id', 'event', 'timestamp', as_dict=True)
+        return dju.EventData(id=rows[0]['event_id'], name=rows[0]['event'], timestamp=rows[0]['timestamp']) if rows else None
+
+
+@schema
+class Outbox(djp.Lookup):
+    definition = f"""
+    -> {Event.class_name}
+    ---
+    event : varchar(128) # event name, used to find the part table that handles it
+    status='pending' : enum('pending', 'claimed', 'done', 'dead') # dead after max_attempts failures
+    attempts=0 : tinyint unsigned # number of times the event was claimed
+    claimed_by=NULL : varchar(64) # claim token of the worker processing the event
+    claimed_at=NULL : timestamp
+    available_at=CURRENT_TIMESTAMP : timestamp # the event is not claimed before this time (retry backoff)
+    last_error=NULL : varchar(2048)
+    created=CURRENT_TIMESTAMP : timestamp
+    index(status, available_at)
+    """
+
+    @classmethod
+    def claim(cls, token, limit=100):
+        """
+        Claims up to limit pending events, oldest first, with one UPDATE. 
+            Claims are atomic, so several workers never claim the same event.
+
+        :param token: (str) unique claim token of the worker
+        
+        :returns: (list) dju.EventData of the claimed events
+        """
+        n = cls.connection.query(
+            f'UPDATE {cls.full_table_name} SET `status` = "claimed", `claimed_by` = %s, `claimed_at` = NOW(), `attempts` = `attempts` + 1 '
+            'WHERE `status` = "pending" AND `available_at` <= NOW() ORDER BY `created` LIMIT %s',
+            args=(token, limit)
+        ).rowcount
+        if n == 0:
+            return []
+        rows = (Event & (cls & {'claimed_by': token, 'status': 'claimed'})).fetch('event_id', 'event', 'timestamp', as_dict=True, order_by='timestamp')
+        return [dju.EventData(id=r['event_id'], name=r['event'], timestamp=r['timestamp']) for r in rows]
+
+    @classmethod
+    def complete(cls, event_ids):
+        if event_ids:
+            cls.connection.query(
+                f'UPDATE {cls.full_table_name} SET `status` = "done", `last_error` = NULL WHERE `event_id` IN ({", ".join(["%s"] * len(event_ids))})',
+                args=tuple(event_ids)
+            )
+
+    @classmethod
+    def fail(cls, event_id, error, max_attempts=5, backoff=30.):
+        """
+        Returns a failed event to pending after a backoff of backoff * 2 ** (attempts - 1) seconds, 
+            or dead-letters it (status "dead") once it has been attempted max_attempts times.
+        """
+        cls.connection.query(
+            f'UPDATE {cls.full_table_name} SET `last_error` = %s, `claimed_by` = NULL, '
+            '`status` = IF(`attempts` >= %s, "dead", "pending"), '
+            '`available_at` = NOW() + INTERVAL (%s * POW(2, `attempts` - 1)) SECOND '
+            'WHERE `event_id` = %s',
+            args=(str(error)[:2048], max_attempts, backoff, event_id)
+        )
+
+    @classmethod
+    def release_expired(cls, lease=600., max_attempts=5):
+        """
+        Returns events claimed more than lease seconds ago (by a worker that died or hung) to pending,
+            or dead-letters them once they have been attempted max_attempts times, so that an event that kills
+            its worker is not claimed forever.
+
+        :returns: (int) number of events released or dead-lettered
+        """
+        return cls.connection.query(
+            f'UPDATE {cls.full_table_name} SET `claimed_by` = NULL, `last_error` = "lease expired", '
+            '`status` = IF(`attempts` >= %s, "dead", "pending") '
+            'WHERE `status` = "claimed" AND `claimed_at` < NOW() - INTERVAL %s SECOND',
+            args=(max_attempts, lease)
+        ).rowcount
+
+    @classmethod
+    def prune(cls, retention=7 * 24 * 3600., limit=10000):
+        """
+        Deletes done events claimed more than retention seconds ago, limit rows per DELETE.
+            Pending, claimed and dead events are kept.
+
+        :returns: (int) number of events deleted
+        """
+        n = 0
+        while True:
+            deleted = cls.connection.query(
+                f'DELETE FROM {cls.full_table_name} WHERE `status` = "done" AND `claimed_at` < NOW() - INTERVAL %s SECOND LIMIT %s',
+                args=(retention, limit)
+            ).rowcount
+            n += deleted
+            if deleted < limit:
+                return n
+
+    @classmethod
+    def retry_dead(cls, event_ids=None):
+        """
+        Returns dead-lettered events (all or event_ids) to pending with their attempts reset.
+        """
+        restr = '' if event_ids is None else f' AND `event_id` IN ({", ".join(["%s"] * len(event_ids))})'
+        return cls.connection.query(
+            f'UPDATE {cls.full_table_name} SET `status` = "pending", `attempts` = 0, `available_at` = NOW() WHERE `status` = "dead"{restr}',
+            args=() if event_ids is None else tuple(event_ids)
+        ).rowcount
+
+
+ResolvedHandler = namedtuple('ResolvedHandler', ['part', 'event', 'version'])
 
 
 @schema
 class EventHandler(dju.EventHandlerLookup):
+    _handlers = None
+
+    @classmethod
+    def reload_handlers(cls, use_cache=False):
+        """
+        Loads the part table, event and version of every handler with one query per part table. 
+            Call after inserting new handlers; handlers missing from the registry also trigger a reload.
+
+        :param use_cache: (bool) if True, rows are read from shared_cache when another kernel has loaded them 
+            since handlers were last inserted
+        """
+        parts = {part.class_name: part for part in cls.parts(as_cls=True)}
+        def fetch():
+            return [dict(row, part=name) for name, part in parts.items() for row in part.fetch('event_handler_id', 'event', Tag.attr_name, as_dict=True)]
+        
+        if use_cache:
+            rows = shared_cache.get_or_set('event_handlers', 'rows', fetch)
+        else:
+            version = shared_cache.version('event_handlers')
+            rows = fetch()
+            shared_cache.set('event_handlers', 'rows', rows, version=version)
+        cls._handlers = {row['event_handler_id']: ResolvedHandler(part=parts[row['part']], event=row['event'], version=row[Tag.attr_name]) for row in rows}
+        return cls._handlers
+
+    @classmethod
+    def resolve(cls, event_handler_id):
+        """
+        Returns the ResolvedHandler for event_handler_id from the registry.
+        """
+        if cls._handlers is None:
+            cls.reload_handlers(use_cache=True)
+        if event_handler_id not in cls._handlers:
+            cls.reload_handlers()
+        assert event_handler_id in cls._handlers, f'event_handler_id {event_handler_id} not found.'
+        return cls._handlers[event_handler_id]
+
     @classmethod
     def run(cls, key):
-        handler = cls.r1p(key)
-        handler_event = handler.fetch1('event')
-        handler_version = handler.fetch1(Tag.attr_name)
-        cls.Log('info',  'Running %s', handler.class_name)
-        cls.Log('debug', 'Running %s with key %s', handler.class_name, key)
-        assert handler_event == key['event'], f'event in handler {handler_event} doesnt match event in key {key["event"]}'
-        assert handler_version == Tag.version, f'version mismatch, event_handler version_id is {handler_version} but the current version_id is {Tag.version}'
-        key = handler.run(key)
-        cls.Log('info', '%s ran successfully.', handler.class_name)
+        with tracer.span('handler', event_id=key.get('event_id'), event_type=key.get('event')):
+            resolved = cls.resolve(key[cls.hash_name])
+            handler = resolved.part & {cls.hash_name: key[cls.hash_name]}
+            cls.Log('info',  'Running %s', resolved.part.class_name)
+            cls.Log('debug', 'Running %s with key %s', resolved.part.class_name, key)
+            assert resolved.event == key['event'], f'event in handler {resolved.event} doesnt match event in key {key["event"]}'
+            assert resolved.version == tag_version, f'version mismatch, event_handler version_id is {resolved.version} but the current version_id is {tag_version}'
+            with tracer.span('handler.run'):
+                key = handler.run(key)
+            cls.Log('info', '%s ran successfully.', resolved.part.class_name)
         return key
 
     class UserEvent(dju.EventHandler):
@@ -126,14 +508,17 @@ class EventHandler(dju.EventHandlerLookup):
 
         @classproperty
         def contents(cls):
-            for event in Event.UserAdd.events:
-                key = {'event': event}
-                key.update(cls.constant_attrs)
-                cls.insert(key, ignore_extra_fields=True, skip_duplicates=True, insert_to_master=True)
+            keys = [dict(cls.constant_attrs, event=event) for event in Event.UserAdd.events]
+            if len(cls & keys) < len(keys):
+                for key in keys:
+                    cls.insert(key, ignore_extra_fields=True, skip_duplicates=True, insert_to_master=True)
+                shared_cache.invalidate('event_handlers')
+            cls.master.reload_handlers(use_cache=True)
             return {}
 
         def run(self, key):
-            event = self.fetch1('event')
+            # EventHandler.run has checked that the event in key matches this handler
+            event = key['event']
 
             if event in ['user_add']:
                 return key
@@ -142,7 +527,8 @@ class EventHandler(dju.EventHandlerLookup):
                 info_type = key.get('info_type')
                 
                 if info_type == 'slack_username':
-                    username = slack_client.get_slack_username(key.get('data'))
+                    with tracer.external('slack.get_slack_username'):
+                        username = slack_client.get_slack_username(key.get('data'))
                     assert username is not None, 'Slack username not found.'
                     key[info_type] = username
                 
@@ -159,6 +545,13 @@ class User(djp.Lookup):
     timestamp=CURRENT_TIMESTAMP : timestamp
     """
 
+    @classmethod
+    def members(cls):
+        """
+        Returns the users added to the dashboard. Cached in shared_cache until a user_add or user_add_info event is logged.
+        """
+        return set(shared_cache.get_or_set('users', 'members', lambda: connection_router.fetch(cls, 'user').tolist()))
+
     class Add(dju.Maker):
         hash_name = 'make_id'
         upstream = Event
@@ -190,11 +583,14 @@ class User(djp.Lookup):
             return (djp.U('event_id', 'event_handler_id') & ((Event.UserAdd & [{'event': e} for e in wrap(cls.events)]) * EventHandler.UserEvent))
 
         def on_make(self, key):
-            if key.get('info_type') == 'slack_username':
-                self.master.Slack.insert1(key, ignore_extra_fields=True, replace=True)
+            with tracer.span('on_make', event_id=key.get('event_id'), event_type=key.get('event')):
+                if key.get('info_type') == 'slack_username':
+                    self.master.Slack.insert1(key, ignore_extra_fields=True, replace=True)
+                    shared_cache.invalidate('users')
 
     class Slack(djp.Part):
         store = True
+        username_cache = TTLCache(maxsize=1024, ttl=300)
         definition = f"""
         -> master
         ---
@@ -202,5 +598,314 @@ class User(djp.Lookup):
         make_id : varchar(10)
         """
 
+        @classmethod
+        def get_slack_username(cls, user):
+            """
+            Returns the Slack username of user or None if the user has not set one. 
+                Lookups are cached in username_cache (see username_cache.stats for hit/miss counters) under the version of 
+                the "users" namespace of shared_cache, so an update in any kernel invalidates them.
+            """
+            version = shared_cache.version('users')
+            return cls.username_cache.get_or_set(
+                (version, user), 
+                lambda: shared_cache.get_or_set('users', f'slack_username:{user}', lambda: unwrap(connection_router.fetch(cls & {'user': user}, 'slack_username').tolist()) or None)
+            )
+
+        @classmethod
+        def get_slack_usernames(cls, users):
+            """
+            Returns a dictionary of user to Slack username (or None) for users. 
+                Users missing from username_cache and shared_cache are fetched with one query.
+            """
+            version = shared_cache.version('users')
+            usernames, missing = {}, []
+            for user in set(users):
+                username = cls.username_cache.get((version, user), default=MISSING)
+                if username is MISSING:
+                    username = shared_cache.get('users', f'slack_username:{user}', default=MISSING)
+                    if username is MISSING:
+                        missing.append(user)
+                        continue
+                    cls.username_cache.set((version, user), username)
+                usernames[user] = username
+            if missing:
+                fetched = dict(zip(*connection_router.fetch(cls & [{'user': user} for user in missing], 'user', 'slack_username')))
+                for user in missing:
+                    usernames[user] = fetched.get(user)
+                    shared_cache.set('users', f'slack_username:{user}', usernames[user], version=version)
+                    cls.username_cache.set((version, user), usernames[user])
+            return {user: usernames[user] for user in users}
+
+
+
+@schema
+class Watermark(djp.Lookup):
+    definition = """
+    name : varchar(64) # name of the process that reads events incrementally
+    ---
+    mark=NULL : varchar(64) # events up to and including mark have been processed
+    last_updated=CURRENT_TIMESTAMP : timestamp
+    """
+    mark_format = '%Y-%m-%d %H:%M:%S'
+
+    class Applied(djp.Part):
+        definition = """
+        # events processed within the lookback of the mark; they are read again by the next window and skipped
+        -> master
+        event_id : varchar(12)
+        ---
+        timestamp : timestamp # event timestamp
+        """
+
+    @classmethod
+    def read(cls, name, lock=False):
+        """
+        Returns the mark of name or None if name has not processed any events.
+
+        :param lock: (bool) if True, the row is locked until the current transaction ends
+        """
+        cls.insert1({'name': name}, skip_duplicates=True)
+        return cls.connection.query(
+            f'SELECT `mark` FROM {cls.full_table_name} WHERE `name` = %s{" FOR UPDATE" if lock else ""}', args=(name,)
+        ).fetchall()[0][0]
+
+    @classmethod
+    def write(cls, name, mark):
+        # an upsert; REPLACE would delete the row and its Applied events
+        cls.connection.query(
+            f'INSERT INTO {cls.full_table_name} (`name`, `mark`) VALUES (%s, %s) '
+            'ON DUPLICATE KEY UPDATE `mark` = VALUES(`mark`), `last_updated` = CURRENT_TIMESTAMP',
+            args=(name, mark)
+        )
+
+    @classmethod
+    def shift(cls, mark, seconds):
+        return (datetime.strptime(mark, cls.mark_format) + timedelta(seconds=seconds)).strftime(cls.mark_format)
+
+    @classmethod
+    def pending(cls, name, part, since, until, lookback=60):
+        """
+        Returns the events of part that name has not processed, up to and including until.
+            Events from lookback seconds before since are read again, minus the Applied events of name, 
+            so events that share a timestamp with since or commit up to lookback seconds late are processed exactly once.
+
+        :param since: (str) mark of name, see `read`
+        :param until: (str) new mark
+        """
+        window = [f'timestamp <= "{until}"'] + ([] if since is None else [f'timestamp >= "{cls.shift(since, -lookback)}"'])
+        return (part & dj.AndList(window)) - (cls.Applied & {'name': name}).proj()
+
+    @classmethod
+    def advance(cls, name, until, events, lookback=60):
+        """
+        Sets the mark of name to until and records the processed events that the next window reads again.
+
+        :param events: (list) dicts with event_id and timestamp of the events processed since the last mark
+        """
+        floor = cls.shift(until, -lookback)
+        cls.write(name, until)
+        (cls.Applied & {'name': name} & f'timestamp < "{floor}"').delete_quick()
+        floor = datetime.strptime(floor, cls.mark_format)
+        cls.Applied.insert(
+            [{'name': name, 'event_id': e['event_id'], 'timestamp': e['timestamp']} for e in events if e['timestamp'] >= floor],
+            skip_duplicates=True
+        )
+
+
+@schema
+class UserActivity(djp.Lookup):
+    definition = f"""
+    {user_attr}
+    ---
+    checked_in=0 : tinyint # 1 if the last check in event of user is a check in
+    last_check_in=NULL : timestamp
+    last_check_out=NULL : timestamp
+    last_access=NULL : timestamp
+    last_entry_point=NULL : varchar(128) # entry_point of the last access
+    n_access=0 : int unsigned # total number of accesses
+    n_check_in=0 : int unsigned # total number of check ins
+    """
+
+    @classmethod
+    def update_from_events(cls, settle=5, lookback=60):
+        """
+        Applies Event.UserAccess and Event.UserCheckIn events logged since the last update to UserActivity and UserActivityWeek.
+            Only events near or after the Watermark of UserActivity are fetched, so the cost grows with the number of new events,
+            not with the event history. Concurrent updates are serialized by locking the watermark row.
+
+        :param settle: (int) events from the last settle seconds are left for the next update
+        :param lookback: (int) events committed up to lookback seconds after their timestamp are still applied, once 
+            (see Watermark.pending). A late event counts, but does not change the last access or check in state 
+            if a newer event was already applied.
+
+        :returns: (dict) number of access and check in events applied and number of users updated
+        """
+        until = (current_timestamp('US/Central') - timedelta(seconds=settle)).replace(microsecond=0).strftime(Watermark.mark_format)
+        with cls.connection.transaction:
+            since = Watermark.read(cls.class_name, lock=True)
+            if since is not None and since >= until:
+                return {'n_access': 0, 'n_check_in': 0, 'n_users': 0}
+            accesses = Watermark.pending(cls.class_name, Event.UserAccess, since, until, lookback=lookback).fetch(
+                'event_id', 'user', 'timestamp', as_dict=True, order_by='timestamp'
+            )
+            check_ins = Watermark.pending(cls.class_name, Event.UserCheckIn, since, until, lookback=lookback).fetch(
+                'event_id', 'user', 'check_in', 'timestamp', as_dict=True, order_by='timestamp'
+            )
+
+            users = {e['user'] for e in accesses} | {e['user'] for e in check_ins}
+            activity = {u: {'user': u, 'checked_in': 0, 'last_check_in': None, 'last_check_out': None, 'last_access': None, 
+                'last_entry_point': None, 'n_access': 0, 'n_check_in': 0} for u in users}
+            current = (cls & [{'user': u} for u in users]).fetch(as_dict=True) if users else []
+            activity.update({row['user']: row for row in current})
+            
+            weeks = {}
+            def week(user, timestamp):
+                key = (user, (timestamp - timedelta(days=timestamp.weekday())).date())
+                return weeks.setdefault(key, {'user': key[0], 'week': key[1], 'n_access': 0, 'n_check_in': 0, 'check_in_hours': 0.})
+
+            last_access = {}
+            for e in accesses:
+                row = activity[e['user']]
+                row['n_access'] += 1
+                week(e['user'], e['timestamp'])['n_access'] += 1
+                if row['last_access'] is None or e['timestamp'] >= row['last_access']:
+                    row['last_access'] = e['timestamp']
+                    last_access[e['user']] = e['event_id']
+
+            for e in check_ins:
+                row = activity[e['user']]
+                if e['check_in']:
+                    row['n_check_in'] += 1
+                    week(e['user'], e['timestamp'])['n_check_in'] += 1
+                latest = max([t for t in [row['last_check_in'], row['last_check_out']] if t is not None], default=None)
+                if latest is not None and e['timestamp'] < latest:
+                    # a late event older than the current state is counted only
+                    continue
+                if e['check_in']:
+                    row['last_check_in'] = e['timestamp']
+                else:
+                    if row['checked_in'] and row['last_check_in'] is not None:
+                        week(e['user'], row['last_check_in'])['check_in_hours'] += (e['timestamp'] - row['last_check_in']).total_seconds() / 3600
+                    row['last_check_out'] = e['timestamp']
+                row['checked_in'] = int(bool(e['check_in']))
+
+            # payloads are only read for the last access of each user
+            if last_access:
+                for e in (Event.UserAccess & [{'event_id': i} for i in last_access.values()]).fetch('user', 'data', as_dict=True):
+                    data = e['data'] or {}
+                    activity[e['user']]['last_entry_point'] = data.get('entry_point') if data.get('entry_point') is not None else 'dashboard'
+
+            if weeks:
+                for row in (UserActivityWeek & [{'user': u, 'week': w} for u, w in weeks]).fetch(as_dict=True):
+                    new = weeks[(row['user'], row['week'])]
+                    for attr in ['n_access', 'n_check_in', 'check_in_hours']:
+                        new[attr] += row[attr]
+                UserActivityWeek.insert(list(weeks.values()), replace=True)
+            if activity:
+                cls.insert(list(activity.values()), replace=True)
+            Watermark.advance(cls.class_name, until, accesses + check_ins, lookback=lookback)
+        cls.Log('info', f'{len(accesses)} access and {len(check_ins)} check in events applied to {len(users)} users')
+        return {'n_access': len(accesses), 'n_check_in': len(check_ins), 'n_users': len(users)}
+
+
+@schema
+class UserActivityWeek(djp.Lookup):
+    definition = f"""
+    {user_attr}
+    week : date # monday of the week
+    ---
+    n_access=0 : int unsigned
+    n_check_in=0 : int unsigned
+    check_in_hours=0 : float # hours between check in and check out, counted in the week of the check in
+    """
+
+def bulk_populate(maker, *restrictions, batch_size=100, processes=1, reserve_jobs=False, suppress_errors=False):
+    """
+    Populates a User maker (User.Add or User.AddInfo) in batches. 
+        Pending keys are computed with one key_source query, upstream events and handlers are fetched once per batch,
+        EventHandler.run is called for every key of the batch and the results are inserted with one insert per batch.
+
+    :param maker: User.Add or User.AddInfo
+    :param restrictions: restrictions applied to key_source, as in populate
+    :param batch_size: (int) number of keys per batch
+    :param processes: (int) number of worker processes. Each forked worker reconnects the schema connection, so workers
+        do not share the parent's socket.
+    :param reserve_jobs: (bool) if True, keys are claimed in the schema jobs table before they are made, 
+        so several kernels can drain the same backlog without duplicating work
+    :param suppress_errors: (bool) if True, errors are logged (and recorded in the jobs table if reserve_jobs) and the remaining keys are made
+
+    :returns: (dict) number of keys made, skipped (reserved by another worker) and failed
+    """
+    # pending keys are computed on the primary; a lagging replica would return keys that are already made
+    keys = ((maker.key_source & dj.AndList(restrictions)) - maker).fetch('KEY', order_by='event_id')
+    batches = [(maker.__name__, keys[i:i + batch_size], reserve_jobs, suppress_errors) for i in range(0, len(keys), batch_size)]
+    if processes > 1 and len(batches) > 1:
+        with multiprocessing.get_context('fork').Pool(processes=min(processes, len(batches)), initializer=_reset_connection) as pool:
+            results = pool.map(_populate_batch_by_name, batches)
+    else:
+        results = [_populate_batch(maker, *batch[1:]) for batch in batches]
+    stats = {'made': 0, 'skipped': 0, 'failed': 0}
+    for result in results:
+        for k, v in result.items():
+            stats[k] += v
+    maker.Log('info', f'bulk_populate: {stats}')
+    return stats
+
+
+def _reset_connection():
+    # forked workers must not share the parent's database socket. Declared tables hold schema.connection,
+    # so it is reconnected in place rather than replaced with a new global connection.
+    schema.connection.connect()
+    if getattr(dj.conn, 'connection', None) not in (None, schema.connection):
+        dj.conn.connection.connect()
+
+
+def _populate_batch_by_name(args):
+    name, *args = args
+    return _populate_batch(getattr(User, name), *args)
+
+
+def _populate_batch(maker, keys, reserve_jobs=False, suppress_errors=False):
+    stats = {'made': 0, 'skipped': 0, 'failed': 0}
+    if reserve_jobs:
+        claimed = [key for key in keys if schema.jobs.reserve(maker.table_name, key)]
+        stats['skipped'] = len(keys) - len(claimed)
+        keys = claimed
+    if not keys:
+        return stats
+
+    events = {row['event_id']: row for row in (Event.UserAdd & keys).fetch(as_dict=True)}
+    rows, made = [], []
+    for key, make_id in zip(keys, maker.hash(keys)):
+        row = {**key, maker.hash_name: make_id, **events[key['event_id']]}
+        try:
+            row.update(EventHandler.run(row))
+        except Exception as e:
+            maker.Log('exception', f'Error making {key}')
+            if reserve_jobs:
+                schema.jobs.error(maker.table_name, key, error_message=str(e), error_stack=traceback.format_exc())
+            if not suppress_errors:
+                raise
+            stats['failed'] += 1
+            continue
+        rows.append(row)
+        made.append(key)
+
+    if rows:
+        # keys made by another kernel since the pending keys were computed are skipped
+        existing = set((maker & made).fetch('event_id'))
+        stats['skipped'] += len([row for row in rows if row['event_id'] in existing])
+        rows = [row for row in rows if row['event_id'] not in existing]
+    if rows:
+        maker.insert(rows, ignore_extra_fields=True, skip_duplicates=True, insert_to_master=True, insert_to_master_kws={'ignore_extra_fields': True, 'skip_duplicates': True}, skip_hashing=True)
+        for row in rows:
+            maker().on_make(row)
+    if reserve_jobs:
+        for key in made:
+            schema.jobs.complete(maker.table_name, key)
+    stats['made'] = len(rows)
+    return stats
+
+
 schema.spawn_missing_classes()
 
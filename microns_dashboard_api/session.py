@@ -0,0 +1,130 @@
+"""
+Kernel-level context of a dashboard session.
+
+The hub user is resolved once, from a GetDashboardUser widget or given directly, and the parsed user info and the
+    keys derived from it are shared by every app of the kernel. Apps that get the session injected read the user from
+    it instead of parsing widget values.
+
+Usage in a notebook:
+```python
+user = GetDashboardUser() # must be in its own cell
+session = DashboardSession.from_widget(user) # or get_session().bind(user)
+user_app = UserApp(session=session, on_user_update=on_user_update)
+```
+
+In tests and headless sessions, no widget or front end is needed:
+```python
+session = DashboardSession.local('test_user')
+session.user, session.key # 'test_user', {'user': 'test_user'}
+```
+"""
+import threading
+
+
+class DashboardSession:
+    """
+    User of a dashboard session. `user_info` is set once the hub user is resolved; callbacks registered with
+        `on_change` are called with the session when the user info is set or changes.
+    """
+    def __init__(self, user_info=None):
+        """
+        :param user_info: (dict) hub user info, with the username under "name" (as returned by the hub) or "user"
+        """
+        self._user_info = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+        if user_info is not None:
+            self.set_user_info(user_info)
+
+    @classmethod
+    def local(cls, user, **user_info):
+        """
+        Returns a session for user that needs no widget or front end, e.g. for tests and headless sessions.
+        """
+        return cls(user_info=dict(user_info, name=user))
+
+    @classmethod
+    def from_widget(cls, widget):
+        """
+        Returns a session bound to a GetDashboardUser widget. See `bind`.
+        """
+        session = cls()
+        session.bind(widget)
+        return session
+
+    def bind(self, widget):
+        """
+        Resolves the user from a GetDashboardUser widget. The widget value is read when the front end sets it.
+        """
+        if widget.value:
+            self.set_user_info(widget.value)
+        widget.observe(lambda change: self.set_user_info(change['new']) if change['new'] else None, names='value')
+        return self
+
+    def set_user_info(self, user_info):
+        with self._lock:
+            changed = user_info != self._user_info
+            self._user_info = dict(user_info)
+            callbacks = list(self._callbacks)
+        if changed:
+            for callback in callbacks:
+                callback(self)
+
+    def on_change(self, callback):
+        """
+        Registers callback(session), called when the user info is set or changes.
+            If the user is already resolved, callback is called immediately.
+        """
+        with self._lock:
+            self._callbacks.append(callback)
+            resolved = self._user_info is not None
+        if resolved:
+            callback(self)
+
+    @property
+    def resolved(self):
+        return self._user_info is not None
+
+    @property
+    def user_info(self):
+        """
+        Copy of the hub user info, or None until the user is resolved.
+        """
+        return None if self._user_info is None else dict(self._user_info)
+
+    @property
+    def user(self):
+        if self._user_info is None:
+            return None
+        return self._user_info.get('name', self._user_info.get('user'))
+
+    @property
+    def key(self):
+        """
+        Restriction of dashboard tables to the session user, e.g. db.User.Slack & session.key.
+        """
+        return {'user': self.user}
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Returns the session of this kernel, creating an unresolved one on first call.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = DashboardSession()
+        return _session
+
+
+def set_session(session):
+    """
+    Sets the session of this kernel, e.g. a DashboardSession.local in tests.
+    """
+    global _session
+    with _session_lock:
+        _session = session
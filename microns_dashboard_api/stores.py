@@ -0,0 +1,366 @@
+"""
+Packed storage for event payloads.
+
+Payloads are appended to segmented, compressed log files instead of being written to one JSON file per event.
+    Each payload is addressed by a pointer "<segment>:<offset>:<length>" that is stored in the event table,
+    so reading a payload back by event_id is one indexed row fetch plus one seek.
+
+The store is used by event tables declared with event_store = "packed" (see config). Tables declared with the JSON
+    store keep a filepath reference per event. `pack_json_files` copies existing JSON files into a store, keyed by
+    event_id in index.tsv, and `verify_json_files` checks the copies by count and payload checksum.
+
+Cutting an existing schema over to the packed store:
+    1. Stop event logging and the outbox worker.
+    2. Pack and verify the payloads of every event referenced by the event tables. Packing is resumable; the command 
+       exits with status 1 if a referenced event has no packed copy or its copy differs from the JSON file:
+
+        python -m microns_dashboard_api.stores <events directory> <packed directory> --tables
+
+    3. Declare the event tables in a new schema with MICRONS_DASHBOARD_EVENT_STORE=packed and copy the rows of each
+       part with `copy_event_rows`, e.g. copy_event_rows(dj.FreeTable(conn, '`old_schema`.`__event__user_access`'), 
+       db.Event.UserAccess, store). The packed copies are stored as the data pointers and are not appended again.
+    4. Point the dashboard at the new schema. Keep the JSON files until the new schema has been checked.
+"""
+import argparse
+import fcntl
+import hashlib
+import json
+import sys
+import threading
+import zlib
+from contextlib import contextmanager
+from pathlib import Path
+
+from microns_utils.adapter_utils import Adapter
+
+
+class PackedEventStore:
+    """
+    Append-only store of JSON payloads packed into segment files.
+
+    Layout of `location`:
+        segment_000000.log, segment_000001.log, ...  : payload records, rolled over at segment_size bytes
+        index.tsv : optional "<key>\\t<pointer>" lines for payloads appended with a key (e.g. event_id)
+        .lock : lock file that serializes appends across threads, processes and hosts
+    """
+    segment_prefix = 'segment_'
+    segment_suffix = '.log'
+    index_name = 'index.tsv'
+    lock_name = '.lock'
+    _raw = b'j'
+    _compressed = b'z'
+
+    def __init__(self, location, segment_size=64 * 2**20, compress=True):
+        """
+        :param location: directory that holds the segments
+        :param segment_size: (int) size in bytes after which a new segment is started
+        :param compress: (bool) if True, payloads are zlib compressed
+        """
+        self.location = Path(location)
+        self.segment_size = segment_size
+        self.compress = compress
+        self._thread_lock = threading.Lock()
+        self._segment = None
+        self._index = {}
+        self._index_size = 0
+
+    def _segment_path(self, segment):
+        return self.location / f'{self.segment_prefix}{segment:06d}{self.segment_suffix}'
+
+    def _last_segment(self):
+        # the directory is only listed once; segments rolled over by other writers are found by probing forward
+        if self._segment is None:
+            segments = [int(p.stem[len(self.segment_prefix):]) for p in self.location.glob(f'{self.segment_prefix}*{self.segment_suffix}')]
+            self._segment = max(segments, default=0)
+        while self._segment_path(self._segment + 1).exists():
+            self._segment += 1
+        return self._segment
+
+    @contextmanager
+    def _lock(self):
+        self.location.mkdir(parents=True, exist_ok=True)
+        with self._thread_lock:
+            with open(self.location / self.lock_name, 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def encode(self, payload):
+        record = json.dumps(payload).encode()
+        return self._compressed + zlib.compress(record) if self.compress else self._raw + record
+
+    @classmethod
+    def decode(cls, record):
+        flag, record = record[:1], record[1:]
+        if flag == cls._compressed:
+            record = zlib.decompress(record)
+        elif flag != cls._raw:
+            raise ValueError(f'Unrecognized record flag {flag}.')
+        return json.loads(record)
+
+    @staticmethod
+    def parse_pointer(pointer):
+        segment, offset, length = str(pointer).split(':')
+        return int(segment), int(offset), int(length)
+
+    def append(self, payload, key=None):
+        """
+        Appends one payload.
+
+        :param payload: JSON serializable object
+        :param key: (str) optional key (e.g. event_id) to record in the index
+
+        :returns: (str) pointer to the payload
+        """
+        return self.append_many([payload], keys=None if key is None else [key])[0]
+
+    def append_many(self, payloads, keys=None):
+        """
+        Appends payloads under a single lock and file open.
+
+        :param payloads: (list) JSON serializable objects
+        :param keys: (list) optional keys (e.g. event_ids) to record in the index, one per payload
+
+        :returns: (list) pointers to the payloads, in order
+        """
+        records = [self.encode(p) for p in payloads]
+        if keys is not None:
+            assert len(keys) == len(records), 'keys and payloads must have the same length'
+        pointers = []
+        with self._lock():
+            segment = self._last_segment()
+            f = open(self._segment_path(segment), 'ab')
+            try:
+                for record in records:
+                    offset = f.tell()
+                    if offset > 0 and offset + len(record) > self.segment_size:
+                        f.close()
+                        segment += 1
+                        f = open(self._segment_path(segment), 'ab')
+                        offset = f.tell()
+                    f.write(record)
+                    pointers.append(f'{segment}:{offset}:{len(record)}')
+            finally:
+                f.close()
+            self._segment = segment
+            if keys is not None:
+                with open(self.location / self.index_name, 'a') as f:
+                    f.writelines([f'{k}\t{p}\n' for k, p in zip(keys, pointers)])
+        return pointers
+
+    def read(self, pointer):
+        """
+        Reads the payload at pointer.
+        """
+        segment, offset, length = self.parse_pointer(pointer)
+        with open(self._segment_path(segment), 'rb') as f:
+            f.seek(offset)
+            return self.decode(f.read(length))
+
+    def read_many(self, pointers):
+        """
+        Reads payloads at pointers, opening each segment once.
+
+        :returns: (list) payloads, in the order of pointers
+        """
+        parsed = sorted([(self.parse_pointer(p), i) for i, p in enumerate(pointers)])
+        payloads = [None] * len(parsed)
+        f, current = None, None
+        try:
+            for (segment, offset, length), i in parsed:
+                if segment != current:
+                    if f is not None:
+                        f.close()
+                    f, current = open(self._segment_path(segment), 'rb'), segment
+                f.seek(offset)
+                payloads[i] = self.decode(f.read(length))
+        finally:
+            if f is not None:
+                f.close()
+        return payloads
+
+    @property
+    def index(self):
+        """
+        Mapping of key to pointer for payloads appended with a key. Only lines added since the last call are parsed.
+        """
+        path = self.location / self.index_name
+        if path.exists() and path.stat().st_size > self._index_size:
+            with open(path, 'r') as f:
+                f.seek(self._index_size)
+                for line in f:
+                    key, pointer = line.rstrip('\n').split('\t')
+                    self._index[key] = pointer
+                self._index_size = f.tell()
+        return self._index
+
+    def read_key(self, key):
+        """
+        Reads the payload appended with key.
+        """
+        return self.read(self.index[key])
+
+
+class Pointer(str):
+    """
+    Pointer to a payload already in a PackedEventStore. PackedJsonAdapter.put stores a Pointer as is.
+    """
+
+
+class PackedJsonAdapter(Adapter):
+    """
+    DataJoint adapter for payloads kept in a PackedEventStore.
+        put appends the payload and stores its pointer in the table; get reads the payload back from the pointer.
+        Payloads of a batch insert can be appended at once with `put_many` and their Pointers inserted.
+    """
+    def __init__(self, attribute_type, store):
+        self.store = store
+        super().__init__(attribute_type)
+
+    def put(self, payload):
+        if payload is None or isinstance(payload, Pointer):
+            return payload
+        return self.store.append(payload)
+
+    def put_many(self, payloads, keys=None):
+        """
+        Appends payloads under a single lock (see PackedEventStore.append_many).
+
+        :returns: (list) Pointer for each payload, None for payloads that are None
+        """
+        inds = [i for i, payload in enumerate(payloads) if payload is not None]
+        pointers = self.store.append_many([payloads[i] for i in inds], keys=None if keys is None else [keys[i] for i in inds])
+        result = [None] * len(payloads)
+        for i, pointer in zip(inds, pointers):
+            result[i] = Pointer(pointer)
+        return result
+
+    def get(self, pointer):
+        return self.store.read(pointer)
+
+
+def pack_json_files(source, store, pattern='*.json', batch_size=1000):
+    """
+    Copies existing JSON event files into a PackedEventStore, keyed by their stem (the event_id) in the store index.
+        Files whose key is already in the index are skipped, so packing can be resumed. 
+        Event tables are not changed and keep reading the JSON files (see the module docstring for the cut-over).
+
+    :param source: directory with JSON files
+    :param store: (PackedEventStore) destination store
+    :param pattern: (str) glob pattern of files to pack
+    :param batch_size: (int) number of files appended per lock
+
+    :returns: (dict) mapping of event_id to pointer for the files packed in this call
+    """
+    done = store.index
+    packed = {}
+    batch = []
+
+    def flush():
+        keys = [p.stem for p in batch]
+        payloads = []
+        for path in batch:
+            with open(path, 'r') as f:
+                payloads.append(json.load(f))
+        packed.update(zip(keys, store.append_many(payloads, keys=keys)))
+        batch.clear()
+
+    for path in sorted(Path(source).glob(pattern)):
+        if path.stem in done:
+            continue
+        batch.append(path)
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    return packed
+
+
+def _checksum(payload):
+    return hashlib.sha1(json.dumps(payload, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+def verify_json_files(source, store, event_ids=None, pattern='*.json', batch_size=1000):
+    """
+    Compares JSON event files with their packed copies by count and payload checksum.
+
+    :param source: directory with JSON files
+    :param store: (PackedEventStore) store the files were packed into
+    :param event_ids: (iterable) event_ids referenced by the event tables. Defaults to the stems of the files.
+    :param pattern: (str) glob pattern of the files
+    :param batch_size: (int) number of packed payloads read at once
+
+    :returns: (dict)
+        n_referenced: number of event_ids
+        n_packed: number of event_ids with a JSON file and a packed copy
+        missing: event_ids without a JSON file or a packed copy
+        mismatched: event_ids whose packed copy differs from the JSON file
+        ok: True if no event_id is missing or mismatched
+    """
+    files = {path.stem: path for path in Path(source).glob(pattern)}
+    referenced = sorted(files if event_ids is None else set(event_ids))
+    index = store.index
+    result = {'n_referenced': len(referenced), 'n_packed': 0, 'missing': [], 'mismatched': []}
+    for i in range(0, len(referenced), batch_size):
+        batch = referenced[i:i + batch_size]
+        packed = [key for key in batch if key in index and key in files]
+        result['missing'].extend([key for key in batch if key not in index or key not in files])
+        for key, payload in zip(packed, store.read_many([index[key] for key in packed])):
+            with open(files[key], 'r') as f:
+                if _checksum(json.load(f)) != _checksum(payload):
+                    result['mismatched'].append(key)
+        result['n_packed'] += len(packed)
+    result['ok'] = not result['missing'] and not result['mismatched']
+    return result
+
+
+def copy_event_rows(source, destination, store, batch_size=1000):
+    """
+    Copies the rows of an event part table into the same part declared with the packed store (step 3 of the cut-over),
+        storing the packed copy of each payload as its data pointer. Rows already in destination are skipped.
+
+    :param source: event part table of the old schema, e.g. a dj.FreeTable
+    :param destination: event part table declared with event_store = "packed", e.g. db.Event.UserAccess
+    :param store: (PackedEventStore) store the payloads of source were packed into
+    :param batch_size: (int) number of rows inserted at once
+
+    :returns: (int) number of rows copied
+    """
+    index = store.index
+    has_data = set((source & 'data IS NOT NULL').fetch('event_id'))
+    unpacked = sorted(has_data - set(index))
+    assert not unpacked, f'{len(unpacked)} events of {source.full_table_name} have no packed copy, e.g. {unpacked[0]}.'
+    attrs = [a for a in source.heading.names if a != 'data']
+    rows = (source - destination.proj()).fetch(*attrs, as_dict=True, order_by='event_id')
+    for row in rows:
+        row['data'] = Pointer(index[row['event_id']]) if row['event_id'] in has_data else None
+    for i in range(0, len(rows), batch_size):
+        destination.insert(
+            rows[i:i + batch_size], ignore_extra_fields=True, skip_duplicates=True, skip_hashing=True,
+            insert_to_master=True, insert_to_master_kws={'ignore_extra_fields': True, 'skip_duplicates': True}
+        )
+    return len(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Copy JSON event files into a PackedEventStore and verify the copies. Event tables are not changed.')
+    parser.add_argument('source', help='directory with JSON event files')
+    parser.add_argument('destination', help='PackedEventStore directory')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--tables', action='store_true', help='verify the events referenced by the event tables instead of the files in source')
+    args = parser.parse_args()
+    store = PackedEventStore(args.destination)
+    packed = pack_json_files(args.source, store, batch_size=args.batch_size)
+    print(f'Packed {len(packed)} files.')
+    event_ids = None
+    if args.tables:
+        from .schemas import dashboard as db
+
+        event_ids = [i for part in db.Event.parts(as_cls=True) for i in (part & 'data IS NOT NULL').fetch('event_id')]
+    result = verify_json_files(args.source, store, event_ids=event_ids, batch_size=args.batch_size)
+    print(f"Verified {result['n_packed']} of {result['n_referenced']} events: {len(result['missing'])} missing, {len(result['mismatched'])} mismatched.")
+    for key in result['missing'][:10] + result['mismatched'][:10]:
+        print(key)
+    sys.exit(0 if result['ok'] else 1)
@@ -0,0 +1,88 @@
+"""
+Automatic check out of users who are still checked in past a cutoff. Each sweep also prunes expired idempotency keys
+    (see EventKey.prune).
+
+Safe to run from cron on several hosts at once; only the host that holds the sweeper lock does any work.
+
+    python -m microns_dashboard_api.sweeper --hours 12
+"""
+import argparse
+from datetime import timedelta
+
+import datajoint_plus as djp
+from microns_utils.datetime_utils import current_timestamp
+
+from .connections import named_lock
+from .notifications import SlackDispatcher
+from .schemas import dashboard as db
+
+logger = djp.getLogger(__name__)
+
+lock_name = 'microns_dashboard_api.sweeper'
+
+
+def find_checked_in(hours=12., now=None):
+    """
+    Returns the users whose last check in event is a check in that happened more than `hours` ago. Runs as a single query.
+
+    :param hours: (float) cutoff in hours
+    :param now: (datetime) current time in US/Central. Defaults to the current time.
+
+    :returns: (list) dicts with "user" and "last" (timestamp of the check in), ordered by user
+    """
+    now = current_timestamp('US/Central') if now is None else now
+    cutoff = (now - timedelta(hours=hours)).strftime('%Y-%m-%d %H:%M:%S')
+    last = djp.U('user').aggr(db.Event.UserCheckIn, last='max(timestamp)')
+    latest = (db.Event.UserCheckIn * last) & 'timestamp = last'
+    # a check out with the same timestamp as the last check in wins
+    checked_out = djp.U('user') & (latest & 'check_in = 0')
+    return ((djp.U('user', 'last') & (latest & 'check_in = 1' & f'last < "{cutoff}"')) - checked_out).fetch(as_dict=True, order_by='user')
+
+
+def sweep(hours=12., dry_run=False, lock_timeout=0, notifier=None, flush_timeout=None, now=None, key_retention=None):
+    """
+    Logs an automatic check out (data {"auto": True}) for every user returned by `find_checked_in`, in one batch.
+
+    :param hours: (float) cutoff in hours
+    :param dry_run: (bool) if True, users are found but not checked out
+    :param lock_timeout: (float) seconds to wait for the sweeper lock held by another host
+    :param notifier: (SlackDispatcher) used for the check out notifications instead of the dashboard's slack_notifier, 
+        e.g. one with a rate limit
+    :param flush_timeout: (float) maximum seconds to wait for notifications to be sent. If None, waits until sent.
+    :param now: (datetime) current time in US/Central. Defaults to the current time.
+    :param key_retention: (float) seconds idempotency keys are kept. Defaults to EventKey.retention.
+
+    :returns: (dict) "locked" (True if another host holds the lock), "users" found, "checked_out" and "pruned_keys"
+    """
+    with named_lock(lock_name, timeout=lock_timeout) as acquired:
+        if not acquired:
+            logger.info('Sweeper lock is held by another session. Skipping.')
+            return {'locked': True, 'users': [], 'checked_out': 0, 'pruned_keys': 0}
+        pruned_keys = 0 if dry_run else db.EventKey.prune(retention=key_retention)
+        users = [row['user'] for row in find_checked_in(hours=hours, now=now)]
+        logger.info('%d user(s) checked in for more than %s hours.', len(users), hours)
+        if dry_run or not users:
+            return {'locked': False, 'users': users, 'checked_out': 0, 'pruned_keys': pruned_keys}
+
+        notifier = db.slack_notifier if notifier is None else notifier
+        db.Event.log_events([{'event': 'user_check_in', 'attrs': {'user': user, 'check_in': 0}, 'data': {'auto': True}} for user in users], notifier=notifier)
+
+    notifier.flush(timeout=flush_timeout)
+    return {'locked': False, 'users': users, 'checked_out': len(users), 'pruned_keys': pruned_keys}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Automatically check out users who are still checked in past a cutoff.')
+    parser.add_argument('--hours', type=float, default=12., help='check out users checked in for more than this many hours')
+    parser.add_argument('--dry-run', action='store_true', help='list the users without checking them out')
+    parser.add_argument('--lock-timeout', type=float, default=0., help='seconds to wait for a sweep running on another host')
+    parser.add_argument('--rate', type=float, default=10., help='maximum Slack posts per second, in total')
+    parser.add_argument('--flush-timeout', type=float, default=None, help='maximum seconds to wait for Slack notifications')
+    parser.add_argument('--key-retention', type=float, default=None, help='seconds idempotency keys are kept')
+    args = parser.parse_args()
+    notifier = SlackDispatcher(db.slack_client, maxsize=10000, total_rate=args.rate, block=True, drain_on_exit=False)
+    result = sweep(hours=args.hours, dry_run=args.dry_run, lock_timeout=args.lock_timeout, notifier=notifier, flush_timeout=args.flush_timeout, key_retention=args.key_retention)
+    if result['locked']:
+        print('Another sweep is running.')
+    else:
+        print(f"{'Found' if args.dry_run else 'Checked out'} {len(result['users'])} user(s): {', '.join(result['users'])}")
@@ -0,0 +1,230 @@
+"""
+Timing spans for the event -> handler -> maker pipeline.
+
+Usage:
+```python
+from microns_dashboard_api.tracing import tracer, InMemoryCollector
+
+collector = InMemoryCollector()
+tracer.enable(collector)
+db.Event.log_event('user_access', {'user': 'user'})
+tracer.summary(collector.spans)
+```
+"""
+import functools
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+class Span:
+    """
+    Timing of one pipeline stage. db_queries and db_s include queries made by nested spans.
+    """
+    def __init__(self, stage, event_id=None, event_type=None, parent=None):
+        self.stage = stage
+        self.event_id = event_id if event_id is not None or parent is None else parent.event_id
+        self.event_type = event_type if event_type is not None or parent is None else parent.event_type
+        self.parent = parent
+        self.start = time.time()
+        self.duration_s = None
+        self.db_queries = 0
+        self.db_s = 0.
+        self.external = {}
+        self.n_events = 1
+        self.error = None
+
+    def to_dict(self):
+        return {
+            'stage': self.stage,
+            'event_id': self.event_id,
+            'event_type': self.event_type,
+            'parent': None if self.parent is None else self.parent.stage,
+            'start': self.start,
+            'duration_s': self.duration_s,
+            'db_queries': self.db_queries,
+            'db_s': self.db_s,
+            'external': self.external,
+            'external_s': sum(self.external.values()),
+            'n_events': self.n_events,
+            'error': self.error,
+        }
+
+
+class InMemoryCollector:
+    """
+    Keeps the most recent spans in memory.
+    """
+    def __init__(self, maxlen=100000):
+        self._spans = deque(maxlen=maxlen)
+
+    def collect(self, span):
+        self._spans.append(span.to_dict())
+
+    @property
+    def spans(self):
+        return list(self._spans)
+
+    def clear(self):
+        self._spans.clear()
+
+
+class FileCollector:
+    """
+    Appends spans to a local file as JSON lines.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+
+    def collect(self, span):
+        line = json.dumps(span.to_dict(), default=str) + '\n'
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(line)
+
+    @property
+    def spans(self):
+        if not self.path.exists():
+            return []
+        with open(self.path, 'r') as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+
+class Tracer:
+    """
+    Records a Span for each traced stage. Disabled until `enable` is called, in which case `span` is a no-op.
+
+    While enabled, DataJoint queries made inside a span are counted and timed,
+        and calls wrapped with `external` (e.g. Slack) are timed.
+    """
+    def __init__(self):
+        self.collector = None
+        self._local = threading.local()
+
+    @property
+    def enabled(self):
+        return self.collector is not None
+
+    def enable(self, collector=None):
+        """
+        :param collector: object with a `collect(span)` method. Defaults to an InMemoryCollector.
+
+        :returns: collector
+        """
+        self.collector = InMemoryCollector() if collector is None else collector
+        _install_query_hook(self)
+        return self.collector
+
+    def disable(self):
+        self.collector = None
+
+    @property
+    def active_spans(self):
+        if not hasattr(self._local, 'spans'):
+            self._local.spans = []
+        return self._local.spans
+
+    @property
+    def current(self):
+        spans = self.active_spans
+        return spans[-1] if spans else None
+
+    @contextmanager
+    def span(self, stage, event_id=None, event_type=None):
+        """
+        Times the enclosed block as stage. event_id and event_type default to those of the enclosing span
+            and can be set on the yielded span once known.
+        """
+        if not self.enabled:
+            yield Span(stage, event_id=event_id, event_type=event_type)
+            return
+        span = Span(stage, event_id=event_id, event_type=event_type, parent=self.current)
+        self.active_spans.append(span)
+        start = time.perf_counter()
+        try:
+            yield span
+        except Exception as e:
+            span.error = repr(e)
+            raise
+        finally:
+            span.duration_s = time.perf_counter() - start
+            self.active_spans.remove(span)
+            if self.collector is not None:
+                self.collector.collect(span)
+
+    @contextmanager
+    def external(self, name):
+        """
+        Times the enclosed external call (e.g. a Slack API request) in every active span.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            for span in self.active_spans:
+                span.external[name] = span.external.get(name, 0.) + elapsed
+
+    def record_query(self, elapsed):
+        for span in self.active_spans:
+            span.db_queries += 1
+            span.db_s += elapsed
+
+    @staticmethod
+    def summary(spans, by=('stage', 'event_type')):
+        """
+        Latency percentiles of spans.
+
+        :param spans: (list) span dictionaries, e.g. collector.spans
+        :param by: (tuple) span fields to group by. Use ('stage',) for a per-stage summary.
+
+        :returns: (pd.DataFrame) n, p50/p95/p99 duration in ms, mean db queries and mean external call ms per group
+        """
+        df = pd.DataFrame(spans, columns=list(Span('').to_dict().keys()))
+        df['event_type'] = df['event_type'].fillna('')
+        rows = []
+        for group, g in df.groupby(list(by), sort=True):
+            durations = 1000 * g['duration_s'].to_numpy(dtype=float)
+            p50, p95, p99 = np.percentile(durations, [50, 95, 99])
+            row = dict(zip(by, group if isinstance(group, tuple) else (group,)))
+            row.update({
+                'n': len(g),
+                'p50_ms': p50,
+                'p95_ms': p95,
+                'p99_ms': p99,
+                'mean_db_queries': g['db_queries'].mean(),
+                'mean_external_ms': 1000 * g['external_s'].mean(),
+            })
+            rows.append(row)
+        return pd.DataFrame(rows)
+
+
+def _install_query_hook(tracer):
+    import datajoint as dj
+
+    if getattr(dj.Connection.query, 'is_traced', False):
+        return
+    query = dj.Connection.query
+
+    @functools.wraps(query)
+    def traced_query(self, *args, **kwargs):
+        if not tracer.active_spans:
+            return query(self, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return query(self, *args, **kwargs)
+        finally:
+            tracer.record_query(time.perf_counter() - start)
+
+    traced_query.is_traced = True
+    dj.Connection.query = traced_query
+
+
+tracer = Tracer()
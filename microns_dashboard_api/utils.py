@@ -1,3 +1,6 @@
+import importlib.util
+import sys
+
 from traitlets import Unicode, Dict, Unicode
 from ipywidgets import DOMWidget, register
 import wridgets.app as wra
@@ -65,3 +68,62 @@ class GetDashboardUser(DOMWidget):
     value = Dict({}, help="User info").tag(sync=True)
     name = Unicode('').tag(sync=True)
 
+
+def lazy_import(name):
+    """
+    Imports a module without executing it. The module is executed on first attribute access.
+        If the module was already imported, it is returned as is.
+
+    :param name: (str) absolute module name
+
+    :returns: module
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def keyset_restriction(attrs, cursor):
+    """
+    Builds a restriction that selects rows strictly after cursor, in ascending order of attrs.
+
+    :param attrs: (list) attributes that define the ordering, typically the primary key
+    :param cursor: (dict) values of attrs for the last row already seen
+
+    :returns: (str) restriction of the form "(`a`, `b`) > ('x', 'y')"
+    """
+    from pymysql.converters import escape_item
+    names = ', '.join([f'`{a}`' for a in attrs])
+    values = ', '.join([escape_item(cursor[a], 'utf8') for a in attrs])
+    return f'({names}) > ({values})'
+
+
+def fetch_chunks(query, attrs=None, chunk_size=1000, cursor=None):
+    """
+    Fetches query in chunks ordered by its primary key, using keyset pagination so every chunk is a cheap indexed query.
+
+    :param query: DataJoint query expression
+    :param attrs: (list) secondary attributes to include. The primary key is always included. If None, all attributes are included.
+    :param chunk_size: (int) maximum number of rows per chunk
+    :param cursor: (dict) primary key of the last row already seen. If provided, starts after this row.
+
+    :yields: (list) rows as dictionaries
+    """
+    primary_key = query.primary_key
+    if attrs is not None:
+        query = query.proj(*[a for a in attrs if a not in primary_key])
+    while True:
+        restr = {} if cursor is None else keyset_restriction(primary_key, cursor)
+        rows = (query & restr).fetch(as_dict=True, order_by=primary_key, limit=chunk_size)
+        if len(rows) == 0:
+            return
+        yield rows
+        if len(rows) < chunk_size:
+            return
+        cursor = {k: rows[-1][k] for k in primary_key}
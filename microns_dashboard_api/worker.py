@@ -0,0 +1,139 @@
+"""
+Worker that handles events recorded in the Outbox (event_processing = "outbox", see config).
+
+Each worker process claims batches of pending events and runs the `on_events` (or `on_event`) side effects of their
+    part tables: User.Add and User.AddInfo populates, Slack lookups and posts. Failed events are retried with
+    exponential backoff and dead-lettered after max_attempts. Events claimed by a worker that died are released after
+    the lease expires, so work resumes after crashes; an event whose lease expires max_attempts times is dead-lettered.
+    Done events are pruned after the retention period. Side effects run at least once; populates are idempotent but a
+    retried event may post to Slack again.
+
+    python -m microns_dashboard_api.worker --processes 4
+    python -m microns_dashboard_api.worker --once        # drain the outbox and exit
+"""
+import argparse
+import multiprocessing
+import os
+import socket
+import time
+import uuid
+
+import datajoint_plus as djp
+from microns_utils.misc_utils import wrap
+
+from .schemas import dashboard as db
+
+logger = djp.getLogger(__name__)
+
+
+def _handle(part, events):
+    if hasattr(part, 'on_events'):
+        part().on_events(events=events)
+    else:
+        for event in events:
+            part().on_event(event=event)
+
+
+def process_batch(events, max_attempts=5, backoff=30., flush_timeout=60.):
+    """
+    Runs the side effects of claimed events, one call to `on_events` per part table.
+        If a batch fails, its events are run one by one so that only the failing events are retried.
+
+    :param flush_timeout: (float) maximum seconds to wait for the Slack posts of the batch. Must be shorter than the
+        lease, otherwise events of a worker stuck on Slack are released and processed again.
+
+    :returns: (dict) number of events done and failed
+    """
+    parts = {}
+    for part in db.Event.parts(as_cls=True):
+        for name in wrap(part.events):
+            parts[name] = part
+    batches = {}
+    for event in events:
+        batches.setdefault(parts[event.name], []).append(event)
+
+    stats = {'done': 0, 'failed': 0}
+    for part, part_events in batches.items():
+        try:
+            _handle(part, part_events)
+            done = part_events
+        except Exception:
+            logger.exception('Error handling %d %s events. Retrying one by one.', len(part_events), part.class_name)
+            done = []
+            for event in part_events:
+                try:
+                    _handle(part, [event])
+                    done.append(event)
+                except Exception as e:
+                    logger.exception('Error handling event %s.', event.id)
+                    db.Outbox.fail(event.id, repr(e), max_attempts=max_attempts, backoff=backoff)
+                    stats['failed'] += 1
+        db.Outbox.complete([e.id for e in done])
+        stats['done'] += len(done)
+    db.slack_notifier.flush(timeout=flush_timeout)
+    return stats
+
+
+def work(batch_size=100, poll_interval=1., max_attempts=5, backoff=30., lease=600., retention=7 * 24 * 3600., prune_interval=3600., once=False):
+    """
+    Claims and processes outbox events until stopped, or until the outbox is drained if once=True.
+
+    :param batch_size: (int) maximum number of events claimed at once
+    :param poll_interval: (float) seconds to wait when there are no pending events
+    :param max_attempts: (int) number of attempts after which an event is dead-lettered
+    :param backoff: (float) seconds before the first retry; doubled after each failed attempt
+    :param lease: (float) seconds after which events claimed by a worker are considered abandoned
+    :param retention: (float) seconds after which done events are deleted from the outbox
+    :param prune_interval: (float) seconds between prunes of done events
+
+    :returns: (dict) number of events done and failed
+    """
+    prefix = f'{socket.gethostname()[:40]}:{os.getpid()}'
+    stats = {'done': 0, 'failed': 0}
+    pruned_at = None
+    while True:
+        if db.Outbox.release_expired(lease=lease, max_attempts=max_attempts):
+            logger.warning('Released events of workers that did not finish within %s seconds.', lease)
+        if pruned_at is None or time.monotonic() - pruned_at >= prune_interval:
+            pruned_at = time.monotonic()
+            logger.info('Pruned %d done events from the outbox.', db.Outbox.prune(retention=retention))
+        events = db.Outbox.claim(f'{prefix}:{uuid.uuid4().hex[:8]}', limit=batch_size)
+        if events:
+            for k, v in process_batch(events, max_attempts=max_attempts, backoff=backoff, flush_timeout=lease / 2).items():
+                stats[k] += v
+        elif once:
+            return stats
+        else:
+            time.sleep(poll_interval)
+
+
+def _work(kwargs):
+    return work(**kwargs)
+
+
+def serve(processes=1, **kwargs):
+    """
+    Runs `work` in processes worker processes. Each forked worker reconnects the schema connection, so workers do not
+        share the socket of the parent, which may have loaded the schema before serve was called. See `work` for kwargs.
+
+    :returns: (dict) number of events done and failed, summed over processes
+    """
+    if processes == 1:
+        return work(**kwargs)
+    with multiprocessing.get_context('fork').Pool(processes=processes, initializer=db._reset_connection) as pool:
+        results = pool.map(_work, [kwargs] * processes)
+    return {k: sum([r[k] for r in results]) for k in ['done', 'failed']}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Process events recorded in the dashboard outbox.')
+    parser.add_argument('--processes', type=int, default=1, help='number of worker processes')
+    parser.add_argument('--batch-size', type=int, default=100, help='maximum number of events claimed at once per process')
+    parser.add_argument('--poll-interval', type=float, default=1., help='seconds to wait when the outbox is empty')
+    parser.add_argument('--max-attempts', type=int, default=5, help='attempts after which an event is dead-lettered')
+    parser.add_argument('--backoff', type=float, default=30., help='seconds before the first retry; doubled after each attempt')
+    parser.add_argument('--lease', type=float, default=600., help='seconds after which claimed events are released')
+    parser.add_argument('--retention', type=float, default=7 * 24 * 3600., help='seconds after which done events are deleted')
+    parser.add_argument('--once', action='store_true', help='drain the outbox and exit')
+    args = parser.parse_args()
+    print(serve(**vars(args)))
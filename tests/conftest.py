@@ -0,0 +1,55 @@
+import pytest
+
+
+@pytest.fixture
+def database():
+    """
+    Skips the test unless datajoint_plus is importable and the database of dj.config can be reached.
+    """
+    import datajoint as dj
+
+    try:
+        import datajoint_plus
+    except ImportError as e:
+        pytest.skip(f'datajoint_plus not available: {e!r}')
+    if dj.config['database.user'] is None:
+        pytest.skip('database credentials not configured')
+    try:
+        return dj.conn()
+    except Exception as e:
+        pytest.skip(f'database not available: {e!r}')
+
+
+class SlackClient:
+    """
+    Stand-in for SlackForWidget that records messages instead of posting them.
+    """
+    default_channel = '#microns-dashboard'
+
+    def __init__(self):
+        self.messages = []
+
+    def post_to_slack(self, text, channel=None):
+        self.messages.append((self.default_channel if channel is None else channel, text))
+        return True
+
+    def get_slack_username(self, display_name):
+        return display_name
+
+
+@pytest.fixture
+def db(database, tmp_path_factory, monkeypatch):
+    """
+    Dashboard schema with a local events store and a Slack client that records messages.
+    """
+    import datajoint_plus as djp
+    from microns_dashboard_api.schemas import dashboard as db
+
+    events_dir = tmp_path_factory.mktemp('events')
+    db.Event.basedir = events_dir
+    monkeypatch.setitem(djp.config['stores']['events'], 'location', str(events_dir))
+    client = SlackClient()
+    monkeypatch.setattr(db, 'slack_client', client)
+    monkeypatch.setattr(db.slack_notifier, 'client', client)
+    monkeypatch.setattr(db.slack_notifier, 'rate', None)
+    return db
@@ -0,0 +1,197 @@
+import time
+
+import pytest
+
+pytest.importorskip('wridgets')
+
+from microns_dashboard_api import apps, connections
+from microns_dashboard_api.apps import DataJointLoginApp, ProtocolManager
+from microns_dashboard_api.session import DashboardSession
+
+
+class Connection:
+    is_connected = True
+
+
+@pytest.fixture
+def connect(monkeypatch):
+    """
+    Replaces ConnectionPool.connect of the kernel's pool. Set connect.error to make logins fail.
+    """
+    class Connect:
+        error = None
+        calls = 0
+
+        def __call__(self, host=None, user=None, password=None):
+            self.calls += 1
+            if self.error is not None:
+                raise self.error
+            return Connection()
+
+    stub = Connect()
+    monkeypatch.setattr(connections.connection_pool, 'connect', stub)
+    return stub
+
+
+def login(app, username='user', password='password'):
+    app._username_field.set(value=username)
+    app._password_field.set(value=password)
+    app._on_login()
+
+
+def test_login(connect):
+    logins = []
+    app = DataJointLoginApp(on_login=lambda: logins.append(True))
+    login(app)
+    assert app.wait(timeout=10)
+    assert app.is_connected
+    assert logins == [True]
+
+
+def test_failed_relogin_is_not_connected(connect):
+    logins = []
+    app = DataJointLoginApp(on_login=lambda: logins.append(True))
+    login(app)
+    assert app.wait(timeout=10)
+    connect.error = RuntimeError('Access denied')
+    login(app, password='wrong')
+    assert not app.wait(timeout=10)
+    assert not app.is_connected
+    assert repr(app.login_error) == repr(connect.error)
+    assert logins == [True]
+
+
+def test_asynchronous_login_updates_widgets_on_kernel_loop(connect, monkeypatch):
+    class Loop:
+        def __init__(self):
+            self.callbacks = []
+
+        def add_callback(self, callback, *args):
+            self.callbacks.append((callback, args))
+
+    loop = Loop()
+    monkeypatch.setattr(apps, '_kernel_loop', lambda: loop)
+    logins = []
+    app = DataJointLoginApp(on_login=lambda: logins.append(True))
+    login(app)
+    assert app.wait(timeout=10)
+    # done callbacks run right after the future's waiters are woken
+    deadline = time.monotonic() + 10
+    while not loop.callbacks and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert app._login_button.get1('disabled')
+    assert logins == [] and len(loop.callbacks) == 1
+    callback, args = loop.callbacks.pop()
+    callback(*args)
+    assert app.is_connected
+    assert not app._login_button.get1('disabled')
+    assert logins == [True]
+
+
+class Source:
+    """
+    Stand-in for a protocol source table; rows are returned by the stubbed connection_router.fetch.
+    """
+    def __init__(self, name, restrictions=()):
+        self.full_table_name = f'`test`.`{name}`'
+        self.restrictions = tuple(restrictions)
+
+    def __and__(self, restriction):
+        return Source(self.full_table_name.split('.')[1].strip('`'), self.restrictions + (restriction,))
+
+    def make_sql(self):
+        return ' AND '.join((f'SELECT * FROM {self.full_table_name}',) + self.restrictions)
+
+
+def test_protocol_manager_calls_on_set_protocol_with_session_user(monkeypatch):
+    rows = [{'protocol_id': 'protocol1', 'protocol_name': 'Protocol 1', 'tag': 'v1', 'active': 1, 'ordering': 0}]
+    monkeypatch.setattr(connections.connection_router, 'fetch', lambda query, **kwargs: rows)
+    calls = []
+    manager = ProtocolManager(
+        source=Source(f'protocol_{time.time_ns()}'), 
+        session=DashboardSession.local('alice'), 
+        on_set_protocol=lambda **kwargs: calls.append(kwargs), 
+        on_set_protocol_kws={'mode': 'test'}
+    )
+    manager._set_protocol_button.set(value=True)
+    assert manager.protocol_is_set
+    assert calls == [{'user': 'alice', 'mode': 'test'}]
+
+
+def test_headless_session_shares_session_with_protocol_manager(monkeypatch):
+    from microns_dashboard_api.headless import HeadlessSession
+
+    rows = [{'protocol_id': 'protocol1', 'protocol_name': 'Protocol 1', 'tag': 'v1', 'active': 1, 'ordering': 0}]
+    monkeypatch.setattr(connections.connection_router, 'fetch', lambda query, **kwargs: rows)
+    calls = []
+    session = HeadlessSession(user_info={'user': 'bob'}, protocol_source=Source(f'protocol_{time.time_ns()}'), on_set_protocol=lambda **kwargs: calls.append(kwargs))
+    assert session.protocol_manager.session is session.session
+    session.set_protocol()
+    assert calls == [{'user': 'bob'}]
+
+
+def test_protocol_manager_caches_restrictions_of_a_table_separately(monkeypatch):
+    fetched = []
+    def fetch(query, **kwargs):
+        fetched.append(query.make_sql())
+        return [{'protocol_id': query.restrictions[0], 'protocol_name': query.restrictions[0], 'tag': 'v1', 'active': 1, 'ordering': 0}]
+    monkeypatch.setattr(connections.connection_router, 'fetch', fetch)
+    monkeypatch.setattr(ProtocolManager, '_source_state', lambda self: (1, None))
+    source = Source(f'protocol_{time.time_ns()}')
+    managers = [ProtocolManager(source=source & f'tag = "{tag}"') for tag in ['v1', 'v2']]
+    assert [[p.ID for p in m.active_protocols] for m in managers] == [['tag = "v1"'], ['tag = "v2"']]
+    assert len(fetched) == 2
+    assert [p.ID for p in ProtocolManager(source=source & 'tag = "v1"').active_protocols] == ['tag = "v1"']
+    assert len(fetched) == 2
+
+
+def test_protocol_manager_refetches_cached_rows_when_source_changed(monkeypatch):
+    rows = [{'protocol_id': 'protocol1', 'protocol_name': 'Protocol 1', 'tag': 'v1', 'active': 1, 'ordering': 0, 'last_updated': 1}]
+    fetched = []
+    def fetch(query, **kwargs):
+        fetched.append(query)
+        return [dict(row) for row in rows]
+    monkeypatch.setattr(connections.connection_router, 'fetch', fetch)
+    monkeypatch.setattr(ProtocolManager, '_source_state', lambda self: apps._rows_state(rows))
+    source = Source(f'protocol_{time.time_ns()}')
+    ProtocolManager(source=source)
+    assert [p.ID for p in ProtocolManager(source=source).active_protocols] == ['protocol1']
+    assert len(fetched) == 1
+    # a kernel that does not share the cache activates a protocol; the cached rows are not invalidated
+    rows.append({'protocol_id': 'protocol2', 'protocol_name': 'Protocol 2', 'tag': 'v1', 'active': 1, 'ordering': 1, 'last_updated': 2})
+    assert [p.ID for p in ProtocolManager(source=source).active_protocols] == ['protocol1', 'protocol2']
+    assert len(fetched) == 2
+
+
+def test_user_app_reads_user_info_from_session():
+    session = DashboardSession.local('carol', email='carol@example.com')
+    app = apps.UserApp(session=session)
+    assert app.user == 'carol'
+    assert app.user_info == {'name': 'carol', 'email': 'carol@example.com'}
+    session.set_user_info({'name': 'dave'})
+    assert app.user_info == {'name': 'dave'}
+    assert apps.UserApp(user_info={'user': 'erin'}).user_info == {'user': 'erin'}
+
+
+def test_callbacks_without_user_parameter_still_work(monkeypatch):
+    rows = [{'protocol_id': 'protocol1', 'protocol_name': 'Protocol 1', 'tag': 'v1', 'active': 1, 'ordering': 0}]
+    monkeypatch.setattr(connections.connection_router, 'fetch', lambda query, **kwargs: rows)
+    session = DashboardSession.local('frank')
+    calls = []
+    manager = ProtocolManager(source=Source(f'protocol_{time.time_ns()}'), session=session, on_set_protocol=lambda: calls.append('set'))
+    manager._set_protocol_button.set(value=True)
+    assert calls == ['set']
+
+    class InfoManager(apps.UserInfoManager):
+        def get_data(self):
+            return 'old'
+
+        def set_data(self, data, user=None):
+            calls.append((data, user))
+
+    manager = InfoManager(label='Info', session=session)
+    assert manager.children.Field.get1('value') == 'old'
+    manager.children.ToggleButton.set(value=True)
+    manager.children.Field.set(value='new')
+    manager.children.ToggleButton.set(value=False)
+    assert calls == ['set', ('new', 'frank')]
@@ -0,0 +1,14 @@
+from microns_dashboard_api.cache import MISSING, LocalCache, TTLCache
+
+
+def test_missing_sentinel_tells_missing_keys_from_cached_none():
+    cache, shared = TTLCache(), LocalCache()
+    assert cache.get('user', default=MISSING) is MISSING
+    assert shared.get('users', 'user', default=MISSING) is MISSING
+    cache.set('user', None)
+    shared.set('users', 'user', None)
+    assert cache.get('user', default=MISSING) is None
+    assert shared.get('users', 'user', default=MISSING) is None
+    assert 'user' in cache
+    shared.invalidate('users')
+    assert shared.get('users', 'user', default=MISSING) is MISSING
@@ -0,0 +1,77 @@
+import datajoint as dj
+import pytest
+
+from microns_dashboard_api.connections import ConnectionRouter
+from microns_dashboard_api.tracing import InMemoryCollector, Tracer
+
+
+@pytest.fixture
+def queries(monkeypatch):
+    """
+    Replaces dj.Connection.query with a stub that records the statements and returns them.
+    """
+    statements = []
+    def query(self, sql, args=(), **kwargs):
+        statements.append(sql)
+        return sql
+    monkeypatch.setattr(dj.Connection, 'query', query)
+    return statements
+
+
+def connection():
+    # a dj.Connection that is not connected; dj.Connection defines __eq__ without __hash__
+    return object.__new__(dj.Connection)
+
+
+def test_track_writes_unhashable_connection(queries):
+    router = ConnectionRouter()
+    conn = connection()
+    with pytest.raises(TypeError):
+        hash(conn)
+    assert router.track_writes(conn) is conn
+    tracked = conn.query
+    assert router.track_writes(conn) is conn
+    assert conn.query is tracked
+    assert conn.query('SELECT 1') == 'SELECT 1'
+    assert queries == ['SELECT 1']
+
+
+def test_track_writes_marks_writes(queries):
+    router = ConnectionRouter()
+    conn = router.track_writes(connection())
+    conn.query('  select * from t')
+    conn.query('SHOW TABLES')
+    assert router.last_write is None
+    conn.query('INSERT INTO t VALUES (1)')
+    assert router.last_write is not None
+
+
+def test_track_writes_keeps_class_hooks(queries):
+    router = ConnectionRouter()
+    conn = router.track_writes(connection())
+    tracer = Tracer()
+    tracer.enable(InMemoryCollector())  # installs the query hook on dj.Connection
+    with tracer.span('stage') as span:
+        conn.query('SELECT 1')
+        conn.query('INSERT INTO t VALUES (1)')
+    assert span.db_queries == 2
+    assert queries == ['SELECT 1', 'INSERT INTO t VALUES (1)']
+
+
+def test_read_connection_without_replicas(queries):
+    router = ConnectionRouter()
+    conn = connection()
+    assert router.read_connection(conn) == (None, conn)
+    assert router.stats['primary'] == 1
+
+
+def test_schema_import_with_router(database, monkeypatch):
+    from microns_dashboard_api.connections import connection_router
+
+    host = dj.config['database.host']
+    monkeypatch.setattr(connection_router, 'replicas', [host])
+    from microns_dashboard_api.schemas import dashboard as db
+
+    rows = connection_router.fetch(db.Tag, as_dict=True)
+    assert isinstance(rows, list)
+    assert connection_router.stats['primary'] + connection_router.stats['replica'] > 0
@@ -0,0 +1,112 @@
+import time
+from datetime import timedelta
+
+import pytest
+
+
+def users(name, n):
+    return [f'test_{name}_{time.time_ns()}_{i}' for i in range(n)]
+
+
+def log_user_add(db, monkeypatch, users):
+    # events are logged without populating, as if the populate of another kernel were pending
+    with monkeypatch.context() as m:
+        m.setattr(db.Event.UserAdd, 'on_events', lambda self, events, notifier=None: None)
+        events = db.Event.log_events([{'event': 'user_add', 'attrs': {'user': user}} for user in users])
+    return [{'event_id': e.id} for e in events]
+
+
+def test_populate_batch_skips_made_keys(db, monkeypatch):
+    db.EventHandler.UserEvent.contents
+    keys = log_user_add(db, monkeypatch, users('populate', 4))
+    assert db._populate_batch(db.User.Add, keys[:2]) == {'made': 2, 'skipped': 0, 'failed': 0}
+    # stale keys, e.g. from a lagging replica, include keys that are already made
+    assert db._populate_batch(db.User.Add, keys) == {'made': 2, 'skipped': 2, 'failed': 0}
+    assert len(db.User.Add & keys) == 4
+
+
+def test_bulk_populate_reads_pending_keys_from_primary(db, monkeypatch):
+    db.EventHandler.UserEvent.contents
+    keys = log_user_add(db, monkeypatch, users('bulk_populate', 3))
+    def fetch(*args, **kwargs):
+        raise AssertionError('pending keys must not be read from a replica')
+    monkeypatch.setattr(db.connection_router, 'fetch', fetch)
+    assert db.bulk_populate(db.User.Add, keys, batch_size=2)['made'] == 3
+
+
+def test_bulk_populate_in_worker_processes(db, monkeypatch):
+    db.EventHandler.UserEvent.contents
+    keys = log_user_add(db, monkeypatch, users('bulk_populate_processes', 4))
+    assert db.bulk_populate(db.User.Add, keys, batch_size=1, processes=2) == {'made': 4, 'skipped': 0, 'failed': 0}
+    assert len(db.User.Add & keys) == 4
+    # the parent's connection is not shared with the workers, so it is still usable
+    assert db.schema.connection.query('SELECT 1').fetchone() == (1,)
+
+
+def test_log_events_notifier(db):
+    from microns_dashboard_api.notifications import SlackDispatcher
+
+    client = type(db.slack_client)()
+    notifier = SlackDispatcher(client, drain_on_exit=False)
+    user, = users('notifier', 1)
+    db.Event.log_events([{'event': 'user_check_in', 'attrs': {'user': user, 'check_in': 0}, 'data': {'auto': True}}], notifier=notifier)
+    assert notifier.flush(timeout=10)
+    db.slack_notifier.flush(timeout=10)
+    assert client.messages == [('#microns-dashboard', f'```{user} auto-checked out```')]
+    assert db.slack_client.messages == []
+
+
+def test_update_from_events_applies_tied_and_late_events_once(db, monkeypatch):
+    user, = users('activity', 1)
+    access = {'event': 'user_access', 'attrs': {'user': user}, 'data': {'entry_point': 'test'}}
+    db.Event.log_events([access])
+    db.UserActivity.update_from_events(settle=0)
+    # likely within the second of the new mark
+    db.Event.log_events([access])
+    # an event that commits 10 seconds after its timestamp
+    now = db.current_timestamp('US/Central')
+    with monkeypatch.context() as m:
+        m.setattr(db, 'current_timestamp', lambda *args, **kwargs: now - timedelta(seconds=10))
+        db.Event.log_events([access])
+    time.sleep(1.1)
+    db.UserActivity.update_from_events(settle=0)
+    db.UserActivity.update_from_events(settle=0)
+    n_access, last_access = (db.UserActivity & {'user': user}).fetch1('n_access', 'last_access')
+    assert n_access == 3
+    assert last_access >= (now - timedelta(seconds=1)).replace(tzinfo=None, microsecond=0)
+
+
+def test_log_event_releases_key_of_failed_insert(db, monkeypatch):
+    user, = users('idempotent', 1)
+    key = db.Event.make_idempotency_key('user_access', user)
+    with monkeypatch.context() as m:
+        def insert(*args, **kwargs):
+            raise RuntimeError('insert failed')
+        m.setattr(db.Event.UserAccess, 'insert', insert)
+        with pytest.raises(RuntimeError):
+            db.Event.log_event('user_access', {'user': user}, {'entry_point': 'test'}, idempotency_key=key)
+    assert len(db.EventKey & {'idempotency_key': key}) == 0
+    event = db.Event.log_event('user_access', {'user': user}, {'entry_point': 'test'}, idempotency_key=key)
+    assert db.Event.log_event('user_access', {'user': user}, {'entry_point': 'test'}, idempotency_key=key).id == event.id
+    assert len(db.Event.UserAccess & {'user': user}) == 1
+
+
+def test_prune_idempotency_keys(db):
+    old, recent = [db.Event.make_idempotency_key('user_access', user) for user in users('prune_keys', 2)]
+    assert db.EventKey.reserve(old) and db.EventKey.reserve(recent)
+    db.EventKey.connection.query(
+        f'UPDATE {db.EventKey.full_table_name} SET `reserved` = NOW() - INTERVAL 2 DAY WHERE `idempotency_key` = %s', args=(old,)
+    )
+    assert db.EventKey.prune(retention=24 * 3600, limit=1) >= 1
+    assert len(db.EventKey & {'idempotency_key': old}) == 0
+    assert len(db.EventKey & {'idempotency_key': recent}) == 1
+
+
+def test_log_events_prepares_table_payloads_without_threads(db, monkeypatch):
+    def executor(*args, **kwargs):
+        raise AssertionError('payloads stored in the table must not be prepared in a thread pool')
+    monkeypatch.setattr(db, 'ThreadPoolExecutor', executor)
+    user, = users('inline', 1)
+    db.Event.log_event('user_access', {'user': user}, {'entry_point': 'test'})
+    db.Event.log_events([{'event': 'user_access', 'attrs': {'user': user}, 'data': {'entry_point': 'test'}}] * 2)
+    assert len(db.Event.UserAccess & {'user': user}) == 3
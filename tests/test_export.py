@@ -0,0 +1,39 @@
+import time
+
+import pytest
+
+pytest.importorskip('pyarrow')
+
+
+def exported_ids(path):
+    import pyarrow.parquet as pq
+
+    return [i for f in sorted(path.glob('date=*/*.parquet')) for i in pq.read_table(str(f)).column('event_id').to_pylist()]
+
+
+def test_rerun_of_interrupted_export_does_not_duplicate(db, tmp_path, monkeypatch):
+    from microns_dashboard_api import export
+
+    name = f'test_export_{time.time_ns()}'
+    user = f'{name}_user'
+    access = {'event': 'user_access', 'attrs': {'user': user}, 'data': {'entry_point': 'test'}}
+    db.Event.log_events([access, access])
+    time.sleep(1.1)
+    part = db.Event.UserAccess
+    first = export.export_part(part, tmp_path, settle=0, name=name)
+    db.Event.log_events([access])
+    time.sleep(1.1)
+
+    def interrupted(*args, **kwargs):
+        raise KeyboardInterrupt
+    with monkeypatch.context() as m:
+        m.setattr(db.Watermark, 'advance', interrupted)
+        with pytest.raises(KeyboardInterrupt):
+            export.export_part(part, tmp_path, settle=0, name=name)
+    export.export_part(part, tmp_path, settle=0, name=name)
+    assert export.export_part(part, tmp_path, settle=0, name=name)['n_events'] == 0
+
+    ids = exported_ids(tmp_path / part.class_name)
+    assert len(ids) == len(set(ids))
+    assert set((part & {'user': user}).fetch('event_id')) <= set(ids)
+    assert first['n_events'] >= 2
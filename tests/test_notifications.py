@@ -0,0 +1,162 @@
+import time
+
+import pytest
+
+from microns_dashboard_api import notifications
+from microns_dashboard_api.notifications import SlackDispatcher, TokenBucket
+
+
+class Response(dict):
+    def __init__(self, status_code, error=None, headers=None):
+        super().__init__(ok=False, error=error)
+        self.status_code = status_code
+        self.headers = {} if headers is None else headers
+
+
+class SlackApiError(Exception):
+    def __init__(self, response):
+        super().__init__(response['error'])
+        self.response = response
+
+
+class Client:
+    """
+    Stand-in for a slack WebClient. Raises the given errors on the first posts, then records the posts.
+    """
+    default_channel = '#channel'
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.attempts = 0
+        self.messages = []
+
+    def post_to_slack(self, text, channel=None):
+        raise AssertionError('WebClients are posted to with chat_postMessage')
+
+    def chat_postMessage(self, channel, text):
+        self.attempts += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        self.messages.append((channel, text))
+
+
+class LocalClient:
+    default_channel = '#channel'
+
+    def __init__(self, ok=True):
+        self.ok = ok
+        self.messages = []
+
+    def post_to_slack(self, text, channel=None):
+        self.messages.append((channel, text))
+        return self.ok
+
+
+def dispatcher(client, **kwargs):
+    return SlackDispatcher(client, drain_on_exit=False, **kwargs)
+
+
+def test_digest():
+    client = LocalClient()
+    notifier = dispatcher(client, digest_window=60)
+    for user in ['a', 'b', 'c']:
+        notifier.post_to_slack(f'{user} accessed the dashboard', digest=('users accessed the dashboard', user))
+    notifier.post_to_slack('you accessed the dashboard', channel='@a', digest=('users accessed the dashboard', 'a'))
+    assert notifier.flush(timeout=10)
+    assert sorted(client.messages) == [
+        ('#channel', '```3 users accessed the dashboard: a, b, c```'),
+        ('@a', 'you accessed the dashboard'),
+    ]
+    assert notifier.stats['digested'] == 3
+
+
+def test_rate_limited_post_waits_for_retry_after():
+    client = Client(SlackApiError(Response(429, 'ratelimited', {'Retry-After': '0.01'})))
+    notifier = dispatcher(client, backoff=60.)
+    notifier.post_to_slack('message')
+    assert notifier.flush(timeout=10)
+    assert client.messages == [('#channel', 'message')]
+    assert notifier.stats['retried'] == 1
+    assert notifier.stats['sent'] == 1
+
+
+def test_rate_limited_channel_does_not_block_other_channels():
+    client = Client(SlackApiError(Response(429, 'ratelimited', {'Retry-After': '1'})))
+    notifier = dispatcher(client)
+    notifier.post_to_slack('a', channel='#a')
+    notifier.post_to_slack('b', channel='#b')
+    deadline = time.monotonic() + 0.5
+    while ('#b', 'b') not in client.messages and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert client.messages == [('#b', 'b')]
+    assert notifier.flush(timeout=10)
+    assert client.messages == [('#b', 'b'), ('#a', 'a')]
+
+
+def test_server_error_is_retried():
+    client = Client(SlackApiError(Response(503, 'service_unavailable')), ConnectionError('reset'))
+    notifier = dispatcher(client, backoff=0.01)
+    notifier.post_to_slack('message')
+    assert notifier.flush(timeout=10)
+    assert client.attempts == 3
+    assert notifier.stats['retried'] == 2
+    assert notifier.stats['sent'] == 1
+
+
+def test_retries_are_limited():
+    client = Client(*[SlackApiError(Response(500, 'internal_error')) for _ in range(5)])
+    notifier = dispatcher(client, backoff=0.01, max_retries=2)
+    notifier.post_to_slack('message')
+    assert notifier.flush(timeout=10)
+    assert client.attempts == 3
+    assert notifier.stats['failed'] == 1
+
+
+@pytest.mark.parametrize('error', ['channel_not_found', 'invalid_auth', 'not_in_channel'])
+def test_permanent_error_is_dropped(error):
+    client = Client(SlackApiError(Response(200, error)))
+    notifier = dispatcher(client, backoff=60.)
+    notifier.post_to_slack('message', channel='@nobody')
+    assert notifier.flush(timeout=10)
+    assert client.attempts == 1
+    assert notifier.stats['retried'] == 0
+    assert notifier.stats['failed'] == 1
+
+
+def test_failed_post_without_error_is_dropped():
+    client = LocalClient(ok=False)
+    notifier = dispatcher(client, backoff=60.)
+    notifier.post_to_slack('message')
+    assert notifier.flush(timeout=10)
+    assert len(client.messages) == 1
+    assert notifier.stats['failed'] == 1
+
+
+def test_direct_message_without_username_is_skipped():
+    client = LocalClient()
+    notifier = dispatcher(client)
+    assert not notifier.send_direct_message('message', None)
+    assert notifier.send_direct_message('message', 'user')
+    assert notifier.flush(timeout=10)
+    assert client.messages == [('@user', 'message')]
+
+
+def test_drain_on_exit_is_registered_once_and_unregistered_on_shutdown(monkeypatch):
+    registered = []
+    monkeypatch.setattr(notifications.atexit, 'register', registered.append)
+    monkeypatch.setattr(notifications.atexit, 'unregister', registered.remove)
+    notifier = SlackDispatcher(LocalClient(), drain_on_exit=True)
+    assert registered == []
+    notifier.post_to_slack('a')
+    notifier.post_to_slack('b')
+    assert registered == [notifier._drain]
+    assert notifier.shutdown(timeout=10)
+    assert registered == []
+
+
+@pytest.mark.parametrize('kwargs', [{'rate': 0}, {'total_rate': 0}])
+def test_zero_rate_is_rejected(kwargs):
+    with pytest.raises(AssertionError):
+        dispatcher(LocalClient(), **kwargs)
+    with pytest.raises(AssertionError):
+        TokenBucket(0)
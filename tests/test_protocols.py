@@ -0,0 +1,86 @@
+from contextlib import contextmanager
+
+import pytest
+
+from microns_dashboard_api import protocols
+
+
+class Cursor:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+
+class Connection:
+    """
+    Records statements; GET_LOCK succeeds unless locked=True.
+    """
+    def __init__(self, rows, locked=False):
+        self.rows = rows
+        self.locked = locked
+        self.statements = []
+
+    @property
+    @contextmanager
+    def transaction(self):
+        self.statements.append('BEGIN')
+        yield
+        self.statements.append('COMMIT')
+
+    def query(self, sql, args=()):
+        self.statements.append(sql)
+        if sql.startswith('SELECT GET_LOCK'):
+            return Cursor([(0 if self.locked else 1,)])
+        if 'MAX(`ordering`)' in sql:
+            return Cursor([(max([o for a, o in self.rows.values() if a == 1 and o is not None], default=-1) + 1,)])
+        if sql.startswith('SELECT `active`'):
+            return Cursor([self.rows[args[0]]] if args[0] in self.rows else [])
+        if sql.startswith('UPDATE'):
+            self.rows[args[-1]] = (1, args[0]) if '`active` = 1' in sql else (0, None)
+        return Cursor([])
+
+
+class Heading:
+    names = ['protocol_id', 'active', 'ordering']
+
+
+class Source:
+    full_table_name = '`schema`.`protocol`'
+    heading = Heading()
+
+    def __init__(self, connection):
+        self.connection = connection
+
+
+def test_activate_holds_lock_around_transaction():
+    source = Source(Connection({'a': (1, 0), 'b': (0, None)}))
+    assert protocols.activate_protocol(source, 'b') == 1
+    statements = source.connection.statements
+    assert statements[0].startswith('SELECT GET_LOCK')
+    assert statements[1] == 'BEGIN'
+    assert statements[-2] == 'COMMIT'
+    assert statements[-1].startswith('SELECT RELEASE_LOCK')
+
+
+def test_activate_active_protocol_keeps_ordering():
+    source = Source(Connection({'a': (1, 3)}))
+    assert protocols.activate_protocol(source, 'a') == 3
+
+
+def test_lock_timeout():
+    source = Source(Connection({'a': (0, None)}, locked=True))
+    with pytest.raises(TimeoutError):
+        protocols.activate_protocol(source, 'a')
+    assert 'BEGIN' not in source.connection.statements
+
+
+def test_deactivate_missing_protocol():
+    source = Source(Connection({}))
+    with pytest.raises(KeyError):
+        protocols.deactivate_protocol(source, 'a')
+    assert source.connection.statements[-1].startswith('SELECT RELEASE_LOCK')
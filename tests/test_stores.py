@@ -0,0 +1,62 @@
+import json
+
+import pytest
+
+pytest.importorskip('microns_utils.adapter_utils')
+
+from microns_dashboard_api.stores import PackedEventStore, PackedJsonAdapter, Pointer, pack_json_files, verify_json_files
+
+
+def test_append_and_read(tmp_path):
+    store = PackedEventStore(tmp_path, segment_size=64)
+    pointers = store.append_many([{'i': i} for i in range(10)], keys=[str(i) for i in range(10)])
+    assert len({store.parse_pointer(p)[0] for p in pointers}) > 1
+    assert store.read_many(pointers[::-1]) == [{'i': i} for i in range(10)][::-1]
+    assert store.read(pointers[3]) == {'i': 3}
+    assert PackedEventStore(tmp_path).read_key('7') == {'i': 7}
+
+
+def test_pack_json_files(tmp_path):
+    source = tmp_path / 'events'
+    source.mkdir()
+    for i in range(5):
+        with open(source / f'event{i}.json', 'w') as f:
+            json.dump({'i': i}, f)
+    store = PackedEventStore(tmp_path / 'packed')
+    packed = pack_json_files(source, store, batch_size=2)
+    assert sorted(packed) == [f'event{i}' for i in range(5)]
+    assert store.read_key('event3') == {'i': 3}
+    # packing is resumable and leaves the JSON files in place
+    with open(source / 'event5.json', 'w') as f:
+        json.dump({'i': 5}, f)
+    assert list(pack_json_files(source, PackedEventStore(tmp_path / 'packed'))) == ['event5']
+    assert len(list(source.glob('*.json'))) == 6
+
+
+def test_adapter_put_many(tmp_path):
+    store = PackedEventStore(tmp_path)
+    adapter = PackedJsonAdapter('varchar(64)', store=store)
+    pointers = adapter.put_many([{'i': 0}, None, {'i': 2}])
+    assert pointers[1] is None
+    assert all(isinstance(p, Pointer) for p in pointers[::2])
+    # pointers are stored as is instead of being appended as payloads
+    assert [adapter.put(p) for p in pointers] == pointers
+    assert [adapter.get(p) for p in pointers[::2]] == [{'i': 0}, {'i': 2}]
+
+
+def test_verify_json_files(tmp_path):
+    source = tmp_path / 'events'
+    source.mkdir()
+    for i in range(3):
+        with open(source / f'event{i}.json', 'w') as f:
+            json.dump({'i': i, 'user': 'a'}, f)
+    store = PackedEventStore(tmp_path / 'packed')
+    pack_json_files(source, store)
+    result = verify_json_files(source, store)
+    assert result == {'n_referenced': 3, 'n_packed': 3, 'missing': [], 'mismatched': [], 'ok': True}
+    # an event referenced by the tables but not packed, and a file changed after packing
+    with open(source / 'event1.json', 'w') as f:
+        json.dump({'i': -1}, f)
+    result = verify_json_files(source, store, event_ids=['event0', 'event1', 'event2', 'event3'])
+    assert (result['n_referenced'], result['n_packed']) == (4, 3)
+    assert (result['missing'], result['mismatched'], result['ok']) == (['event3'], ['event1'], False)
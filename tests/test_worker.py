@@ -0,0 +1,47 @@
+import time
+
+
+def outbox_events(db, n, **attrs):
+    events = db.Event.log_events([{'event': 'user_access', 'attrs': {'user': f'test_outbox_{time.time_ns()}_{i}'}, 'data': {'entry_point': 'test'}} for i in range(n)])
+    db.Outbox.insert([{'event_id': e.id, 'event': e.name, **attrs} for e in events], skip_duplicates=True)
+    return [{'event_id': e.id} for e in events]
+
+
+def set_claimed_at(db, keys, seconds_ago):
+    db.Outbox.connection.query(
+        f'UPDATE {db.Outbox.full_table_name} SET `claimed_at` = NOW() - INTERVAL %s SECOND WHERE `event_id` IN ({", ".join(["%s"] * len(keys))})',
+        args=(seconds_ago, *[k['event_id'] for k in keys])
+    )
+
+
+def test_release_expired_dead_letters_after_max_attempts(db):
+    retried, = outbox_events(db, 1, status='claimed', attempts=2, claimed_by='test')
+    crashing, = outbox_events(db, 1, status='claimed', attempts=5, claimed_by='test')
+    set_claimed_at(db, [retried, crashing], 3600)
+    db.Outbox.release_expired(lease=600, max_attempts=5)
+    assert (db.Outbox & retried).fetch1('status') == 'pending'
+    assert (db.Outbox & crashing).fetch1('status', 'last_error') == ('dead', 'lease expired')
+
+
+def test_prune_deletes_old_done_events(db):
+    old, recent, dead = outbox_events(db, 3, status='done')
+    db.Outbox.connection.query(f'UPDATE {db.Outbox.full_table_name} SET `status` = "dead" WHERE `event_id` = %s', args=(dead['event_id'],))
+    set_claimed_at(db, [old, dead], 3600)
+    set_claimed_at(db, [recent], 0)
+    db.Outbox.prune(retention=600, limit=1)
+    assert len(db.Outbox & old) == 0
+    assert len(db.Outbox & recent) == 1
+    assert len(db.Outbox & dead) == 1
+
+
+def test_serve_in_worker_processes(db, monkeypatch):
+    from microns_dashboard_api import worker
+
+    keys = outbox_events(db, 4)
+    with monkeypatch.context() as m:
+        m.setattr(db.Event.UserAccess, 'on_events', lambda self, events, notifier=None: None)
+        stats = worker.serve(processes=2, batch_size=1, once=True)
+    assert stats['done'] >= 4
+    assert set((db.Outbox & keys).fetch('status')) == {'done'}
+    # the parent's connection is not shared with the workers, so it is still usable
+    assert db.schema.connection.query('SELECT 1').fetchone() == (1,)